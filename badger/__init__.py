@@ -13,12 +13,82 @@ TEMPLATE_BASE = 'badger'
 # Skip baking for now (Issue #139)
 BAKE_AWARD_IMAGES = False
 
+# Queue that bakes award images, when enabled. Either a dotted path to a
+# badger.baking.BakeQueue class, or one of 'sync', 'thread', or 'db'. 'sync'
+# bakes in the request saving the award. 'thread' bakes in the background,
+# but loses bakes still queued if the process is killed. 'db' queues bakes
+# in the database, for the bake_worker command.
+BAKE_QUEUE = 'sync'
+
+# Number of worker threads used by the 'thread' bake queue
+BAKE_QUEUE_THREADS = 2
+
+# Buffer progress changes made with badger.utils.record_progress() in
+# memory, writing them in bulk. See badger.progress
+PROGRESS_BUFFER = False
+
+# Number of pending progress records at which the buffer is flushed
+PROGRESS_BUFFER_SIZE = 500
+
+# Seconds after which buffered progress changes are flushed
+PROGRESS_BUFFER_MAX_AGE = 5
+
+# Max # of emails or users looked up per query by Badge.award_to_many(),
+# keeping imports of thousands of emails under database parameter limits
+AWARD_QUERY_SIZE = 500
+
+# Relations of User to prefetch wherever awards, badges & nominations are
+# listed along with their users, such as a profile used for display names
+USER_PREFETCH_RELATED = ()
+
+# Max # of awards fetched per query by the bulk assertion exports, and
+# the max # of IDs accepted by /assertions.json?ids=
+ASSERTION_EXPORT_BATCH_SIZE = 500
+
+# Max # of deferred awards inserted per query when generating claim codes,
+# and the max # of claim codes generated at once from the badge detail page
+CLAIM_CODE_BATCH_SIZE = 500
+MAX_GENERATED_CLAIM_CODES = 10000
+
+# Queue the emails inviting people to claim deferred awards, to be sent in
+# batches by the flush_claim_emails command, rather than sending each as
+# its deferred award is saved
+CLAIM_EMAIL_OUTBOX = False
+
+# Queue the notifications of awards and nominations, to be sent by the
+# dispatch_notifications command, rather than sending them as events happen.
+# Notices for the same user are collected over NOTIFICATION_DIGEST_WINDOW
+# seconds from the first one, and sent together as one digest. Notices for
+# awards made in bulk by Badge.award_to_many() are always queued, so run the
+# command wherever the bulk award API is used.
+NOTIFICATION_QUEUE = False
+NOTIFICATION_DIGEST_WINDOW = 60 * 15
+
+# # of unused claim codes the refill_claim_codes command keeps in the pool,
+# for new deferred awards to take. Codes are made as needed if this is 0.
+CLAIM_CODE_POOL_DEPTH = 0
+
+# Max # of feed items fetched per query by the streaming JSON feeds
+FEED_CHUNK_SIZE = 100
+
+# Seconds clients & proxies may cache feeds, and badge & award JSON
+FEED_CACHE_MAX_AGE = 60 * 5
+JSON_CACHE_MAX_AGE = 60 * 15
+
 # Master switch for wide-open badge creation by all users (multiplayer mode)
 ALLOW_ADD_BY_ANYONE = False
 
 # Page size for badge listings
 BADGE_PAGE_SIZE = 50
 
+# Page badge & award listings with ?after= cursors, rather than ?page=
+# numbers. Listings use cursors whenever ?after= is given, regardless.
+# See badger.pagination
+CURSOR_PAGINATION = False
+
+# Max # of badges returned by the autocomplete endpoint
+AUTOCOMPLETE_MAX_RESULTS = 10
+
 # Max # of items shown on home page recent sections
 MAX_RECENT = 15
 
@@ -34,7 +34,8 @@ show_image.allow_tags = True
 show_image.short_description = "Image"
 
 
-def build_related_link(self, model_name, name_single, name_plural, qs):
+def build_related_link(self, model_name, name_single, name_plural, qs,
+                       count=None):
     link = '%s?%s' % (
         reverse('admin:badger_%s_changelist' % model_name, args=[]),
         'badge__exact=%s' % (self.id)
@@ -43,7 +44,8 @@ def build_related_link(self, model_name, name_single, name_plural, qs):
         reverse('admin:badger_%s_add' % model_name, args=[]),
         'badge=%s' % (self.id)
     )
-    count = qs.count()
+    if count is None:
+        count = qs.count()
     what = (count == 1) and name_single or name_plural
     return ('<a href="%s">%s %s</a> (<a href="%s">new</a>)' %
             (link, count, what, new_link))
@@ -59,7 +61,7 @@ related_deferredawards_link.short_description = "Deferred Awards"
 
 def related_awards_link(self):
     return build_related_link(self, 'award', 'award', 'awards',
-                              self.award_set)
+                              self.award_set, self.award_count)
 
 related_awards_link.allow_tags = True
 related_awards_link.short_description = "Awards"
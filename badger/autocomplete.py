@@ -0,0 +1,141 @@
+"""Prefix lookup of badges by title or slug, for autocompletion.
+
+Each process keeps a sorted list of (normalized title or slug, badge ID)
+pairs in memory, searched by bisection. Badge changes are applied to the
+list in the process that made them, and bump a version stamp in the cache.
+Other processes see that the stamp has moved on, and rebuild their list
+from the database on their next lookup.
+"""
+import random
+import threading
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import search
+
+
+VERSION_CACHE_KEY = 'badger:autocomplete_version'
+VERSION_CACHE_TIMEOUT = getattr(settings,
+    'BADGER_AUTOCOMPLETE_VERSION_CACHE_TIMEOUT', 60 * 60 * 24)
+
+_autocomplete_index = None
+_autocomplete_index_lock = threading.Lock()
+
+
+def normalize(text):
+    """Normalize a title, slug, or prefix for lookup"""
+    return u' '.join(search.normalize(text or '').split())
+
+
+def get_version():
+    """Get the current version stamp of the badges, setting a new one if
+    there isn't one in the cache yet"""
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        # Start from a random stamp, so a process holding a list from before
+        # the stamp expired won't mistake it for current.
+        cache.add(VERSION_CACHE_KEY, random.randint(1, 2 ** 30),
+                  VERSION_CACHE_TIMEOUT)
+        version = cache.get(VERSION_CACHE_KEY)
+    return version
+
+
+def bump_version():
+    """Bump the version stamp, returning (old version, new version), or
+    (None, None) if the cache can't store the stamp. Badge changes mustn't
+    fail along with the cache, so this never raises."""
+    try:
+        version = cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        try:
+            get_version()
+            version = cache.incr(VERSION_CACHE_KEY)
+        except ValueError:
+            # Drop whatever stamp the cache has, so every process rebuilds
+            cache.delete(VERSION_CACHE_KEY)
+            return (None, None)
+    return (version - 1, version)
+
+
+def get_autocomplete_index():
+    """Get the autocomplete index for this process"""
+    global _autocomplete_index
+    with _autocomplete_index_lock:
+        if _autocomplete_index is None:
+            _autocomplete_index = AutocompleteIndex()
+        return _autocomplete_index
+
+
+class AutocompleteIndex(object):
+    """Sorted list of badge titles and slugs, loaded on first lookup"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.entries = None
+        self.badges = {}
+
+    def lookup(self, prefix, limit, load):
+        """Find up to limit badges with a title or slug starting with prefix.
+        ``load`` is a callable returning (pk, title, slug) for all badges,
+        used when this index is missing or stale.
+
+        Returns a list of (pk, title, slug), sorted by matching key.
+        """
+        prefix = normalize(prefix)
+        version = get_version()
+        with self.lock:
+            if self.entries is None or self.version != version:
+                self.load(load(), version)
+            if not prefix:
+                return []
+            results, seen = [], set()
+            pos, end = bisect_left(self.entries, (prefix,)), len(self.entries)
+            while pos < end and len(results) < limit:
+                key, pk = self.entries[pos]
+                if not key.startswith(prefix):
+                    break
+                if pk not in seen:
+                    seen.add(pk)
+                    results.append((pk,) + self.badges[pk])
+                pos += 1
+            return results
+
+    def load(self, rows, version):
+        """Replace the contents of the index. Call with the lock held."""
+        self.badges = dict((pk, (title, slug)) for pk, title, slug in rows)
+        self.entries = sorted(
+            (key, pk) for pk, (title, slug) in self.badges.items()
+            for key in set((normalize(title), normalize(slug))))
+        self.version = version
+
+    def update(self, pk, title=None, slug=None):
+        """Apply a badge change, or removal if title and slug are None, to
+        this index if it's current. Otherwise, leave it to be rebuilt."""
+        with self.lock:
+            if (self.entries is not None and title is not None and
+                    self.badges.get(pk) == (title, slug)):
+                return
+            old_version, new_version = bump_version()
+            if new_version is None:
+                # The change can't be versioned, so rebuild on next lookup
+                self.entries = None
+                return
+            if self.entries is None or self.version != old_version:
+                return
+            old = self.badges.pop(pk, None)
+            if old:
+                for key in set(normalize(text) for text in old):
+                    pos = bisect_left(self.entries, (key, pk))
+                    del self.entries[pos]
+            if title is not None:
+                self.badges[pk] = (title, slug)
+                for key in set((normalize(title), normalize(slug))):
+                    insort(self.entries, (key, pk))
+            self.version = new_version
+
+    def remove(self, pk):
+        """Remove a deleted badge from this index"""
+        self.update(pk)
@@ -0,0 +1,202 @@
+"""Queues for baking OBI assertions into award images, so that the bake
+doesn't have to happen during the request that creates an award.
+
+Until an award's image is baked, award.image is empty and templates fall
+back to the badge image.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import timedelta
+from Queue import Queue
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.importlib import import_module
+
+import badger
+from .models import Award, AwardBakeTask
+
+
+# Shorthand names accepted for the BADGER_BAKE_QUEUE setting
+BAKE_QUEUE_ALIASES = {
+    'sync': 'badger.baking.SyncBakeQueue',
+    'thread': 'badger.baking.ThreadBakeQueue',
+    'db': 'badger.baking.DatabaseBakeQueue',
+}
+
+# Seconds after which a claimed, unfinished database bake task is assumed to
+# belong to a dead worker and can be claimed again.
+BAKE_TASK_CLAIM_TIMEOUT = getattr(settings, 'BADGER_BAKE_TASK_CLAIM_TIMEOUT',
+                                  600)
+
+# Number of failed attempts after which a database bake task is dropped.
+BAKE_TASK_MAX_ATTEMPTS = getattr(settings, 'BADGER_BAKE_TASK_MAX_ATTEMPTS', 3)
+
+# Number of times the 'thread' bake queue looks again for an award it can't
+# find, in case the transaction that saved it hasn't committed yet, and the
+# seconds between looks.
+BAKE_THREAD_RETRIES = getattr(settings, 'BADGER_BAKE_THREAD_RETRIES', 5)
+BAKE_THREAD_RETRY_DELAY = 1.0
+
+_bake_queues = {}
+_bake_queues_lock = threading.Lock()
+
+
+def get_bake_queue(name=None):
+    """Get the bake queue configured by BADGER_BAKE_QUEUE, creating it on
+    first use. Queues are shared across the process, so that thread pools
+    are only started once."""
+    name = name or badger.settings.BAKE_QUEUE
+    path = BAKE_QUEUE_ALIASES.get(name, name)
+    with _bake_queues_lock:
+        if path not in _bake_queues:
+            module_name, cls_name = path.rsplit('.', 1)
+            cls = getattr(import_module(module_name), cls_name)
+            _bake_queues[path] = cls()
+        return _bake_queues[path]
+
+
+def bake_award(award_id, retries=0):
+    """Bake the image for an award by ID, if the award still exists. If it's
+    not found, look again up to ``retries`` times. Returns whether the image
+    was baked."""
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(BAKE_THREAD_RETRY_DELAY)
+        try:
+            award = Award.admin_objects.get(pk=award_id)
+            break
+        except Award.DoesNotExist:
+            pass
+    else:
+        logging.warning('Award %s not found, so its image was not baked' %
+                        award_id)
+        return False
+    if not award.bake_obi_image():
+        logging.warning('Failed to bake image for award %s' % award_id)
+        return False
+    return True
+
+
+class BakeQueue(object):
+    """Base class for award image bake queues"""
+
+    def enqueue(self, award):
+        """Schedule the image for a newly-saved award to be baked"""
+        raise NotImplementedError()
+
+    def enqueue_many(self, awards):
+        """Schedule images for a list of newly-saved awards to be baked"""
+        for award in awards:
+            self.enqueue(award)
+
+
+class SyncBakeQueue(BakeQueue):
+    """Bakes award images immediately, in the calling thread"""
+
+    def enqueue(self, award):
+        award.bake_obi_image()
+
+
+class ThreadBakeQueue(BakeQueue):
+    """Bakes award images in a pool of in-process worker threads.
+
+    Awards are queued before the transaction saving them commits, so workers
+    look again for awards they can't find yet. Queued bakes are finished as
+    the process exits, but are lost if it's killed. Use DatabaseBakeQueue
+    where every bake must happen.
+    """
+
+    def __init__(self, num_threads=None):
+        self.num_threads = num_threads or badger.settings.BAKE_QUEUE_THREADS
+        self.queue = Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def enqueue(self, award):
+        self.start()
+        self.queue.put(award.pk)
+
+    def start(self):
+        """Start the worker threads, if they're not already running"""
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.num_threads):
+                thread = threading.Thread(target=self.work,
+                                          name='badger-bake-%s' % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            atexit.register(self.join)
+
+    def join(self):
+        """Block until all the queued bakes are done"""
+        self.queue.join()
+
+    def work(self):
+        while True:
+            award_id = self.queue.get()
+            try:
+                bake_award(award_id, retries=BAKE_THREAD_RETRIES)
+            except Exception:
+                logging.exception('Failed to bake image for award %s' %
+                                  award_id)
+            finally:
+                # Each thread gets its own DB connection, don't leak them.
+                connection.close()
+                self.queue.task_done()
+
+
+class DatabaseBakeQueue(BakeQueue):
+    """Records bakes as AwardBakeTask rows, processed by the bake_worker
+    management command"""
+
+    def enqueue(self, award):
+        AwardBakeTask.objects.create(award=award)
+
+    def enqueue_many(self, awards):
+        AwardBakeTask.objects.bulk_create(
+            [AwardBakeTask(award=award) for award in awards])
+
+
+def run_bake_tasks(batch_size=100):
+    """Claim and bake a batch of pending AwardBakeTasks. Several workers can
+    run at once, since each task is claimed with a conditional UPDATE.
+
+    Returns a tuple of (tasks claimed, tasks baked)
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=BAKE_TASK_CLAIM_TIMEOUT)
+    tasks = list(AwardBakeTask.objects
+                 .filter(Q(claimed__isnull=True) | Q(claimed__lt=stale))
+                 .order_by('pk')[:batch_size])
+
+    claimed, baked = 0, 0
+    for task in tasks:
+        was_claimed = (AwardBakeTask.objects
+                       .filter(pk=task.pk, claimed=task.claimed)
+                       .update(claimed=now))
+        if not was_claimed:
+            # Another worker got to this one first.
+            continue
+        claimed += 1
+        try:
+            if bake_award(task.award_id):
+                baked += 1
+            # Retrying won't help with a missing award or a bad image.
+            task.delete()
+        except Exception:
+            logging.exception('Failed to bake image for award %s' %
+                              task.award_id)
+            if task.attempts + 1 >= BAKE_TASK_MAX_ATTEMPTS:
+                task.delete()
+            else:
+                (AwardBakeTask.objects.filter(pk=task.pk)
+                     .update(claimed=None, attempts=F('attempts') + 1))
+
+    return (claimed, baked)
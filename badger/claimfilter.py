@@ -0,0 +1,181 @@
+"""Filter of the emails that have deferred awards waiting to be claimed.
+
+Deferred awards are claimed by email on every login, though hardly any
+logins have awards waiting. So a Bloom filter of the emails on deferred
+awards is kept in the cache, and logins skip the query when it says an
+email definitely has none.
+
+A Bloom filter gives false positives, but never false negatives, so long
+as it covers every email saved on a deferred award. The filter itself is
+only written by the rebuild_claim_filter command. Emails saved since then
+are each recorded under a small pending key just before their deferred
+awards are saved, and logins check that key along with the filter. So
+saves never rewrite the whole filter, nor race each other.
+
+The filter expires after BADGER_CLAIM_FILTER_CACHE_TIMEOUT, and logins then
+look up deferred awards every time. So rebuild_claim_filter must be run
+regularly, from cron, well within that timeout. Rebuilds also fold in the
+pending emails and drop those of claimed awards.
+
+Rebuilds bump a version stamp in the cache, and the filter records the
+version it was built at. If rebuilds race, the versions won't match and the
+filter is ignored until it's next rebuilt. If the cache fails to store a
+pending email, the stamp is bumped too, leaving the filter out of date.
+
+see: http://en.wikipedia.org/wiki/Bloom_filter
+"""
+import hashlib
+import math
+import random
+import struct
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+FILTER_CACHE_KEY = 'badger:claim_filter'
+VERSION_CACHE_KEY = 'badger:claim_filter_version'
+PENDING_CACHE_KEY = 'badger:claim_filter_pending:%s'
+CACHE_TIMEOUT = getattr(settings, 'BADGER_CLAIM_FILTER_CACHE_TIMEOUT',
+                        60 * 60 * 24 * 7)
+
+FALSE_POSITIVE_RATE = getattr(settings,
+    'BADGER_CLAIM_FILTER_FALSE_POSITIVE_RATE', 0.01)
+
+# Filters are sized for at least this many emails
+MIN_CAPACITY = 1000
+
+# Filters are capped at this many bytes, to stay under memcached's 1MB item
+# limit. Past about 700,000 emails at a 1% false positive rate, the rate
+# rises, but emails with deferred awards are still never missed.
+MAX_SIZE = getattr(settings, 'BADGER_CLAIM_FILTER_MAX_SIZE', 800 * 1024)
+
+
+def normalize(email):
+    """Normalize an email for the filter. Folding case can only add false
+    positives, whatever the database makes of case."""
+    return (email or u'').strip().lower()
+
+
+class BloomFilter(object):
+    """Set of strings that may give false positives, in a bit array"""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        capacity = max(capacity, MIN_CAPACITY)
+        self.num_bits = min(MAX_SIZE * 8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            math.log(2) * self.num_bits / capacity)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def __getstate__(self):
+        # A string pickles smaller than a bytearray
+        return (self.num_bits, self.num_hashes, str(self.bits))
+
+    def __setstate__(self, state):
+        self.num_bits, self.num_hashes, bits = state
+        self.bits = bytearray(bits)
+
+    def positions(self, key):
+        """Bit positions for a key, by double hashing one digest"""
+        digest = hashlib.md5(normalize(key).encode('utf-8')).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self.positions(key))
+
+
+def bump_version():
+    """Bump the version stamp, returning the new version, or None if the
+    cache can't store it. Saving deferred awards mustn't fail along with
+    the cache, so this never raises."""
+    try:
+        return cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        pass
+    try:
+        # Start from a random stamp, so a filter from before the stamp
+        # expired won't be mistaken for current.
+        cache.add(VERSION_CACHE_KEY, random.randint(1, 2 ** 30),
+                  CACHE_TIMEOUT)
+        return cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        # Drop the filter, so it's out of date until it's next rebuilt,
+        # and may_have_pending() says yes to every email.
+        cache.delete_many([FILTER_CACHE_KEY, VERSION_CACHE_KEY])
+        return None
+
+
+def _get_cached():
+    """Get (filter, filter version, current version) from the cache"""
+    cached = cache.get_many([FILTER_CACHE_KEY, VERSION_CACHE_KEY])
+    version, bloom = cached.get(FILTER_CACHE_KEY, (None, None))
+    return (bloom, version, cached.get(VERSION_CACHE_KEY, None))
+
+
+def get_filter():
+    """Get the filter, or None if it's missing or out of date"""
+    bloom, version, current = _get_cached()
+    if bloom is None or version != current:
+        return None
+    return bloom
+
+
+def pending_key(email):
+    """Cache key recording that an email was saved since the last rebuild"""
+    return PENDING_CACHE_KEY % hashlib.md5(
+        normalize(email).encode('utf-8')).hexdigest()
+
+
+def may_have_pending(email):
+    """Might there be deferred awards for this email? False only if there
+    definitely aren't, according to an up to date filter and the emails
+    saved since it was built. Checked with one cache round trip."""
+    key = pending_key(email)
+    cached = cache.get_many([FILTER_CACHE_KEY, VERSION_CACHE_KEY, key])
+    if cached.get(key, False):
+        return True
+    version, bloom = cached.get(FILTER_CACHE_KEY, (None, None))
+    if bloom is None or version != cached.get(VERSION_CACHE_KEY, None):
+        return True
+    return email in bloom
+
+
+def add_emails(emails):
+    """Record emails saved since the filter was built, to be checked along
+    with it until the next rebuild. If the cache fails to store them, mark
+    the filter out of date."""
+    keys = set(pending_key(email) for email in emails if email is not None)
+    if not keys:
+        return
+    # Kept for twice as long as the filter, so they outlive any filter
+    # loaded from the database before they were saved.
+    cache.set_many(dict((key, True) for key in keys), CACHE_TIMEOUT * 2)
+    if len(cache.get_many(list(keys))) < len(keys):
+        bump_version()
+
+
+def rebuild(load):
+    """Replace the filter. ``load`` is a callable returning a list of all
+    the emails on deferred awards. Returns the number of emails, and whether
+    the cache stored the filter."""
+    # Bump the version before loading emails, so a rebuild that races this
+    # one leaves the filter out of date. Emails saved meanwhile are still
+    # pending, whether or not they're loaded.
+    version = bump_version()
+    emails = load()
+    if version is None:
+        return (len(emails), False)
+    bloom = BloomFilter(len(emails))
+    for email in emails:
+        bloom.add(email)
+    cache.set(FILTER_CACHE_KEY, (version, bloom), CACHE_TIMEOUT)
+    # Sets fail silently, e.g. for items too large for memcached
+    return (len(emails), get_filter() is not None)
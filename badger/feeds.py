@@ -1,16 +1,25 @@
 """Feeds for badge"""
+import copy
 import datetime
 import hashlib
 import urllib
+from calendar import timegm
 
 from django.contrib.syndication.views import Feed, FeedDoesNotExist
 from django.utils.feedgenerator import (SyndicationFeed, Rss201rev2Feed,
                                         Atom1Feed, get_tag_uri)
 import json
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.utils.http import http_date
 from django.shortcuts import get_object_or_404
 
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils import translation
+from django.utils.encoding import force_text
 
 try:
     from tower import ugettext_lazy as _
@@ -22,10 +31,15 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
+import badger
 from . import validate_jsonp
+from .pagination import paginate_after, paginate_since, CursorStream
+from .utils import last_modified_condition
 from .models import (Badge, Award, Nomination, Progress,
-                     BadgeAwardNotAllowedException,
-                     DEFAULT_BADGE_IMAGE)
+                     BadgeAwardNotAllowedException, prefetch_user_related,
+                     DEFAULT_BADGE_IMAGE, FEED_ITEM_CACHE_KEY,
+                     FEED_ITEM_CACHE_TIMEOUT, USER_VERSION_KEY,
+                     get_user_versions)
 
 
 MAX_FEED_ITEMS = getattr(settings, 'BADGER_MAX_FEED_ITEMS', 15)
@@ -37,6 +51,10 @@ class BaseJSONFeedGenerator(SyndicationFeed):
 
     mime_type = 'application/json'
 
+    # Links written after the items, as they may only be known once the
+    # items have been read
+    link_keys = ('next', 'since', )
+
     def _encode_complex(self, obj):
         if isinstance(obj, datetime.datetime):
             return obj.isoformat()
@@ -51,13 +69,20 @@ class BaseJSONFeedGenerator(SyndicationFeed):
     def build_feed(self):
         """Simple base feed formatter.
         Omit some named keys and any keys with false-y values"""
-        omit_keys = ('obj', 'request', 'id', )
-        feed_data = dict((k, v) for k, v in self.feed.items()
-                         if v and k not in omit_keys)
+        feed_data = self.build_envelope()
         feed_data['items'] = [self.build_item(item) for item in self.items]
         return feed_data
 
-    def write(self, outfile, encoding):
+    def build_envelope(self):
+        """The feed's own data, without its items"""
+        omit_keys = ('obj', 'request', 'id', ) + self.link_keys
+        return dict((k, v) for k, v in self.feed.items()
+                    if v and k not in omit_keys)
+
+    def stream(self, encoding):
+        """Yield the feed as JSON, a piece at a time. Items are built and
+        encoded one by one as self.items is iterated, so it may be a
+        generator rather than a list. See link_keys."""
         request = self.feed['request']
 
         # Check for a callback param, validate it before use
@@ -65,14 +90,30 @@ class BaseJSONFeedGenerator(SyndicationFeed):
         if callback is not None:
             if not validate_jsonp.is_valid_jsonp_callback_value(callback):
                 callback = None
-
-        # Build the JSON string, wrapping it in a callback param if necessary.
-        json_string = json.dumps(self.build_feed(),
-                                 default=self._encode_complex)
         if callback:
-            outfile.write('%s(%s)' % (callback, json_string))
-        else:
-            outfile.write(json_string)
+            yield '%s(' % callback
+
+        envelope = json.dumps(self.build_envelope(),
+                              default=self._encode_complex)
+        yield '%s%s"items": [' % (envelope[:-1],
+                                  envelope != '{}' and ', ' or '')
+        separator = ''
+        for item in self.items:
+            yield separator + json.dumps(self.build_item(item),
+                                         default=self._encode_complex)
+            separator = ', '
+        yield ']'
+
+        for key in self.link_keys:
+            if self.feed.get(key, None):
+                yield ', "%s": %s' % (key, json.dumps(self.feed[key]))
+        yield '}'
+        if callback:
+            yield ')'
+
+    def write(self, outfile, encoding):
+        for chunk in self.stream(encoding):
+            outfile.write(chunk)
 
 
 class BaseFeed(Feed):
@@ -84,9 +125,172 @@ class BaseFeed(Feed):
     rss_feed_generator = Rss201rev2Feed
     atom_feed_generator = Atom1Feed
 
+    # Item attributes cached as rendered fragments, shared by all formats.
+    # Each is rendered by a render_item_<name>() method. See load_fragments()
+    fragment_names = ('title', 'link', 'description', 'author_name',
+                      'author_link', )
+
     def __call__(self, request, *args, **kwargs):
-        self.request = request
-        return super(BaseFeed, self).__call__(request, *args, **kwargs)
+        # Feeds are instances shared by every request, so keep the state of
+        # this request on a copy. Streaming responses read it after this
+        # returns, while other requests may be under way.
+        feed = copy.copy(self)
+        feed.request = request
+        feed.page = None
+        feed.chunk = None
+        feed.fragments = {}
+        view = last_modified_condition(feed.get_last_modified,
+            max_age=badger.settings.FEED_CACHE_MAX_AGE)(feed.render)
+        return view(request, *args, **kwargs)
+
+    def render(self, request, *args, **kwargs):
+        """Respond with the feed. Generators with a stream() method, like
+        the JSON ones, get a streaming response with items built as they're
+        sent, rather than all up front."""
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+        feedgen = self.get_feed(obj, request)
+        if self.streaming:
+            return StreamingHttpResponse(feedgen.stream('utf-8'),
+                                         content_type=feedgen.mime_type)
+        response = HttpResponse(content_type=feedgen.mime_type)
+        if hasattr(self, 'item_pubdate'):
+            response['Last-Modified'] = http_date(
+                timegm(feedgen.latest_post_date().utctimetuple()))
+        feedgen.write(response, 'utf-8')
+        return response
+
+    def get_last_modified(self, request, format, *args, **kwargs):
+        """Latest modification of the feed's items, for conditional GET,
+        along with their count and latest ID. Deleting an item, or adding
+        one within the same second as the latest change, leaves the time
+        alone, but changes those."""
+        queryset = self.get_modified_queryset(*args, **kwargs)
+        stats = queryset.aggregate(modified=Max('modified'),
+                                   count=Count('pk'), last_pk=Max('pk'))
+        if stats['modified'] is None:
+            return None
+        return (stats['modified'], '%(count)s|%(last_pk)s' % stats)
+
+    def get_modified_queryset(self, *args, **kwargs):
+        """Queryset of the items a feed lists, given the URL arguments
+        after the format"""
+        raise NotImplementedError
+
+    def get_feed(self, obj, request):
+        feed = super(BaseFeed, self).get_feed(obj, request)
+        if self.page is not None and self.streaming:
+            # The items are read as the response is sent, after the view has
+            # returned, so they're read with a copy of this feed holding the
+            # request, page and fragments they need.
+            stream = copy.copy(self)
+            feed.items = stream.stream_items(obj, request, feed, self.page)
+        elif self.page is not None:
+            self.add_links(feed, request, self.page)
+        return feed
+
+    def add_links(self, feed, request, page):
+        """Link the feed to its next page, and to the items added since its
+        newest, for polling"""
+        if page.has_next():
+            feed.feed['next'] = request.build_absolute_uri('?%s' %
+                urllib.urlencode(dict(after=page.next_cursor)))
+        if page.since_cursor:
+            feed.feed['since'] = request.build_absolute_uri('?%s' %
+                urllib.urlencode(dict(since=page.since_cursor)))
+
+    def stream_items(self, obj, request, feed, page):
+        """Yield the items of a streaming feed, fetched and built a chunk
+        at a time, then add its links to the feed. See get_feed()"""
+        for chunk in page.chunks():
+            # Feed.get_feed() builds the items returned by items(), which
+            # returns the chunk given in self.chunk. See paginate()
+            self.chunk = chunk
+            items = super(BaseFeed, self).get_feed(obj, request).items
+            for item in items:
+                yield item
+        self.add_links(feed, request, page)
+
+    def paginate(self, queryset):
+        """Get up to MAX_FEED_ITEMS items, newest first, starting after the
+        ?after= cursor if given, or only those created since the ?since=
+        cursor. See badger.pagination
+
+        Streaming feeds get no items here at first, but a page to read them
+        from in chunks of FEED_CHUNK_SIZE."""
+        if self.chunk is not None:
+            return self.load_fragments(self.chunk)
+        after = self.request.GET.get('after', None)
+        since = self.request.GET.get('since', None)
+        try:
+            if since:
+                self.page = paginate_since(queryset, since, MAX_FEED_ITEMS,
+                                           'created')
+            elif self.streaming:
+                self.page = CursorStream(queryset, after, MAX_FEED_ITEMS,
+                    'created', badger.settings.FEED_CHUNK_SIZE)
+            else:
+                self.page = paginate_after(queryset, after, MAX_FEED_ITEMS,
+                                           'created')
+        except ValueError:
+            raise Http404
+        if self.streaming:
+            return []
+        return self.load_fragments(self.page.object_list)
+
+    def load_fragments(self, items):
+        """Look up the rendered fragments of a list of items in the cache,
+        rendering and caching those missing or out of date. The version
+        stamps of the items' users are fetched in the same round trip.
+        Returns items."""
+        items_by_key = dict((self.get_fragment_key(item), item)
+                            for item in items)
+        user_keys = set(USER_VERSION_KEY % pk for item in items
+                        for pk in self.get_fragment_user_ids(item))
+        cached = cache.get_many(items_by_key.keys() + list(user_keys))
+
+        self.fragments, missed = {}, {}
+        for key, item in items_by_key.items():
+            version = '%s|%s' % (self.get_fragment_version(item),
+                                 get_user_versions(
+                                     cached, self.get_fragment_user_ids(item)))
+            hit = cached.get(key, None)
+            if hit and hit[0] == version:
+                self.fragments[key] = hit[1]
+            else:
+                self.fragments[key] = self.render_fragments(item)
+                missed[key] = (version, self.fragments[key])
+        if missed:
+            cache.set_many(missed, FEED_ITEM_CACHE_TIMEOUT)
+        return items
+
+    def get_fragment_key(self, obj):
+        return FEED_ITEM_CACHE_KEY % (obj._meta.model_name, obj.pk)
+
+    def get_fragment_version(self, obj):
+        """Identify what an item's fragments are rendered from, short of its
+        users, whose version stamps are checked by load_fragments()"""
+        return '%s|%s|%s' % (obj.modified.isoformat(),
+                             translation.get_language(),
+                             self.request.build_absolute_uri('/'))
+
+    def get_fragment_user_ids(self, obj):
+        """IDs of the users shown in an item's fragments"""
+        return [pk for pk in (obj.creator_id,) if pk]
+
+    def render_fragments(self, obj):
+        return dict((name, force_text(
+                        getattr(self, 'render_item_%s' % name)(obj),
+                        strings_only=True))
+                    for name in self.fragment_names)
+
+    def get_fragment(self, obj, name):
+        key = self.get_fragment_key(obj)
+        if key not in self.fragments:
+            self.load_fragments([obj])
+        return self.fragments[key][name]
 
     def get_object(self, request, format):
         self.link = request.build_absolute_uri('/')
@@ -96,6 +300,7 @@ class BaseFeed(Feed):
             self.feed_type = self.rss_feed_generator
         else:
             self.feed_type = self.atom_feed_generator
+        self.streaming = hasattr(self.feed_type, 'stream')
         return super(BaseFeed, self).get_object(request)
 
     def feed_extra_kwargs(self, obj):
@@ -107,20 +312,41 @@ class BaseFeed(Feed):
     def item_pubdate(self, obj):
         return obj.created
 
+    def item_title(self, obj):
+        return self.get_fragment(obj, 'title')
+
+    def item_link(self, obj):
+        return self.get_fragment(obj, 'link')
+
+    def item_description(self, obj):
+        return self.get_fragment(obj, 'description')
+
+    def item_author_name(self, obj):
+        return self.get_fragment(obj, 'author_name')
+
     def item_author_link(self, obj):
+        return self.get_fragment(obj, 'author_link')
+
+    def render_item_title(self, obj):
+        return super(BaseFeed, self).item_title(obj)
+
+    def render_item_link(self, obj):
+        return super(BaseFeed, self).item_link(obj)
+
+    def render_item_author_link(self, obj):
         if not obj.creator or not hasattr(obj.creator, 'get_absolute_url'):
             return None
         else:
             return self.request.build_absolute_uri(
                 obj.creator.get_absolute_url())
 
-    def item_author_name(self, obj):
+    def render_item_author_name(self, obj):
         if not obj.creator:
             return None
         else:
             return '%s' % obj.creator
 
-    def item_description(self, obj):
+    def render_item_description(self, obj):
         if obj.image:
             image_url = obj.image.url
         else:
@@ -152,11 +378,26 @@ class AwardsFeed(BaseFeed):
     json_feed_generator = AwardActivityStreamJSONFeedGenerator
     atom_feed_generator = AwardActivityStreamAtomFeedGenerator
 
-    def item_title(self, obj):
+    def get_queryset(self):
+        return prefetch_user_related(
+            Award.objects.select_related('badge', 'user', 'creator'),
+            'user', 'creator')
+
+    def get_fragment_version(self, obj):
+        """Award items also show their badge"""
+        return '%s|%s' % (
+            super(AwardsFeed, self).get_fragment_version(obj),
+            obj.badge.modified.isoformat())
+
+    def get_fragment_user_ids(self, obj):
+        """Award items also show their awardee"""
+        return [pk for pk in (obj.user_id, obj.creator_id) if pk]
+
+    def render_item_title(self, obj):
         return _(u'{badgetitle} awarded to {username}').format(
             badgetitle=obj.badge.title, username=obj.user.username)
 
-    def item_author_link(self, obj):
+    def render_item_author_link(self, obj):
         if not obj.creator:
             return None
         else:
@@ -164,7 +405,7 @@ class AwardsFeed(BaseFeed):
                 reverse('badger.views.awards_by_user',
                         args=(obj.creator.username,)))
 
-    def item_link(self, obj):
+    def render_item_link(self, obj):
         return self.request.build_absolute_uri(
             reverse('badger.views.award_detail',
                     args=(obj.badge.slug, obj.pk, )))
@@ -173,15 +414,19 @@ class AwardsFeed(BaseFeed):
 class AwardsRecentFeed(AwardsFeed):
     """Feed of all recent badge awards"""
 
+    def get_modified_queryset(self):
+        return Award.objects.all()
+
     def items(self):
-        return (Award.objects
-                .order_by('-created')
-                .all()[:MAX_FEED_ITEMS])
+        return self.paginate(self.get_queryset())
 
 
 class AwardsByUserFeed(AwardsFeed):
     """Feed of recent badge awards for a user"""
 
+    def get_modified_queryset(self, username):
+        return Award.objects.filter(user__username=username)
+
     def get_object(self, request, format, username):
         super(AwardsByUserFeed, self).get_object(request, format)
         user = get_object_or_404(User, username=username)
@@ -192,15 +437,15 @@ class AwardsByUserFeed(AwardsFeed):
         return user
 
     def items(self, user):
-        return (Award.objects
-                .filter(user=user)
-                .order_by('-created')
-                .all()[:MAX_FEED_ITEMS])
+        return self.paginate(self.get_queryset().filter(user=user))
 
 
 class AwardsByBadgeFeed(AwardsFeed):
     """Feed of recent badge awards for a badge"""
 
+    def get_modified_queryset(self, slug):
+        return Award.objects.filter(badge__slug=slug)
+
     def get_object(self, request, format, slug):
         super(AwardsByBadgeFeed, self).get_object(request, format)
         badge = get_object_or_404(Badge, slug=slug)
@@ -211,9 +456,7 @@ class AwardsByBadgeFeed(AwardsFeed):
         return badge
 
     def items(self, badge):
-        return (Award.objects
-                .filter(badge=badge).order_by('-created')
-                .all()[:MAX_FEED_ITEMS])
+        return self.paginate(self.get_queryset().filter(badge=badge))
 
 
 class BadgesJSONFeedGenerator(BaseJSONFeedGenerator):
@@ -226,10 +469,14 @@ class BadgesFeed(BaseFeed):
 
     json_feed_generator = BadgesJSONFeedGenerator
 
-    def item_title(self, obj):
+    def get_queryset(self):
+        return prefetch_user_related(
+            Badge.objects.select_related('creator'), 'creator')
+
+    def render_item_title(self, obj):
         return obj.title
 
-    def item_link(self, obj):
+    def render_item_link(self, obj):
         return self.request.build_absolute_uri(
             reverse('badger.views.detail',
                     args=(obj.slug, )))
@@ -237,15 +484,19 @@ class BadgesFeed(BaseFeed):
 
 class BadgesRecentFeed(BadgesFeed):
 
+    def get_modified_queryset(self):
+        return Badge.objects.all()
+
     def items(self):
-        return (Badge.objects
-                .order_by('-created')
-                .all()[:MAX_FEED_ITEMS])
+        return self.paginate(self.get_queryset())
 
 
 class BadgesByUserFeed(BadgesFeed):
     """Feed of badges recently created by a user"""
 
+    def get_modified_queryset(self, username):
+        return Badge.objects.filter(creator__username=username)
+
     def get_object(self, request, format, username):
         super(BadgesByUserFeed, self).get_object(request, format)
         user = get_object_or_404(User, username=username)
@@ -256,7 +507,4 @@ class BadgesByUserFeed(BadgesFeed):
         return user
 
     def items(self, user):
-        return (Badge.objects
-                .filter(creator=user)
-                .order_by('-created')
-                .all()[:MAX_FEED_ITEMS])
+        return self.paginate(self.get_queryset().filter(creator=user))
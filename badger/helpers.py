@@ -18,7 +18,7 @@ from jinja2 import evalcontextfilter, Markup, escape
 from jingo import register, env
 
 from .models import (Badge, Award, Nomination, Progress,
-                     BadgeAwardNotAllowedException)
+                     BadgeAwardNotAllowedException, prefetch_user_related)
 
 @register.function
 def user_avatar(user, secure=False, size=256, rating='pg', default=''):
@@ -42,7 +42,10 @@ def user_avatar(user, secure=False, size=256, rating='pg', default=''):
 
 @register.function
 def user_awards(user):
-    return Award.objects.filter(user=user)
+    return prefetch_user_related(
+        Award.objects.filter(user=user)
+                     .select_related('badge', 'user', 'creator'),
+        'user', 'creator')
 
 
 @register.function
@@ -68,12 +71,16 @@ def qr_code_image(value, alt=None, size=150):
 
 @register.function
 def nominations_pending_approval(user):
-    return Nomination.objects.filter(badge__creator=user,
-                                     approver__isnull=True)
+    return prefetch_user_related(
+        Nomination.objects.filter(badge__creator=user, approver__isnull=True)
+                          .select_related('badge', 'nominee', 'creator'),
+        'nominee', 'creator')
 
 
 @register.function
 def nominations_pending_acceptance(user):
-    return Nomination.objects.filter(nominee=user,
-                                     approver__isnull=False,
-                                     accepted=False)
+    return prefetch_user_related(
+        Nomination.objects.filter(nominee=user, approver__isnull=False,
+                                  accepted=False)
+                          .select_related('badge', 'nominee', 'creator'),
+        'nominee', 'creator')
@@ -38,6 +38,8 @@ if "notification" in settings.INSTALLED_APPS:
                 _(u"a nomination to award you a badge was approved")),
             ("nomination_accepted", _(u"Nomination accepted"),
                 _(u"a nomination you submitted for an award has been accepted")),
+            ("notification_digest", _(u"Notification digest"),
+                _(u"several of the notices above, collected into one")),
         )
         for notice in notices:
             notification.create_notice_type(*notice)
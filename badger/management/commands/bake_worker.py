@@ -0,0 +1,38 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from badger.baking import run_bake_tasks
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Bake award images queued with BADGER_BAKE_QUEUE = "db"'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit once the queue is empty, rather than polling'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of bake tasks to claim at a time'),
+        make_option('--sleep', type='float', dest='sleep', default=5.0,
+                    help='Seconds to wait between polls of an empty queue'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        while True:
+            claimed, baked = run_bake_tasks(batch_size)
+            if claimed and verbosity > 0:
+                self.stdout.write('Baked %s of %s claimed award images' %
+                                  (baked, claimed))
+            if not claimed:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
@@ -0,0 +1,48 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from badger.models import NotificationTask
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Send the award and nomination notices queued with '
+            'BADGER_NOTIFICATION_QUEUE, collected into a digest per user')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit once no digests are due, rather than polling'),
+        make_option('--window', type='int', dest='window', default=None,
+                    help='Seconds to collect notices for a digest, from '
+                         'the first. Defaults to '
+                         'BADGER_NOTIFICATION_DIGEST_WINDOW'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of users to send digests to per batch'),
+        make_option('--sleep', type='float', dest='sleep', default=5.0,
+                    help='Seconds to wait between polls when no digests are '
+                         'due'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        window = options['window']
+        if window is not None and window < 0:
+            raise CommandError('--window must not be negative')
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        while True:
+            claimed, sent = NotificationTask.objects.dispatch(window,
+                                                              batch_size)
+            if claimed and verbosity > 0:
+                self.stdout.write('Sent %s of %s queued notices' %
+                                  (sent, claimed))
+            if not claimed:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
@@ -0,0 +1,40 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from badger.models import ClaimEmailTask
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Send the deferred award claim emails queued with '
+            'BADGER_CLAIM_EMAIL_OUTBOX')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit once no emails are due, rather than polling'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of emails to send over each connection'),
+        make_option('--sleep', type='float', dest='sleep', default=5.0,
+                    help='Seconds to wait between polls when no emails are '
+                         'due'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        while True:
+            claimed, sent = ClaimEmailTask.objects.flush(batch_size)
+            if claimed and verbosity > 0:
+                self.stdout.write('Sent %s of %s queued claim emails' %
+                                  (sent, claimed))
+            if not claimed:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
@@ -1,19 +1,110 @@
-from os.path import dirname, basename
+import os
+import time
+from multiprocessing import Pool
+from optparse import make_option
 
-from django.conf import settings
-from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
-from django.db.models import get_apps, get_models, signals
-from django.utils.importlib import import_module
+from django.db import connection
 
-from badger.models import Badge, Award, Progress
-from badger.management import update_badges
+from badger.baking import bake_award
+from badger.models import Badge, Award
 
 
 class Command(BaseCommand):
     args = ''
     help = 'Rebake award images'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of awards to fetch per query'),
+        make_option('--workers', type='int', dest='workers', default=0,
+                    help='Number of worker processes to bake with. The '
+                         'default bakes in this process'),
+        make_option('--since-pk', type='int', dest='since_pk', default=None,
+                    help='Only rebake awards with a pk greater than this'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File recording the last pk baked, used to resume '
+                         'an interrupted run. Removed once the run is done'),
+        make_option('--badge', dest='badge', default=None,
+                    help='Only rebake awards for the badge with this slug'),
+    )
+
     def handle(self, *args, **options):
-        for award in Award.objects.all():
-            award.save()
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        qs = Award.objects.order_by('pk')
+        if options['badge']:
+            try:
+                badge = Badge.objects.get(slug=options['badge'])
+            except Badge.DoesNotExist:
+                raise CommandError('No badge with slug "%s"' %
+                                   options['badge'])
+            qs = qs.filter(badge=badge)
+
+        checkpoint = options['checkpoint']
+        last_pk = options['since_pk']
+        if last_pk is None:
+            last_pk = self.read_checkpoint(checkpoint)
+
+        pool = None
+        if options['workers'] > 0:
+            # Don't share this process' DB connection with the workers,
+            # they'll each open their own.
+            connection.close()
+            pool = Pool(options['workers'])
+
+        count, start = 0, time.time()
+        try:
+            while True:
+                # Keyset pagination, so each batch is an indexed range scan
+                # no matter how deep into the table we are.
+                batch_qs = qs.filter(pk__gt=last_pk)[:batch_size]
+                if pool:
+                    pks = list(batch_qs.values_list('pk', flat=True))
+                    pool.map(bake_award, pks)
+                else:
+                    pks = []
+                    for award in (batch_qs.select_related('badge', 'user')
+                                          .iterator()):
+                        award.bake_obi_image()
+                        pks.append(award.pk)
+
+                if not pks:
+                    break
+
+                last_pk = pks[-1]
+                count += len(pks)
+                self.write_checkpoint(checkpoint, last_pk)
+
+                elapsed = time.time() - start
+                self.stdout.write('Baked %s awards, up to pk %s '
+                                  '(%0.1f awards/s)' %
+                                  (count, last_pk, count / max(elapsed, 0.001)))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    def read_checkpoint(self, checkpoint):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return 0
+        try:
+            return int(open(checkpoint).read().strip())
+        except ValueError:
+            raise CommandError('Invalid checkpoint file %s' % checkpoint)
+
+    def write_checkpoint(self, checkpoint, last_pk):
+        if not checkpoint:
+            return
+        # Write to a temp file and rename, so a crash never leaves a
+        # half-written checkpoint behind.
+        tmp_fn = '%s.tmp' % checkpoint
+        with open(tmp_fn, 'w') as fout:
+            fout.write('%s\n' % last_pk)
+        os.rename(tmp_fn, checkpoint)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from badger import claimfilter
+from badger.models import DeferredAward
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Rebuild the filter of emails with deferred awards, which lets '
+            'logins skip looking for awards to claim. This must be run '
+            'from cron, well within BADGER_CLAIM_FILTER_CACHE_TIMEOUT '
+            '(a week, by default): without it, the filter expires and every '
+            'login looks for awards again.')
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        def load():
+            return list(DeferredAward.objects.order_by()
+                                     .exclude(email=None)
+                                     .values_list('email', flat=True)
+                                     .distinct())
+
+        count, stored = claimfilter.rebuild(load)
+        if not stored:
+            raise CommandError('The cache did not store the claim filter of '
+                               '%s emails. Is the cache down, or its item '
+                               'size limit below '
+                               'BADGER_CLAIM_FILTER_MAX_SIZE?' % count)
+        if verbosity > 0:
+            self.stdout.write('Added %s emails to the claim filter' % count)
@@ -0,0 +1,44 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from badger.models import Badge, BadgeSearchIndex
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Rebuild the badge search index'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500,
+                    help='Number of badges to index per query'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        # Drop entries for badges that no longer exist, in case they were
+        # deleted without signals.
+        BadgeSearchIndex.objects.exclude(
+            badge__in=Badge.objects.values('pk')).delete()
+
+        count, last_pk = 0, 0
+        while True:
+            badges = list(Badge.objects.order_by('pk')
+                                       .filter(pk__gt=last_pk)
+                                       .only('pk', 'title', 'slug',
+                                             'description')[:batch_size])
+            if not badges:
+                break
+            BadgeSearchIndex.objects.index_badges(badges)
+            last_pk = badges[-1].pk
+            count += len(badges)
+            if verbosity > 1:
+                self.stdout.write('Indexed %s badges' % count)
+
+        if verbosity > 0:
+            self.stdout.write('Indexed %s badges' % count)
@@ -0,0 +1,57 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, get_model
+
+from badger.models import Badge, Award
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Repair the award counts kept on badges and, if it has an '
+            'award_count field, on the user profile model')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Report counts that are wrong, without fixing them'),
+    )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+
+        counts = dict(Award.admin_objects.values_list('badge')
+                                         .annotate(Count('id')))
+        self.recount(Badge, 'pk', counts)
+
+        profile_model = self.get_profile_model()
+        if profile_model:
+            counts = dict(Award.admin_objects.values_list('user')
+                                             .annotate(Count('id')))
+            self.recount(profile_model, 'user', counts)
+
+    def get_profile_model(self):
+        profile_module = getattr(settings, 'AUTH_PROFILE_MODULE', None)
+        if not profile_module:
+            return None
+        model = get_model(*profile_module.split('.', 1))
+        if not model or 'award_count' not in model._meta.get_all_field_names():
+            return None
+        return model
+
+    def recount(self, model, key_field, counts):
+        """Compare award_count on every row of model with the actual count,
+        looked up in counts by key_field, and fix the rows that differ"""
+        name = model._meta.verbose_name_plural
+        fixed = 0
+        for pk, key, award_count in (model.objects.order_by()
+                .values_list('pk', key_field, 'award_count').iterator()):
+            actual = counts.get(key, 0)
+            if award_count == actual:
+                continue
+            fixed += 1
+            if not self.dry_run:
+                model.objects.filter(pk=pk).update(award_count=actual)
+        self.stdout.write('%s %s of %s with wrong award counts' % (
+            self.dry_run and 'Found' or 'Fixed', fixed, name))
@@ -0,0 +1,53 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+import badger
+from badger.models import ClaimCode
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Fill the pool of unused claim codes taken by new deferred '
+            'awards, reporting its depth and refill rate')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--depth', type='int', dest='depth', default=None,
+                    help='Number of unused codes to keep in the pool. '
+                         'Defaults to BADGER_CLAIM_CODE_POOL_DEPTH'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None,
+                    help='Number of codes to insert per query'),
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Keep refilling the pool, rather than exiting'),
+        make_option('--sleep', type='float', dest='sleep', default=60.0,
+                    help='Seconds to wait between refills with --loop'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        depth = options['depth']
+        if depth is None:
+            depth = badger.settings.CLAIM_CODE_POOL_DEPTH
+        if depth < 1:
+            raise CommandError('--depth or BADGER_CLAIM_CODE_POOL_DEPTH must '
+                               'be at least 1')
+        batch_size = options['batch_size']
+        if batch_size is not None and batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        while True:
+            start = time.time()
+            taken, added = ClaimCode.objects.refill(depth, batch_size)
+            elapsed = time.time() - start
+            if verbosity > 0:
+                self.stdout.write(
+                    'Claim code pool depth %s: %s codes taken since the last '
+                    'refill, %s added in %0.2fs (%d codes/s)' % (
+                        ClaimCode.objects.depth(), taken, added, elapsed,
+                        added / max(elapsed, 0.001)))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
@@ -13,10 +13,11 @@ from urlparse import urljoin
 
 from django.conf import settings
 
-from django.db import models
-from django.db.models import signals, Q, Count, Max
+from django.db import models, transaction, IntegrityError
+from django.db.models import signals, Q, F, Avg, Count, Max, Min
 from django.db.models.fields.files import FieldFile, ImageFieldFile
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
 from django.core.exceptions import ValidationError
 from django.core.files.storage import FileSystemStorage
 from django.core.files.base import ContentFile
@@ -26,6 +27,7 @@ from django.contrib.contenttypes.models import ContentType
 
 from django.template import Context, TemplateDoesNotExist
 from django.template.loader import render_to_string
+from django.utils import timezone
 
 from django.core.serializers.json import DjangoJSONEncoder
 
@@ -72,7 +74,10 @@ else:
     notification = None
 
 import badger
+from . import claimfilter, pngchunks, search
+from .autocomplete import get_autocomplete_index
 from .signals import (badge_will_be_awarded, badge_was_awarded,
+                      badges_were_awarded,
                       nomination_will_be_approved, nomination_was_approved,
                       nomination_will_be_accepted, nomination_was_accepted,
                       nomination_will_be_rejected, nomination_was_rejected,
@@ -108,9 +113,85 @@ TIME_ZONE_OFFSET = getattr(settings, "TIME_ZONE_OFFSET", timedelta(0))
 
 MK_UPLOAD_TMPL = '%(base)s/%(h1)s/%(h2)s/%(hash)s_%(field_fn)s_%(now)s_%(rand)04d.%(ext)s'
 
+BAKED_IMAGE_TMPL = '%(base)s/%(h1)s/%(h2)s/%(hash)s_baked.png'
+
 DEFAULT_HTTP_PROTOCOL = getattr(settings, "DEFAULT_HTTP_PROTOCOL", "http")
 
 CLAIM_CODE_LENGTH = getattr(settings, "CLAIM_CODE_LENGTH", 6)
+CLAIM_CODE_MAX_RETRIES = 5
+
+# Max number of claim codes in each query looking them up.
+CLAIM_CODE_QUERY_SIZE = 500
+
+# Seconds after which a claimed, unsent claim email is assumed to belong to
+# a dead worker and can be claimed again.
+CLAIM_EMAIL_CLAIM_TIMEOUT = getattr(settings,
+    'BADGER_CLAIM_EMAIL_CLAIM_TIMEOUT', 600)
+
+# Seconds before retrying a claim email that failed to send, doubled with
+# each failed attempt.
+CLAIM_EMAIL_RETRY_DELAY = getattr(settings, 'BADGER_CLAIM_EMAIL_RETRY_DELAY',
+                                  60)
+
+# Number of failed attempts after which a claim email is dropped.
+CLAIM_EMAIL_MAX_ATTEMPTS = getattr(settings,
+    'BADGER_CLAIM_EMAIL_MAX_ATTEMPTS', 5)
+
+# Seconds after which a claimed, unsent notice is assumed to belong to a
+# dead worker and can be claimed again.
+NOTIFICATION_CLAIM_TIMEOUT = getattr(settings,
+    'BADGER_NOTIFICATION_CLAIM_TIMEOUT', 600)
+
+# Seconds before retrying a notice that failed to send, doubled with each
+# failed attempt.
+NOTIFICATION_RETRY_DELAY = getattr(settings,
+    'BADGER_NOTIFICATION_RETRY_DELAY', 60)
+
+# Number of failed attempts after which a notice is dropped.
+NOTIFICATION_MAX_ATTEMPTS = getattr(settings,
+    'BADGER_NOTIFICATION_MAX_ATTEMPTS', 5)
+
+# Max number of badges returned by a ranked search
+SEARCH_MAX_RESULTS = getattr(settings, 'BADGER_SEARCH_MAX_RESULTS', 500)
+
+# Max number of badge IDs in each query narrowing down search matches
+SEARCH_CHUNK_SIZE = 500
+
+# Cached set of badge IDs awarded to each user, stored along with the
+# version stamp it was loaded at. Changes bump the stamp, but they can't wait
+# for their transaction to commit, so a set re-cached meanwhile may be stale
+# until it times out. Keep the timeout short.
+AWARDED_BADGE_IDS_CACHE_KEY = 'badger:awarded_badge_ids:%s'
+AWARDED_BADGE_IDS_VERSION_KEY = 'badger:awarded_badge_ids_version:%s'
+AWARDED_BADGE_IDS_CACHE_TIMEOUT = getattr(settings,
+    'BADGER_AWARDED_BADGE_IDS_CACHE_TIMEOUT', 60)
+
+# The most used tags, up to TOP_TAGS_CACHE_SIZE, are cached for top_tags()
+TOP_TAGS_CACHE_KEY = 'badger:top_tags'
+TOP_TAGS_CACHE_SIZE = 100
+TOP_TAGS_CACHE_TIMEOUT = getattr(settings,
+    'BADGER_TOP_TAGS_CACHE_TIMEOUT', 60 * 60)
+
+# Version stamp for each user, bumped whenever they change. Cached items
+# that show users are stored along with the stamps of those users, so a
+# change to a user leaves them all out of date without finding them.
+USER_VERSION_KEY = 'badger:user_version:%s'
+USER_VERSION_TIMEOUT = getattr(settings, 'BADGER_USER_VERSION_TIMEOUT',
+                               60 * 60 * 24 * 7)
+
+# Cached OBI JSON for badges & award assertions, each stored along with the
+# (modified timestamps, base URL, user versions) it was built for
+OBI_BADGE_CACHE_KEY = 'badger:obi_badge:%s'
+OBI_ASSERTION_CACHE_KEY = 'badger:obi_assertion:%s'
+OBI_CACHE_TIMEOUT = getattr(settings, 'BADGER_OBI_CACHE_TIMEOUT', 60 * 60 * 24)
+
+FEED_ITEM_CACHE_KEY = 'badger:feed_item:%s:%s'
+FEED_ITEM_CACHE_TIMEOUT = getattr(settings, 'BADGER_FEED_ITEM_CACHE_TIMEOUT',
+                                  60 * 60 * 24)
+
+PREREQUISITE_GRAPH_CACHE_KEY = 'badger:prerequisite_graph'
+PREREQUISITE_GRAPH_CACHE_TIMEOUT = getattr(settings,
+    'BADGER_PREREQUISITE_GRAPH_CACHE_TIMEOUT', 60 * 60)
 
 
 def _document_django_model(cls):
@@ -167,6 +248,13 @@ def scale_image(img_upload, img_max_size):
     return ContentFile(img_data)
 
 
+def chunks(items, size):
+    """Split a sequence into lists of up to size items, for queries that
+    look up items in bulk"""
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 # Taken from http://stackoverflow.com/a/4019144
 def slugify(txt):
     """A custom version of slugify that retains non-ascii characters. The
@@ -321,6 +409,19 @@ class SearchManagerMixin(object):
             return queryset.order_by('-created')
 
 
+def prefetch_user_related(qs, *fields):
+    """Prefetch the BADGER_USER_PREFETCH_RELATED relations of the named User
+    foreign keys in a queryset, so that rendering the users of a list
+    doesn't cost queries per row. Use with select_related() for the foreign
+    keys themselves."""
+    lookups = ['%s__%s' % (field, related)
+               for field in fields
+               for related in badger.settings.USER_PREFETCH_RELATED]
+    if lookups:
+        qs = qs.prefetch_related(*lookups)
+    return qs
+
+
 class BadgerException(Exception):
     """General Badger model exception"""
 
@@ -345,6 +446,42 @@ class BadgeManager(models.Manager, SearchManagerMixin):
     """Manager for Badge model objects"""
     search_fields = ('title', 'slug', 'description', )
 
+    def search(self, query_string, sort='relevance'):
+        """Search badges using the BadgeSearchIndex. Results are ranked by
+        relevance, up to SEARCH_MAX_RESULTS, unless sort is 'title' or
+        'created', which get every match. Quoted phrases must match in
+        sequence."""
+        strip_qs = query_string.strip()
+        if not strip_qs:
+            return self.all_sorted(sort).order_by('-modified')
+        by_relevance = sort not in ('title', 'created')
+        ranked_ids = BadgeSearchIndex.objects.rank(
+            self._normalize_query(strip_qs),
+            by_relevance and SEARCH_MAX_RESULTS or None)
+        if not ranked_ids:
+            return self.none()
+        # The IDs are written into the SQL, rather than passed as query
+        # parameters, since broad queries can match more badges than
+        # databases like SQLite accept parameters.
+        table = self.model._meta.db_table
+        queryset = self.all_sorted(sort).extra(where=['%s.id IN (%s)' % (
+            table, ', '.join('%d' % badge_id for badge_id in ranked_ids))])
+        if not by_relevance:
+            return queryset
+        # Order by position in the ranked list
+        rank_sql = 'CASE %s.id %s END' % (
+            table,
+            ' '.join('WHEN %d THEN %d' % (badge_id, rank)
+                     for rank, badge_id in enumerate(ranked_ids)))
+        return queryset.extra(select={'search_rank': rank_sql},
+                              order_by=['search_rank'])
+
+    def autocomplete(self, prefix, limit=10):
+        """Find badges with a title or slug starting with prefix, from an
+        in-memory index. Returns a list of (pk, title, slug)"""
+        return get_autocomplete_index().lookup(prefix, limit,
+            lambda: self.values_list('pk', 'title', 'slug').iterator())
+
     def allows_add_by(self, user):
         if user.is_anonymous():
             return False
@@ -365,31 +502,18 @@ class BadgeManager(models.Manager, SearchManagerMixin):
         """Assemble list of top-used tags"""
         if not taggit:
             return []
+        if limit > TOP_TAGS_CACHE_SIZE:
+            return [dict(count=x.count, tag=x.tag)
+                    for x in BadgeTagCount.objects.top(min_count, limit)]
 
-        # TODO: There has got to be a better way to do this. I got lost in
-        # Django model bits, though.
-
-        # Gather list of tags sorted by use frequency
-        ct = ContentType.objects.get_for_model(Badge)
-        tag_counts = (TaggedItem.objects
-            .values('tag')
-            .annotate(count=Count('id'))
-            .filter(content_type=ct, count__gte=min_count)
-            .order_by('-count'))[:limit]
-
-        # Gather set of tag IDs from list
-        tag_ids = set(x['tag'] for x in tag_counts)
-
-        # Gather and map tag objects to IDs
-        tags_by_id = dict((x.pk, x)
-            for x in Tag.objects.filter(pk__in=tag_ids))
-
-        # Join tag objects up with counts
-        tags_with_counts = [
-            dict(count=x['count'], tag=tags_by_id[x['tag']])
-            for x in tag_counts]
+        tag_counts = cache.get(TOP_TAGS_CACHE_KEY)
+        if tag_counts is None:
+            tag_counts = [dict(count=x.count, tag=x.tag)
+                          for x in BadgeTagCount.objects.top(
+                              1, TOP_TAGS_CACHE_SIZE)]
+            cache.set(TOP_TAGS_CACHE_KEY, tag_counts, TOP_TAGS_CACHE_TIMEOUT)
 
-        return tags_with_counts
+        return [x for x in tag_counts if x['count'] >= min_count][:limit]
 
 
 @_document_django_model
@@ -426,12 +550,18 @@ class Badge(models.Model):
     if taggit:
         tags = TaggableManager(blank=True)
 
+    award_count = models.IntegerField(default=0, editable=False,
+            help_text=('Number of times this badge has been awarded, kept up '
+                       'to date as awards are saved & deleted'))
+
     creator = models.ForeignKey(User, blank=True, null=True)
     created = models.DateTimeField(auto_now_add=True, blank=False)
     modified = models.DateTimeField(auto_now=True, blank=False)
 
     class Meta:
         unique_together = ('title', 'slug')
+        # For cursor pagination, see badger.pagination
+        index_together = [('modified', 'id'), ('created', 'id')]
         ordering = ['-modified', '-created']
         permissions = (
             ('manage_deferredawards',
@@ -461,6 +591,13 @@ class Badge(models.Model):
         if not self.slug:
             self.slug = slugify(self.title)
 
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # award_count is maintained with UPDATEs as awards change, so
+            # don't clobber it with whatever value this instance loaded.
+            kwargs['update_fields'] = [f.name for f in self._meta.fields
+                                       if not f.primary_key and
+                                       f.name != 'award_count']
+
         super(Badge, self).save(**kwargs)
 
         if notification:
@@ -580,22 +717,161 @@ class Badge(models.Model):
                                     creator=awarder,
                                     description=description)
 
+    def award_to_many(self, emails, awarder=None, description=''):
+        """Award this badge to a list of email addresses in bulk.
+
+        Works like award_to() for each email, but resolves users, checks
+        existing awards and inserts new awards & deferred awards with a
+        few queries for every BADGER_AWARD_QUERY_SIZE emails. Notices of the
+        new awards are queued for the dispatch_notifications command, rather
+        than sent one by one.
+
+        Returns a dict mapping each email to one of 'AWARDED', 'INVITED' or
+        'ALREADYAWARDED'. Like repeated calls to award_to(), an email listed
+        more than once is awarded again, unless the badge is unique; each
+        email maps to the result of its first listing.
+
+        All the awards are made in one transaction, so if this raises, none
+        of them were.
+        """
+        if not awarder:
+            awarder = self.creator
+
+        if not self.allows_award_to(awarder):
+            raise BadgeAwardNotAllowedException()
+
+        with transaction.atomic():
+            return self._award_to_many(emails, awarder, description)
+
+    def _award_to_many(self, emails, awarder, description):
+        """Make the awards for award_to_many(), within its transaction"""
+        results = {}
+        size = badger.settings.AWARD_QUERY_SIZE
+
+        # Resolve users for the emails in chunks. Like award_to(), use the
+        # most recently created user when an email matches several.
+        users = []
+        for chunk in chunks(set(emails), size):
+            users.extend(User.objects.filter(email__in=chunk))
+        users.sort(key=lambda user: user.date_joined)
+        users_by_email = dict((user.email.lower(), user) for user in users)
+
+        awardees, invite_emails = [], []
+        for email in emails:
+            user = users_by_email.get(email.lower(), None)
+            if user is None:
+                invite_emails.append(email)
+            else:
+                awardees.append((email, user))
+
+        # Check for existing awards & deferred awards, a chunk at a time.
+        awarded_user_ids, deferred_emails = set(), set()
+        if self.unique:
+            user_ids = set(user.pk for email, user in awardees)
+            for chunk in chunks(user_ids, size):
+                awarded_user_ids.update(Award.objects
+                    .filter(badge=self, user__in=chunk)
+                    .values_list('user_id', flat=True))
+            for chunk in chunks(set(invite_emails), size):
+                deferred_emails.update(x.lower() for x in DeferredAward.objects
+                    .filter(badge=self, email__in=chunk)
+                    .values_list('email', flat=True))
+
+        new_awards = []
+        for email, user in awardees:
+            if user.pk in awarded_user_ids:
+                results.setdefault(email, 'ALREADYAWARDED')
+                continue
+            results.setdefault(email, 'AWARDED')
+            if self.unique:
+                awarded_user_ids.add(user.pk)
+            award = Award(user=user, badge=self, creator=awarder,
+                          description=description)
+            badge_will_be_awarded.send(sender=Award, award=award)
+            new_awards.append(award)
+
+        new_emails = []
+        for email in invite_emails:
+            if email.lower() in deferred_emails:
+                results.setdefault(email, 'ALREADYAWARDED')
+                continue
+            results.setdefault(email, 'INVITED')
+            if self.unique:
+                deferred_emails.add(email.lower())
+            new_emails.append(email)
+        new_deferreds = [
+            DeferredAward(badge=self, email=email, claim_code=code)
+            for email, code in zip(new_emails, DeferredAward.objects
+                                   .claim_codes(len(new_emails)))]
+
+        if new_awards:
+            Award.objects.bulk_create(new_awards)
+            self._after_award_many(new_awards)
+
+        if new_deferreds:
+            DeferredAward.objects.create_many(new_deferreds)
+
+        return results
+
+    def _after_award_many(self, new_awards):
+        """Perform the post-save work of Award.save() for awards inserted in
+        bulk, batching the queries that can be shared across awards"""
+        # bulk_create() doesn't set primary keys, so fetch the new awards back
+        # a chunk of users at a time. The latest awards for each user are the
+        # ones just created, as many as were inserted for them.
+        size = badger.settings.AWARD_QUERY_SIZE
+        new_counts = {}
+        for award in new_awards:
+            new_counts[award.user_id] = new_counts.get(award.user_id, 0) + 1
+        user_id_chunks = chunks(new_counts, size)
+        awards_by_user_id = {}
+        for chunk in user_id_chunks:
+            for award in (Award.objects.filter(badge=self, user__in=chunk)
+                                       .select_related('user', 'creator')
+                                       .order_by('pk')):
+                awards_by_user_id.setdefault(award.user_id, []).append(award)
+        new_by_user_id = dict(
+            (user_id, awards_by_user_id[user_id][-count:])
+            for user_id, count in new_counts.items())
+        awards = [new_by_user_id[award.user_id].pop(0)
+                  for award in new_awards]
+        for award in awards:
+            award.badge = self
+
+        if badger.settings.BAKE_AWARD_IMAGES:
+            from badger.baking import get_bake_queue
+            get_bake_queue().enqueue_many(awards)
+
+        badges_were_awarded.send(sender=Award, awards=awards)
+
+        # Sending each notice costs queries, so queue them all with one
+        # insert, whether or not notices are queued otherwise.
+        notices = []
+        for award in awards:
+            award._after_award(notices)
+        if notices:
+            NotificationTask.objects.enqueue(notices)
+
+        # Reset any progress for these users & this badge upon award.
+        for chunk in user_id_chunks:
+            Progress.objects.filter(user__in=chunk, badge=self).delete()
+
     def check_prerequisites(self, awardee, dep_badge, award):
         """Check the prerequisites for this badge. If they're all met, award
         this badge to the user."""
-        if self.is_awarded_to(awardee):
+        awarded_ids = get_awarded_badge_ids(awardee)
+        if self.pk in awarded_ids:
             # Not unique, but badge auto-award from prerequisites should only
             # happen once.
             return None
-        for badge in self.prerequisites.all():
-            if not badge.is_awarded_to(awardee):
-                # Bail on the first unmet prerequisites
-                return None
+        prerequisite_ids, dependent_ids = get_prerequisite_graph()
+        if not prerequisite_ids.get(self.pk, set()) <= awarded_ids:
+            return None
         return self.award_to(awardee)
 
     def is_awarded_to(self, user):
         """Has this badge been awarded to the user?"""
-        return Award.objects.filter(user=user, badge=self).count() > 0
+        return self.pk in get_awarded_badge_ids(user)
 
     def progress_for(self, user):
         """Get or create (but not save) a progress record for a user"""
@@ -629,11 +905,8 @@ class Badge(models.Model):
         """Nominate a nominee for this badge on the nominator's behalf"""
         nomination = Nomination.objects.create(badge=self, creator=nominator,
                                          nominee=nominee)
-        if notification:
-            if self.creator:
-                notification.send([self.creator], 'nomination_submitted',
-                                  dict(nomination=nomination,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
+        if notification and self.creator:
+            send_notices([(self.creator, 'nomination_submitted', nomination)])
 
         if self.nominations_autoapproved:
             nomination.approve_by(self.creator)
@@ -645,10 +918,7 @@ class Badge(models.Model):
 
     def as_obi_serialization(self, request=None):
         """Produce an Open Badge Infrastructure serialization of this badge"""
-        if request:
-            base_url = request.build_absolute_uri('/')[:-1]
-        else:
-            base_url = 'http://%s' % (Site.objects.get_current().domain,)
+        base_url = get_obi_base_url(request)
 
         # see: https://github.com/brianlovesdata/openbadges/wiki/Assertions
         if not self.creator:
@@ -678,11 +948,307 @@ class Badge(models.Model):
 
         return data
 
+    def as_obi_serialization_json(self, request=None):
+        """JSON for as_obi_serialization(), cached until the badge or its
+        creator changes"""
+        cache_key = OBI_BADGE_CACHE_KEY % self.pk
+        user_ids = [pk for pk in (self.creator_id,) if pk]
+        cached = cache.get_many([cache_key] + [USER_VERSION_KEY % pk
+                                               for pk in user_ids])
+        version = '%s|%s|%s' % (self.modified.isoformat(),
+                                get_obi_base_url(request),
+                                get_user_versions(cached, user_ids))
+        hit = cached.get(cache_key, None)
+        if hit and hit[0] == version:
+            return hit[1]
+        data = json.dumps(self.as_obi_serialization(request))
+        cache.set(cache_key, (version, data), OBI_CACHE_TIMEOUT)
+        return data
+
+
+class BadgeSearchIndexManager(models.Manager):
+
+    def index_badges(self, badges):
+        """Replace the index entries for a list of badges"""
+        badges = list(badges)
+        rows = []
+        for badge in badges:
+            length, entries = search.index_terms(dict(
+                title=badge.title, slug=badge.slug,
+                description=badge.description))
+            # A row with an empty term records the length of each badge,
+            # for corpus statistics.
+            rows.append(self.model(badge=badge, term='', frequency=0,
+                                   length=length, positions=''))
+            for term, (frequency, positions) in entries.items():
+                rows.append(self.model(
+                    badge=badge, term=term, frequency=frequency,
+                    length=length,
+                    positions=' '.join(str(p) for p in positions)))
+        self.filter(badge__in=badges).delete()
+        self.bulk_create(rows)
+
+    def rank(self, phrases, limit=None):
+        """Find the IDs of badges matching all the phrases of a query, as
+        from SearchManagerMixin._normalize_query(), ordered by BM25 score"""
+        query = search.parse_query(phrases)
+        terms = set(term for phrase in query for term in phrase)
+        if not terms:
+            return []
+
+        doc_freqs = dict(self.filter(term__in=terms).values_list('term')
+                                                    .annotate(Count('id')))
+        if len(doc_freqs) < len(terms):
+            # Every term has to match somewhere.
+            return []
+        stats = self.filter(term='').aggregate(num_docs=Count('id'),
+                                               avg_length=Avg('length'))
+
+        # Start from the postings of the rarest term, then narrow those down
+        # with each of the others.
+        postings = None
+        for term in sorted(terms, key=lambda term: doc_freqs[term]):
+            if postings is None:
+                chunks = [None]
+            else:
+                badge_ids = list(postings)
+                chunks = [badge_ids[i:i + SEARCH_CHUNK_SIZE] for i in
+                          range(0, len(badge_ids), SEARCH_CHUNK_SIZE)]
+            matched = {}
+            for chunk in chunks:
+                qs = self.filter(term=term)
+                if chunk is not None:
+                    qs = qs.filter(badge__in=chunk)
+                for badge_id, frequency, length, positions in qs.values_list(
+                        'badge', 'frequency', 'length', 'positions'):
+                    if postings is None:
+                        entry = (length, {}, {})
+                    else:
+                        entry = postings[badge_id]
+                    entry[1][term] = frequency
+                    entry[2][term] = [int(p) for p in positions.split()]
+                    matched[badge_id] = entry
+            postings = matched
+            if not postings:
+                return []
+
+        scores = []
+        for badge_id, (length, frequencies, positions) in postings.items():
+            if not all(search.has_phrase(positions, phrase)
+                       for phrase in query if len(phrase) > 1):
+                continue
+            score = sum(search.bm25(frequency, doc_freqs[term], length,
+                                    stats['num_docs'], stats['avg_length'])
+                        for term, frequency in frequencies.items())
+            scores.append((-score, badge_id))
+        scores.sort()
+        return [badge_id for score, badge_id in scores[:limit]]
+
+
+class BadgeSearchIndex(models.Model):
+    """Search index entry recording where a term appears in a badge"""
+    objects = BadgeSearchIndexManager()
+
+    badge = models.ForeignKey(Badge)
+    term = models.CharField(max_length=search.MAX_TERM_LENGTH,
+                            db_index=True)
+    frequency = models.IntegerField(default=0)
+    length = models.IntegerField(default=0)
+    positions = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return u'%s in %s' % (self.term, self.badge)
+
+
+class BadgeTagCountManager(models.Manager):
+
+    def top(self, min_count=1, limit=20):
+        """Most used tags, with their counts"""
+        return (self.filter(count__gte=min_count).select_related('tag')
+                    .order_by('-count')[:limit])
+
+    def count_for(self, tag):
+        """Number of badges with the given tag"""
+        counts = self.filter(tag=tag).values_list('count', flat=True)
+        return counts and counts[0] or 0
+
+    def adjust(self, tag_id, amount):
+        """Add amount to the count for a tag"""
+        updated = self.filter(tag=tag_id).update(
+            count=F('count') + amount)
+        if not updated and amount > 0:
+            count, created = self.get_or_create(tag_id=tag_id,
+                                                defaults=dict(count=amount))
+            if not created:
+                self.filter(tag=tag_id).update(count=F('count') + amount)
+        cache.delete(TOP_TAGS_CACHE_KEY)
+
+
+if taggit:
+    class BadgeTagCount(models.Model):
+        """Number of badges with a tag, kept up to date as badges are tagged
+        and untagged"""
+        objects = BadgeTagCountManager()
+
+        tag = models.OneToOneField(Tag, primary_key=True,
+                                   related_name='badge_count')
+        count = models.IntegerField(default=0, db_index=True)
+
+        def __unicode__(self):
+            return u'%s badges tagged %s' % (self.count, self.tag)
+
+
+def get_obi_base_url(request=None):
+    """Base URL for links in OBI serializations, worked out once per
+    request"""
+    if not request:
+        return 'http://%s' % (Site.objects.get_current().domain,)
+    if not hasattr(request, '_badger_obi_base_url'):
+        request._badger_obi_base_url = request.build_absolute_uri('/')[:-1]
+    return request._badger_obi_base_url
+
+
+def invalidate_obi_assertions(award_ids):
+    """Drop cached OBI assertion JSON for a list of award IDs"""
+    cache.delete_many([OBI_ASSERTION_CACHE_KEY % pk for pk in award_ids])
+
+
+def invalidate_feed_items(model, pks):
+    """Drop cached feed item fragments for a list of IDs of a model"""
+    cache.delete_many([FEED_ITEM_CACHE_KEY % (model._meta.model_name, pk)
+                       for pk in pks])
+
+
+def get_awarded_badge_ids(user):
+    """Get the set of IDs for badges awarded to a user. Cached until the
+    user's awards change."""
+    if user is None or not user.pk:
+        return set()
+    cache_key = AWARDED_BADGE_IDS_CACHE_KEY % user.pk
+    version_key = AWARDED_BADGE_IDS_VERSION_KEY % user.pk
+    cached = cache.get_many([cache_key, version_key])
+    current = cached.get(version_key, None)
+    version, badge_ids = cached.get(cache_key, (None, None))
+    if badge_ids is None or version != current:
+        # The version is read before the query, so a change made meanwhile
+        # leaves this set out of date, rather than cached as current.
+        badge_ids = set(Award.objects.filter(user=user)
+                                     .values_list('badge_id', flat=True))
+        cache.set(cache_key, (current, badge_ids),
+                  AWARDED_BADGE_IDS_CACHE_TIMEOUT)
+    return badge_ids
+
+
+def invalidate_awarded_badge_ids(user_id):
+    """Mark the cached set of badge IDs awarded to a user out of date"""
+    bump_version(AWARDED_BADGE_IDS_VERSION_KEY % user_id,
+                 AWARDED_BADGE_IDS_CACHE_TIMEOUT * 2)
+
+
+def invalidate_user_version(user_id):
+    """Mark everything cached along with a user's version stamp out of
+    date"""
+    bump_version(USER_VERSION_KEY % user_id, USER_VERSION_TIMEOUT)
+
+
+def get_user_versions(cached, user_ids):
+    """Describe the version stamps of a list of user IDs, given the result
+    of a cache.get_many() that included their USER_VERSION_KEYs"""
+    return ','.join('%s' % cached.get(USER_VERSION_KEY % pk, None)
+                    for pk in user_ids)
+
+
+def bump_version(version_key, timeout):
+    """Bump a version stamp in the cache. The cache is only advisory, so
+    this never raises if the cache can't store the stamp."""
+    try:
+        cache.incr(version_key)
+    except ValueError:
+        # Start from a random stamp, so an item cached before the stamp
+        # expired won't be mistaken for current.
+        try:
+            cache.add(version_key, random.randint(1, 2 ** 30), timeout)
+            cache.incr(version_key)
+        except ValueError:
+            # The cache is down or evicting. Drop whatever stamp it has, so
+            # items cached along with it aren't taken as current.
+            cache.delete(version_key)
+
+
+def get_prerequisite_graph():
+    """Get the prerequisite graph for all badges, as a tuple of dicts
+    mapping badge IDs to the set of their prerequisite IDs and to the set of
+    their dependent IDs. Cached until any badge prerequisites change."""
+    graph = cache.get(PREREQUISITE_GRAPH_CACHE_KEY)
+    if graph is None:
+        prerequisite_ids, dependent_ids = {}, {}
+        through = Badge.prerequisites.through
+        for badge_id, prerequisite_id in through.objects.values_list(
+                'from_badge_id', 'to_badge_id'):
+            prerequisite_ids.setdefault(badge_id, set()).add(prerequisite_id)
+            dependent_ids.setdefault(prerequisite_id, set()).add(badge_id)
+        graph = (prerequisite_ids, dependent_ids)
+        cache.set(PREREQUISITE_GRAPH_CACHE_KEY, graph,
+                  PREREQUISITE_GRAPH_CACHE_TIMEOUT)
+    return graph
+
+
+def invalidate_prerequisite_graph(*args, **kwargs):
+    """Drop the cached prerequisite graph. Accepts any arguments, so it can
+    be connected directly to signals."""
+    cache.delete(PREREQUISITE_GRAPH_CACHE_KEY)
+
+
+def find_satisfied_badge_ids(awarded_ids, new_badge_ids):
+    """Find the IDs of badges whose prerequisites become met when
+    new_badge_ids are added to a user's awarded_ids, including badges
+    satisfied in turn by those. Returned in the order they should be
+    awarded, so each badge comes after its prerequisites."""
+    prerequisite_ids, dependent_ids = get_prerequisite_graph()
+    awarded_ids = set(awarded_ids) | set(new_badge_ids)
+    satisfied_ids = []
+    frontier = set(new_badge_ids)
+    while frontier:
+        candidate_ids = set()
+        for badge_id in frontier:
+            candidate_ids |= dependent_ids.get(badge_id, set())
+        frontier = set(badge_id for badge_id in candidate_ids - awarded_ids
+                       if prerequisite_ids[badge_id] <= awarded_ids)
+        awarded_ids |= frontier
+        satisfied_ids.extend(sorted(frontier))
+    return satisfied_ids
+
 
 class AwardManager(models.Manager):
     def get_query_set(self):
         return super(AwardManager, self).get_query_set().exclude(hidden=True)
 
+    def obi_assertions_json(self, awards, request=None):
+        """Get the OBI assertion JSON for a list of awards, as a dict keyed
+        by award pk. Cached assertions are fetched in one round trip, along
+        with the version stamps of their users, so load the awards with
+        select_related('badge') to avoid a query per award."""
+        awards_by_key = dict((OBI_ASSERTION_CACHE_KEY % award.pk, award)
+                             for award in awards)
+        user_keys = set(USER_VERSION_KEY % pk for award in awards
+                        for pk in award.obi_assertion_user_ids())
+        cached = cache.get_many(awards_by_key.keys() + list(user_keys))
+
+        results, missed = {}, {}
+        for cache_key, award in awards_by_key.items():
+            version = '%s|%s' % (award.obi_assertion_version(request),
+                                 get_user_versions(
+                                     cached, award.obi_assertion_user_ids()))
+            hit = cached.get(cache_key, None)
+            if hit and hit[0] == version:
+                results[award.pk] = hit[1]
+            else:
+                results[award.pk] = json.dumps(award.as_obi_assertion(request))
+                missed[cache_key] = (version, results[award.pk])
+        if missed:
+            cache.set_many(missed, OBI_CACHE_TIMEOUT)
+        return results
+
 
 @_document_django_model
 class Award(models.Model):
@@ -709,7 +1275,13 @@ class Award(models.Model):
 
     get_permissions_for = get_permissions_for
 
+    # Set False on awards made while resolving prerequisites, whose cascade
+    # has already been accounted for.
+    resolves_prerequisites = True
+
     class Meta:
+        # For cursor pagination, see badger.pagination
+        index_together = [('modified', 'id'), ('created', 'id')]
         ordering = ['-modified', '-created']
 
     def __unicode__(self):
@@ -754,31 +1326,63 @@ class Award(models.Model):
 
         super(Award, self).save(*args, **kwargs)
 
-        # Called after super.save(), so we have some auto-gen fields
-        if badger.settings.BAKE_AWARD_IMAGES:
-            self.bake_obi_image()
-
         if is_new:
-            # Only fire was-awarded signal on a new award.
-            badge_was_awarded.send(sender=self.__class__, award=self)
-
-            if notification:
-                if self.creator:
-                    notification.send([self.badge.creator], 'badge_awarded',
-                                      dict(award=self,
-                                           protocol=DEFAULT_HTTP_PROTOCOL))
-                notification.send([self.user], 'award_received',
-                                  dict(award=self,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
+            # Called after super.save(), so we have some auto-gen fields
+            if badger.settings.BAKE_AWARD_IMAGES:
+                from badger.baking import get_bake_queue
+                get_bake_queue().enqueue(self)
 
-            # Since this badge was just awarded, check the prerequisites on all
-            # badges that count this as one.
-            for dep_badge in self.badge.badge_set.all():
-                dep_badge.check_prerequisites(self.user, self.badge, self)
+            badges_were_awarded.send(sender=self.__class__, awards=[self])
+            self._after_award()
 
             # Reset any progress for this user & badge upon award.
             Progress.objects.filter(user=self.user, badge=self.badge).delete()
 
+    def _after_award(self, notices=None):
+        """Fire signals, send notifications and award dependent badges for a
+        newly-saved award. If a list of ``notices`` is given, notices are
+        added to it to be sent by the caller, rather than sent now."""
+        # Only fire was-awarded signal on a new award.
+        badge_was_awarded.send(sender=self.__class__, award=self)
+
+        if notification:
+            award_notices = []
+            if self.creator:
+                award_notices.append(
+                    (self.badge.creator, 'badge_awarded', self))
+            award_notices.append((self.user, 'award_received', self))
+            if notices is None:
+                send_notices(award_notices)
+            else:
+                notices.extend(award_notices)
+
+        # Since this badge was just awarded, award every badge whose
+        # prerequisites are now all met. The cascade is resolved up front, so
+        # the awards made here don't each resolve it again.
+        if self.resolves_prerequisites:
+            self.award_satisfied_badges()
+
+    def award_satisfied_badges(self):
+        """Award the user every badge whose prerequisites are met now that
+        this award exists, including badges that cascade from those."""
+        prerequisite_ids, dependent_ids = get_prerequisite_graph()
+        if self.badge_id not in dependent_ids:
+            # Skip fetching the user's awards if nothing depends on this.
+            return []
+        badge_ids = find_satisfied_badge_ids(
+            get_awarded_badge_ids(self.user), [self.badge_id])
+        if not badge_ids:
+            return []
+        badges = Badge.objects.in_bulk(badge_ids)
+        awards = []
+        for badge_id in badge_ids:
+            badge = badges[badge_id]
+            award = Award(user=self.user, badge=badge, creator=badge.creator)
+            award.resolves_prerequisites = False
+            award.save()
+            awards.append(award)
+        return awards
+
     def delete(self):
         """Make sure nominations get deleted along with awards"""
         Nomination.objects.filter(award=self).delete()
@@ -786,11 +1390,7 @@ class Award(models.Model):
 
     def as_obi_assertion(self, request=None):
         badge_data = self.badge.as_obi_serialization(request)
-
-        if request:
-            base_url = request.build_absolute_uri('/')[:-1]
-        else:
-            base_url = 'http://%s' % (Site.objects.get_current().domain,)
+        base_url = get_obi_base_url(request)
 
         # If this award has a creator (ie. not system-issued), tweak the issuer
         # data to reflect award creator.
@@ -822,6 +1422,25 @@ class Award(models.Model):
         }
         return assertion
 
+    def obi_assertion_version(self, request=None):
+        """Identify the data an assertion is built from, short of the
+        users, whose version stamps are checked by obi_assertions_json()"""
+        return '%s|%s|%s' % (self.modified.isoformat(),
+                             self.badge.modified.isoformat(),
+                             get_obi_base_url(request))
+
+    def obi_assertion_user_ids(self):
+        """IDs of the users shown in the assertion: the awardee, the
+        awarder, and the badge creator, who issues the badge and awards
+        without an awarder"""
+        return [pk for pk in (self.user_id, self.creator_id,
+                              self.badge.creator_id) if pk]
+
+    def as_obi_assertion_json(self, request=None):
+        """JSON for as_obi_assertion(), cached until the award or badge
+        changes"""
+        return Award.objects.obi_assertions_json([self], request)[self.pk]
+
     def bake_obi_image(self, request=None):
         """Bake the OBI JSON badge award assertion into a copy of the original
         badge's image, if one exists."""
@@ -831,47 +1450,70 @@ class Award(models.Model):
         else:
             base_url = 'http://%s' % (Site.objects.get_current().domain,)
 
-        if self.badge.image:
-            # Make a duplicate of the badge image
-            self.badge.image.open()
-            img_copy_fh = StringIO(self.badge.image.file.read())
-        else:
-            # Make a copy of the default badge image
-            img_copy_fh = StringIO(open(DEFAULT_BADGE_IMAGE, 'rb').read())
-
-        try:
-            # Try processing the image copy, bail if the image is bad.
-            img = Image.open(img_copy_fh)
-        except IOError:
-            return False
-
-        # Here's where the baking gets done. JSON representation of the OBI
-        # assertion gets written into the "openbadges" metadata field
-        # see: http://blog.client9.com/2007/08/python-pil-and-png-metadata-take-2.html
-        # see: https://github.com/mozilla/openbadges/blob/development/lib/baker.js
-        # see: https://github.com/mozilla/openbadges/blob/development/controllers/baker.js
-        try:
-            from PIL import PngImagePlugin
-        except ImportError:
-            import PngImagePlugin
-        meta = PngImagePlugin.PngInfo()
-
         # TODO: Will need this, if we stop doing hosted assertions
         # assertion = self.as_obi_assertion(request)
-        # meta.add_text('openbadges', json.dumps(assertion))
         hosted_assertion_url = '%s%s' % (
             base_url, reverse('badger.award_detail_json',
                               args=(self.badge.slug, self.id)))
-        meta.add_text('openbadges', hosted_assertion_url)
 
-        # And, finally save out the baked image.
-        new_img = StringIO()
-        img.save(new_img, "PNG", pnginfo=meta)
-        img_data = new_img.getvalue()
+        if self.badge.image:
+            # Read from the badge image
+            source_name = self.badge.image.name
+
+            def read_source():
+                self.badge.image.open()
+                return self.badge.image.file.read()
+        else:
+            # Read from the default badge image
+            source_name = DEFAULT_BADGE_IMAGE
+
+            def read_source():
+                return open(DEFAULT_BADGE_IMAGE, 'rb').read()
+
+        # The parsed source image is cached by content hash, so baking many
+        # awards of a badge only reads and parses the badge image once.
+        source_hash, source_data, source_split = pngchunks.load_source(
+            source_name, read_source)
+
+        # Baked images are named by a hash of the source image and the
+        # assertion URL. If that name is already in place, the award is
+        # already baked and there's nothing to do.
+        baked_hash = (hashlib.sha1('%s-%s' % (
+            source_hash, hosted_assertion_url.encode('utf-8'))).hexdigest())
+        base, slug = self.get_upload_meta()
+        baked_name = BAKED_IMAGE_TMPL % dict(base=base, hash=baked_hash,
+                                             h1=baked_hash[0],
+                                             h2=baked_hash[1])
+        storage = self.image.storage
+        if self.image.name == baked_name and storage.exists(baked_name):
+            return True
+
+        # Here's where the baking gets done. The assertion URL gets written
+        # into the "openbadges" metadata field by splicing a text chunk into
+        # the PNG, without decoding the image. Fall back to re-encoding with
+        # PIL for source images that aren't PNGs.
+        # see: https://github.com/mozilla/openbadges/blob/development/lib/baker.js
+        # see: https://github.com/mozilla/openbadges/blob/development/controllers/baker.js
+        if source_split:
+            img_data = pngchunks.bake(source_split, 'openbadges',
+                                      hosted_assertion_url)
+        else:
+            img_data = pngchunks.bake_with_pil(source_data, 'openbadges',
+                                               hosted_assertion_url)
+            if img_data is None:
+                # Bail if the image is bad.
+                return False
+
+        # And, finally save out the baked image. An existing file by the same
+        # name already has the same content.
         name_before = self.image.name
-        self.image.save('', ContentFile(img_data), False)
-        if (self.image.storage.exists(name_before)):
-            self.image.storage.delete(name_before)
+        if storage.exists(baked_name):
+            self.image.name = baked_name
+        else:
+            self.image.name = storage.save(baked_name, ContentFile(img_data))
+        if (name_before and name_before != self.image.name and
+                storage.exists(name_before)):
+            storage.delete(name_before)
 
         # Update the image field with the new image name
         # NOTE: Can't do a full save(), because this gets called in save()
@@ -889,12 +1531,210 @@ class Award(models.Model):
             return None
 
 
+def invalidate_awarded_badge_ids_on_award(sender, award, **kwargs):
+    invalidate_awarded_badge_ids(award.user_id)
+
+
+def invalidate_awarded_badge_ids_on_change(sender, instance, **kwargs):
+    invalidate_awarded_badge_ids(instance.user_id)
+
+
+def increment_badge_award_count(sender, awards, **kwargs):
+    counts = {}
+    for award in awards:
+        counts[award.badge_id] = counts.get(award.badge_id, 0) + 1
+    for badge_id, count in counts.items():
+        Badge.objects.filter(pk=badge_id).update(
+            award_count=F('award_count') + count)
+
+
+def decrement_badge_award_count(sender, instance, **kwargs):
+    Badge.objects.filter(pk=instance.badge_id).update(
+        award_count=F('award_count') - 1)
+
+
+def invalidate_obi_assertion(sender, instance, **kwargs):
+    invalidate_obi_assertions([instance.pk])
+
+
+def invalidate_obi_badge(sender, instance, **kwargs):
+    cache.delete(OBI_BADGE_CACHE_KEY % instance.pk)
+
+
+def invalidate_user_version_on_change(sender, instance, created=False,
+                                      update_fields=None, **kwargs):
+    """Assertions include the emails & usernames of their users, badges
+    their creator's, and feed items the names & links of their users. So
+    bump the user's version stamp when they change, rather than finding
+    everything cached for them"""
+    if created or (update_fields and
+                   set(update_fields) <= set(['last_login'])):
+        return
+    invalidate_user_version(instance.pk)
+
+
+def invalidate_feed_item(sender, instance, **kwargs):
+    invalidate_feed_items(sender, [instance.pk])
+
+
+def update_badge_search_index(sender, instance, raw=False, **kwargs):
+    if not raw:
+        BadgeSearchIndex.objects.index_badges([instance])
+
+
+def update_autocomplete_index(sender, instance, **kwargs):
+    get_autocomplete_index().update(instance.pk, instance.title,
+                                    instance.slug)
+
+
+def remove_from_autocomplete_index(sender, instance, **kwargs):
+    get_autocomplete_index().remove(instance.pk)
+
+
+badge_was_awarded.connect(invalidate_awarded_badge_ids_on_award,
+                          sender=Award)
+signals.post_save.connect(invalidate_awarded_badge_ids_on_change,
+                          sender=Award)
+signals.post_delete.connect(invalidate_awarded_badge_ids_on_change,
+                            sender=Award)
+badges_were_awarded.connect(increment_badge_award_count, sender=Award)
+signals.post_delete.connect(decrement_badge_award_count, sender=Award)
+signals.m2m_changed.connect(invalidate_prerequisite_graph,
+                            sender=Badge.prerequisites.through)
+signals.post_delete.connect(invalidate_prerequisite_graph, sender=Badge)
+signals.post_save.connect(update_badge_search_index, sender=Badge)
+signals.post_save.connect(update_autocomplete_index, sender=Badge)
+signals.post_delete.connect(remove_from_autocomplete_index, sender=Badge)
+signals.post_save.connect(invalidate_obi_assertion, sender=Award)
+signals.post_delete.connect(invalidate_obi_assertion, sender=Award)
+signals.post_save.connect(invalidate_obi_badge, sender=Badge)
+signals.post_delete.connect(invalidate_obi_badge, sender=Badge)
+signals.post_save.connect(invalidate_user_version_on_change, sender=User)
+signals.post_save.connect(invalidate_feed_item, sender=Award)
+signals.post_delete.connect(invalidate_feed_item, sender=Award)
+signals.post_save.connect(invalidate_feed_item, sender=Badge)
+signals.post_delete.connect(invalidate_feed_item, sender=Badge)
+
+
+if taggit:
+    def increment_badge_tag_count(sender, instance, created=False, raw=False,
+                                  **kwargs):
+        if (created and not raw and instance.content_type_id ==
+                ContentType.objects.get_for_model(Badge).pk):
+            BadgeTagCount.objects.adjust(instance.tag_id, 1)
+
+    def decrement_badge_tag_count(sender, instance, **kwargs):
+        if (instance.content_type_id ==
+                ContentType.objects.get_for_model(Badge).pk):
+            BadgeTagCount.objects.adjust(instance.tag_id, -1)
+
+    signals.post_save.connect(increment_badge_tag_count, sender=TaggedItem)
+    signals.post_delete.connect(decrement_badge_tag_count, sender=TaggedItem)
+
+
+class AwardBakeTask(models.Model):
+    """Pending bake of an award image, processed by the bake_worker
+    command"""
+    award = models.ForeignKey(Award)
+    attempts = models.IntegerField(default=0)
+    claimed = models.DateTimeField(blank=True, null=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True, blank=False)
+
+    class Meta:
+        ordering = ['created']
+
+    def __unicode__(self):
+        return u'Bake task for %s' % (self.award,)
+
+
 class ProgressManager(models.Manager):
-    pass
+
+    def increment_many(self, increments):
+        """Increment progress counters in bulk.
+
+        Takes a list of (user, badge, amount) tuples. See update_many().
+        """
+        return self.update_many([(user, badge, amount, None)
+                                 for user, badge, amount in increments])
+
+    def update_many(self, updates):
+        """Update progress counters and percents in bulk.
+
+        Takes a list of (user, badge, amount, percent) tuples, where user
+        and badge are instances or IDs, and percent is None to leave it
+        unchanged. Amounts for the same user & badge are
+        added together and the last percent wins. Existing progress records
+        are updated atomically with one UPDATE per distinct change, and
+        missing records are created in one INSERT. Badges are auto-awarded
+        where progress reaches 100 percent, like Progress.save(). It all
+        happens in one transaction, so if this raises, nothing changed.
+
+        Returns a dict mapping (user ID, badge ID) to the new counter value.
+        """
+        changes = {}
+        for user, badge, amount, percent in updates:
+            key = (getattr(user, 'pk', user), getattr(badge, 'pk', badge))
+            prev_amount, prev_percent = changes.get(key, (0, None))
+            if percent is None:
+                percent = prev_percent
+            changes[key] = (prev_amount + amount, percent)
+        if not changes:
+            return {}
+
+        with transaction.atomic():
+            return self._update_many(changes)
+
+    def _update_many(self, changes):
+        user_ids = set(user_id for user_id, badge_id in changes)
+        badge_ids = set(badge_id for user_id, badge_id in changes)
+
+        def fetch():
+            return dict(
+                ((p.user_id, p.badge_id), p)
+                for p in self.filter(user__in=user_ids, badge__in=badge_ids)
+                if (p.user_id, p.badge_id) in changes)
+
+        existing = fetch()
+
+        pks_by_change = {}
+        for key, progress in existing.items():
+            pks_by_change.setdefault(changes[key], []).append(progress.pk)
+        now = timezone.now()
+        for (amount, percent), pks in pks_by_change.items():
+            fields = dict(counter=F('counter') + amount, modified=now)
+            if percent is not None:
+                fields['percent'] = percent
+            self.filter(pk__in=pks).update(**fields)
+
+        # Like Progress.save(), don't start new progress toward unique badges
+        # that have already been awarded.
+        badges = Badge.objects.in_bulk(badge_ids)
+        awarded = set(Award.objects
+            .filter(user__in=user_ids,
+                    badge__in=[pk for pk in badge_ids if badges[pk].unique])
+            .values_list('user_id', 'badge_id'))
+        new_progresses = [
+            Progress(user_id=user_id, badge_id=badge_id, counter=amount,
+                     percent=percent or 0)
+            for (user_id, badge_id), (amount, percent) in changes.items()
+            if (user_id, badge_id) not in existing and
+               (user_id, badge_id) not in awarded]
+        if new_progresses:
+            self.bulk_create(new_progresses)
+
+        counters = {}
+        for key, progress in fetch().items():
+            counters[key] = progress.counter
+            if progress.percent >= 100:
+                progress.badge = badges[progress.badge_id]
+                progress._award(raise_exception=False)
+        return counters
 
 
 class Progress(models.Model):
     """Record tracking progress toward auto-award of a badge"""
+    objects = ProgressManager()
+
     badge = models.ForeignKey(Badge)
     user = models.ForeignKey(User, related_name="progress_user")
     percent = models.FloatField(default=0)
@@ -925,9 +1765,17 @@ class Progress(models.Model):
 
         super(Progress, self).save(*args, **kwargs)
 
-        # If the percent is over/equal to 1.0, auto-award on save.
-        if self.percent >= 100:
+        self._award(raise_exception=True)
+
+    def _award(self, raise_exception=False):
+        """If the percent is over/equal to 1.0, auto-award the badge"""
+        if self.percent < 100:
+            return
+        try:
             self.badge.award_to(self.user)
+        except BadgeAlreadyAwardedException as e:
+            if raise_exception:
+                raise e
 
     def _quiet_save(self, raise_exception=False):
         try:
@@ -945,18 +1793,41 @@ class Progress(models.Model):
         self.percent = value
         self._quiet_save(raise_exception)
 
-    def increment_by(self, amount, raise_exception=False):
-        # TODO: Do this with an UPDATE counter+amount in DB
-        self.counter += amount
-        self._quiet_save(raise_exception)
-        return self
+    def increment_by(self, amount, raise_exception=False, refresh=True):
+        """Increment the counter with an atomic UPDATE in the database, so
+        concurrent increments aren't lost. With refresh, the counter and
+        percent are reloaded afterward to include other updates, and the
+        badge is auto-awarded if the percent has reached 100. Without it,
+        this is just the UPDATE, and never awards the badge."""
+        if not self.pk:
+            # Nothing to update yet, so this just saves the new record.
+            self.counter = (self.counter or 0) + amount
+            self._quiet_save(raise_exception)
+            return self
 
-    def decrement_by(self, amount, raise_exception=False):
-        # TODO: Do this with an UPDATE counter-amount in DB
-        self.counter -= amount
-        self._quiet_save(raise_exception)
+        (Progress.objects.filter(pk=self.pk)
+                 .update(counter=F('counter') + amount,
+                         modified=timezone.now()))
+
+        if not refresh:
+            # The percent in memory may be out of date, so it can't be
+            # trusted to decide on an award.
+            self.counter = (self.counter or 0) + amount
+            return self
+
+        values = (Progress.objects.filter(pk=self.pk)
+                                  .values_list('counter', 'percent'))
+        if values:
+            self.counter, self.percent = values[0]
+
+        self._award(raise_exception)
         return self
 
+    def decrement_by(self, amount, raise_exception=False, refresh=True):
+        """Decrement the counter with an atomic UPDATE in the database. See
+        increment_by()."""
+        return self.increment_by(-amount, raise_exception, refresh)
+
 
 class DeferredAwardManager(models.Manager):
 
@@ -970,13 +1841,123 @@ class DeferredAwardManager(models.Manager):
                 if x['claim_group']]
 
     def generate(self, badge, user=None, amount=10, reusable=False):
-        """Generate a number of deferred awards for a badge"""
+        """Generate a number of deferred awards for a badge, inserted in
+        batches of CLAIM_CODE_BATCH_SIZE"""
         claim_group = '%s-%s' % (time(), random.randint(0, 10000))
-        for i in range(0, amount):
-            (DeferredAward(badge=badge, creator=user, reusable=reusable,
-                           claim_group=claim_group).save())
+        batch_size = badger.settings.CLAIM_CODE_BATCH_SIZE
+        remaining, retries = amount, 0
+        with transaction.atomic():
+            while remaining > 0:
+                codes = self.claim_codes(min(batch_size, remaining))
+                try:
+                    # In a savepoint, so a code taken since it was checked
+                    # only costs this batch, which is retried with new codes
+                    with transaction.atomic():
+                        self.bulk_create([
+                            DeferredAward(badge=badge, creator=user,
+                                          reusable=reusable,
+                                          claim_group=claim_group,
+                                          claim_code=code)
+                            for code in codes])
+                except IntegrityError:
+                    retries += 1
+                    if retries > CLAIM_CODE_MAX_RETRIES:
+                        raise
+                    continue
+                remaining -= len(codes)
         return claim_group
 
+    def claim_codes(self, count):
+        """Get a number of unused claim codes, taking them from the pool if
+        it's enabled, and making up any shortfall"""
+        codes = []
+        if badger.settings.CLAIM_CODE_POOL_DEPTH:
+            codes = ClaimCode.objects.pop(count)
+        return codes + self.unused_claim_codes(count - len(codes))
+
+    def unused_claim_codes(self, count):
+        """Draw a number of distinct claim codes from make_random_code()
+        that aren't in use or in the pool, checking each round of them with
+        a query per table for every CLAIM_CODE_QUERY_SIZE codes"""
+        codes = set()
+        while len(codes) < count:
+            drawn = set()
+            while len(drawn) < count - len(codes):
+                code = make_random_code()
+                if code not in codes:
+                    drawn.add(code)
+            for chunk in chunks(drawn, CLAIM_CODE_QUERY_SIZE):
+                drawn -= set(self.filter(claim_code__in=chunk)
+                                 .values_list('claim_code', flat=True))
+                drawn -= set(ClaimCode.objects.filter(code__in=chunk)
+                                              .values_list('code', flat=True))
+            codes |= drawn
+        return list(codes)
+
+    def create_many(self, deferred_awards):
+        """Insert a list of unsaved deferred awards in bulk, sending claim
+        invitations just as DeferredAward.save() would."""
+        # bulk_create() skips save(), which fills in missing claim codes.
+        empty = [da for da in deferred_awards if not da.claim_code]
+        for da, code in zip(empty, self.claim_codes(len(empty))):
+            da.claim_code = code
+
+        # Avoid claim code collisions within the batch itself.
+        codes = set()
+        for da in deferred_awards:
+            while da.claim_code in codes:
+                da.claim_code = make_random_code()
+            codes.add(da.claim_code)
+
+        # Only the first deferred award for an email triggers an invitation.
+        emails = set(da.email for da in deferred_awards if da.email)
+        existing_emails = set()
+        for chunk in chunks(emails, badger.settings.AWARD_QUERY_SIZE):
+            existing_emails.update(self.filter(email__in=chunk)
+                                       .values_list('email', flat=True))
+
+        invites = []
+        for da in deferred_awards:
+            if da.email and da.email not in existing_emails:
+                existing_emails.add(da.email)
+                invites.append(da)
+
+        with transaction.atomic():
+            # bulk_create() skips the signal that adds emails to the claim
+            # filter, so add them first. See badger.claimfilter
+            claimfilter.add_emails(emails)
+            self.bulk_create(deferred_awards)
+            if invites and badger.settings.CLAIM_EMAIL_OUTBOX:
+                ClaimEmailTask.objects.enqueue(self._fetch_pks(invites))
+
+        if invites and not badger.settings.CLAIM_EMAIL_OUTBOX:
+            self.send_claim_emails(invites)
+
+        return deferred_awards
+
+    def _fetch_pks(self, deferred_awards):
+        """Set the primary keys of deferred awards inserted by bulk_create(),
+        looked up by claim code"""
+        by_code = dict((da.claim_code, da) for da in deferred_awards)
+        codes = by_code.keys()
+        for start in range(0, len(codes), CLAIM_CODE_QUERY_SIZE):
+            for pk, code in (self.filter(
+                    claim_code__in=codes[start:start + CLAIM_CODE_QUERY_SIZE])
+                    .values_list('pk', 'claim_code')):
+                by_code[code].pk = pk
+        return deferred_awards
+
+    def send_claim_emails(self, deferred_awards):
+        """Send claim emails for a list of deferred awards at once, over one
+        connection"""
+        current_site = Site.objects.get_current()
+        messages = [message for message in
+                    (da.build_claim_email(current_site)
+                     for da in deferred_awards)
+                    if message]
+        if messages:
+            get_connection().send_messages(messages)
+
     def claim_by_email(self, awardee):
         """Claim all deferred awards that match the awardee's email"""
         return self._claim_qs(awardee, self.filter(email=awardee.email))
@@ -998,6 +1979,89 @@ def make_random_code():
     return ''.join([random.choice(s) for x in range(CLAIM_CODE_LENGTH)])
 
 
+def make_claim_code():
+    """Take a claim code from the pool if it's enabled and not empty, or
+    make a random one"""
+    if badger.settings.CLAIM_CODE_POOL_DEPTH:
+        codes = ClaimCode.objects.pop(1)
+        if codes:
+            return codes[0]
+    return make_random_code()
+
+
+class ClaimCodeManager(models.Manager):
+
+    def depth(self):
+        """Number of codes in the pool waiting to be taken"""
+        return self.filter(taken=None).count()
+
+    def pop(self, count=1):
+        """Take up to count codes from the pool. Codes are taken with a
+        conditional UPDATE marking them with a token for this call, so
+        concurrent calls skip each other's codes rather than waiting on
+        them. Returns fewer codes only if the pool runs dry."""
+        codes = []
+        for attempt in range(CLAIM_CODE_MAX_RETRIES):
+            need = count - len(codes)
+            if need <= 0:
+                break
+            candidates = dict(self.filter(taken=None)
+                                  .values_list('pk', 'code')[:need])
+            if not candidates:
+                break
+            token = make_random_code() + make_random_code()
+            num_taken = (self.filter(pk__in=candidates.keys(), taken=None)
+                             .update(taken=token))
+            if num_taken == len(candidates):
+                codes.extend(candidates.values())
+            elif num_taken:
+                # Another call took some of them first.
+                codes.extend(self.filter(taken=token)
+                                 .values_list('code', flat=True))
+        return codes
+
+    def refill(self, depth, batch_size=None):
+        """Drop the codes taken from the pool, and top it up to depth unused
+        codes, inserted in batches. Returns a tuple of (codes taken since the
+        last refill, codes added)"""
+        batch_size = batch_size or badger.settings.CLAIM_CODE_BATCH_SIZE
+        taken = self.exclude(taken=None)
+        num_taken = taken.count()
+        taken.delete()
+
+        added, retries = 0, 0
+        need = depth - self.depth()
+        while need > 0:
+            codes = DeferredAward.objects.unused_claim_codes(
+                min(batch_size, need))
+            try:
+                with transaction.atomic():
+                    self.bulk_create([ClaimCode(code=code) for code in codes])
+            except IntegrityError:
+                # A code was used or pooled since it was checked.
+                retries += 1
+                if retries > CLAIM_CODE_MAX_RETRIES:
+                    raise
+                continue
+            added += len(codes)
+            need -= len(codes)
+        return (num_taken, added)
+
+
+class ClaimCode(models.Model):
+    """Claim code checked to be unused, waiting in the pool to be taken for
+    a deferred award. Filled by the refill_claim_codes command"""
+    objects = ClaimCodeManager()
+
+    code = models.CharField(max_length=32, unique=True)
+    taken = models.CharField(max_length=32, blank=True, null=True,
+                             db_index=True)
+    created = models.DateTimeField(auto_now_add=True, blank=False)
+
+    def __unicode__(self):
+        return self.code
+
+
 class DeferredAwardGrantNotAllowedException(BadgerException):
     """Attempt to grant a DeferredAward not allowed"""
 
@@ -1011,8 +2075,10 @@ class DeferredAward(models.Model):
     description = models.TextField(blank=True)
     reusable = models.BooleanField(default=False)
     email = models.EmailField(blank=True, null=True, db_index=True)
-    claim_code = models.CharField(max_length=32,
-            default=make_random_code, unique=True, db_index=True)
+    # Left empty until saved, so unsaved instances don't take codes from the
+    # pool. See save()
+    claim_code = models.CharField(max_length=32, default='', blank=True,
+            unique=True, db_index=True)
     claim_group = models.CharField(max_length=32, blank=True, null=True,
             db_index=True)
     creator = models.ForeignKey(User, blank=True, null=True)
@@ -1061,32 +2127,52 @@ class DeferredAward(models.Model):
     def save(self, **kwargs):
         """Save the DeferredAward, sending a claim email if it's new"""
         is_new = not self.pk
+        if not self.claim_code:
+            self.claim_code = make_claim_code()
         has_existing_deferreds = False
         if self.email:
             has_existing_deferreds = DeferredAward.objects.filter(
                 email=self.email).exists()
+        # If this is new and there's an email, send an invite to claim.
+        is_invite = is_new and self.email and not has_existing_deferreds
+        outbox = badger.settings.CLAIM_EMAIL_OUTBOX
+
+        with transaction.atomic():
+            super(DeferredAward, self).save(**kwargs)
+            if is_invite and outbox:
+                # Queued in the same transaction, so the invite is sent if
+                # and only if the deferred award is saved.
+                ClaimEmailTask.objects.enqueue([self])
+
+        if is_invite and not outbox:
+            self.send_claim_email()
+
+    def build_claim_email(self, current_site=None):
+        """Build the email inviting the recipient to claim this award, or
+        None if there are no templates for it"""
+        try:
+            context = Context(dict(
+                deferred_award=self,
+                badge=self.badge,
+                protocol=DEFAULT_HTTP_PROTOCOL,
+                current_site=current_site or Site.objects.get_current()
+            ))
+            tmpl_name = 'badger/deferred_award_%s.txt'
+            subject = render_to_string(tmpl_name % 'subject', {}, context)
+            # Email subjects can't contain newlines, so we strip it. It makes
+            # the template less fragile.
+            subject = subject.strip()
+            body = render_to_string(tmpl_name % 'body', {}, context)
+        except TemplateDoesNotExist:
+            return None
+        return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL,
+                            [self.email])
 
-        super(DeferredAward, self).save(**kwargs)
-
-        if is_new and self.email and not has_existing_deferreds:
-            try:
-                # If this is new and there's an email, send an invite to claim.
-                context = Context(dict(
-                    deferred_award=self,
-                    badge=self.badge,
-                    protocol=DEFAULT_HTTP_PROTOCOL,
-                    current_site=Site.objects.get_current()
-                ))
-                tmpl_name = 'badger/deferred_award_%s.txt'
-                subject = render_to_string(tmpl_name % 'subject', {}, context)
-                # Email subjects can't contain newlines, so we strip it. It makes
-                # the template less fragile.
-                subject = subject.strip()
-                body = render_to_string(tmpl_name % 'body', {}, context)
-                send_mail(subject, body, settings.DEFAULT_FROM_EMAIL,
-                          [self.email], fail_silently=False)
-            except TemplateDoesNotExist:
-                pass
+    def send_claim_email(self):
+        """Send an email inviting the recipient to claim this award"""
+        message = self.build_claim_email()
+        if message:
+            message.send(fail_silently=False)
 
     def claim(self, awardee):
         """Claim the deferred award for the given user"""
@@ -1109,7 +2195,7 @@ class DeferredAward(models.Model):
         if not self.reusable:
             # If not reusable, reassign email and regenerate claim code.
             self.email = email
-            self.claim_code = make_random_code()
+            self.claim_code = make_claim_code()
             self.save()
             return self
         else:
@@ -1120,6 +2206,98 @@ class DeferredAward(models.Model):
             return new_da
 
 
+class ClaimEmailTaskManager(models.Manager):
+
+    def enqueue(self, deferred_awards):
+        """Queue claim emails for a list of saved deferred awards"""
+        self.bulk_create([ClaimEmailTask(deferred_award_id=da.pk)
+                          for da in deferred_awards])
+
+    def flush(self, batch_size=100):
+        """Send a batch of the queued claim emails that are due, rendered
+        together and sent over one connection. Emails that fail are retried
+        later, backing off with each attempt. Safe to run in more than one
+        worker at once, since each batch is claimed with a conditional
+        UPDATE.
+
+        Returns a tuple of (emails claimed, emails sent)
+        """
+        now = timezone.now()
+        due = (Q(claimed__isnull=True) |
+               Q(claimed__lt=now - timedelta(seconds=CLAIM_EMAIL_CLAIM_TIMEOUT)))
+        pks = list(self.filter(due, next_attempt__lte=now).order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return (0, 0)
+        # Mark the batch with a token for this call, so workers claiming in
+        # the same instant can't read back each other's tasks.
+        token = make_random_code() + make_random_code()
+        self.filter(due, pk__in=pks).update(claimed=now, claim_token=token)
+        tasks = list(self.filter(claim_token=token)
+                         .select_related('deferred_award__badge'))
+        if not tasks:
+            return (0, 0)
+
+        current_site = Site.objects.get_current()
+        sent, failed = [], []
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception:
+            logging.exception('Failed to connect to send claim emails')
+            failed = tasks
+        else:
+            try:
+                for task in tasks:
+                    try:
+                        # Built here, so a render error or a deleted
+                        # deferred award only fails this task
+                        message = task.deferred_award.build_claim_email(
+                            current_site)
+                        if message:
+                            connection.send_messages([message])
+                        sent.append(task)
+                    except Exception:
+                        logging.exception('Failed to send claim email for '
+                                          'deferred award %s' %
+                                          task.deferred_award_id)
+                        failed.append(task)
+            finally:
+                connection.close()
+
+        self.filter(pk__in=[task.pk for task in sent]).delete()
+        for task in failed:
+            if task.attempts + 1 >= CLAIM_EMAIL_MAX_ATTEMPTS:
+                task.delete()
+                continue
+            delay = CLAIM_EMAIL_RETRY_DELAY * 2 ** task.attempts
+            (self.filter(pk=task.pk)
+                 .update(claimed=None, claim_token=None,
+                         attempts=F('attempts') + 1,
+                         next_attempt=now + timedelta(seconds=delay)))
+        return (len(tasks), len(sent))
+
+
+class ClaimEmailTask(models.Model):
+    """Queued email inviting someone to claim a deferred award, sent by the
+    flush_claim_emails command"""
+    objects = ClaimEmailTaskManager()
+
+    deferred_award = models.ForeignKey(DeferredAward)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    claimed = models.DateTimeField(blank=True, null=True, db_index=True)
+    claim_token = models.CharField(max_length=32, blank=True, null=True,
+                                   db_index=True)
+    created = models.DateTimeField(auto_now_add=True, blank=False)
+
+    class Meta:
+        ordering = ['created']
+
+    def __unicode__(self):
+        return u'Claim email for %s' % (self.deferred_award,)
+
+
 class NominationException(BadgerException):
     """Nomination model exception"""
 
@@ -1234,17 +2412,14 @@ class Nomination(models.Model):
         nomination_was_approved.send(sender=self.__class__,
                                      nomination=self)
         if notification:
+            notices = []
             if self.badge.creator:
-                notification.send([self.badge.creator], 'nomination_approved',
-                                  dict(nomination=self,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
+                notices.append(
+                    (self.badge.creator, 'nomination_approved', self))
             if self.creator:
-                notification.send([self.creator], 'nomination_approved',
-                                  dict(nomination=self,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
-            notification.send([self.nominee], 'nomination_received',
-                              dict(nomination=self,
-                                   protocol=DEFAULT_HTTP_PROTOCOL))
+                notices.append((self.creator, 'nomination_approved', self))
+            notices.append((self.nominee, 'nomination_received', self))
+            send_notices(notices)
 
         return self
 
@@ -1277,14 +2452,13 @@ class Nomination(models.Model):
                                      nomination=self)
 
         if notification:
+            notices = []
             if self.badge.creator:
-                notification.send([self.badge.creator], 'nomination_accepted',
-                                  dict(nomination=self,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
+                notices.append(
+                    (self.badge.creator, 'nomination_accepted', self))
             if self.creator:
-                notification.send([self.creator], 'nomination_accepted',
-                                  dict(nomination=self,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
+                notices.append((self.creator, 'nomination_accepted', self))
+            send_notices(notices)
 
         return self
 
@@ -1316,21 +2490,171 @@ class Nomination(models.Model):
                                      nomination=self)
 
         if notification:
+            notices = []
             if self.badge.creator:
-                notification.send([self.badge.creator], 'nomination_rejected',
-                                  dict(nomination=self,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
+                notices.append(
+                    (self.badge.creator, 'nomination_rejected', self))
             if self.creator:
-                notification.send([self.creator], 'nomination_rejected',
-                                  dict(nomination=self,
-                                       protocol=DEFAULT_HTTP_PROTOCOL))
+                notices.append((self.creator, 'nomination_rejected', self))
+            send_notices(notices)
 
         return self
 
 
+def send_notices(notices):
+    """Notify users of award and nomination events, given a list of
+    (recipient, notice type label, award or nomination) tuples. With
+    BADGER_NOTIFICATION_QUEUE, the notices are queued to be sent in digests
+    by the dispatch_notifications command, rather than sent now."""
+    if not notification or not notices:
+        return
+    if badger.settings.NOTIFICATION_QUEUE:
+        NotificationTask.objects.enqueue(notices)
+        return
+    for recipient, label, obj in notices:
+        notification.send([recipient], label, notice_context(obj))
+
+
+def notice_context(obj):
+    """Build the notification context for an award or nomination"""
+    if isinstance(obj, Award):
+        return dict(award=obj, protocol=DEFAULT_HTTP_PROTOCOL)
+    return dict(nomination=obj, protocol=DEFAULT_HTTP_PROTOCOL)
+
+
+class NotificationTaskManager(models.Manager):
+
+    def enqueue(self, notices):
+        """Queue a list of (recipient, notice type label, award or
+        nomination) tuples, with one query"""
+        tasks = []
+        for recipient, label, obj in notices:
+            task = NotificationTask(recipient=recipient, label=label)
+            if isinstance(obj, Award):
+                task.award = obj
+            else:
+                task.nomination = obj
+            tasks.append(task)
+        self.bulk_create(tasks)
+
+    def dispatch(self, window=None, batch_size=100):
+        """Send the queued notices of a batch of recipients whose digests are
+        due, having waited ``window`` seconds since their first notice. Each
+        recipient gets their notices in one digest, or just the notice if
+        there's only one. Notices that fail to send are retried later,
+        backing off with each attempt. Safe to run in more than one worker at
+        once, since each batch is claimed with a conditional UPDATE.
+
+        Returns a tuple of (notices claimed, notices sent)
+        """
+        if window is None:
+            window = badger.settings.NOTIFICATION_DIGEST_WINDOW
+        now = timezone.now()
+        stale = now - timedelta(seconds=NOTIFICATION_CLAIM_TIMEOUT)
+        due = ((Q(claimed__isnull=True) | Q(claimed__lt=stale)) &
+               Q(next_attempt__lte=now))
+        firsts = (self.filter(due).values('recipient')
+                      .annotate(first=Min('created'))
+                      .filter(first__lte=now - timedelta(seconds=window))
+                      .order_by('first'))
+        recipient_ids = [row['recipient'] for row in firsts[:batch_size]]
+        if not recipient_ids:
+            return (0, 0)
+        # Mark the batch with a token for this call, so workers claiming in
+        # the same instant can't read back each other's notices.
+        token = make_random_code() + make_random_code()
+        (self.filter(due, recipient__in=recipient_ids)
+             .update(claimed=now, claim_token=token))
+        tasks = list(self.filter(claim_token=token)
+                         .select_related('recipient', 'award__badge',
+                                         'award__user', 'nomination__badge',
+                                         'nomination__nominee')
+                         .order_by('created', 'pk'))
+
+        tasks_by_recipient = {}
+        for task in tasks:
+            tasks_by_recipient.setdefault(task.recipient_id, []).append(task)
+        sent, sent_count = [], 0
+        for recipient_id, recipient_tasks in tasks_by_recipient.items():
+            recipient = recipient_tasks[0].recipient
+            try:
+                if len(recipient_tasks) == 1:
+                    task = recipient_tasks[0]
+                    notification.send_now([recipient], task.label,
+                                          task.get_context())
+                else:
+                    notification.send_now([recipient], 'notification_digest',
+                                          dict(notices=recipient_tasks,
+                                               protocol=DEFAULT_HTTP_PROTOCOL))
+            except Exception:
+                logging.exception('Failed to send %s notices to user %s' %
+                                  (len(recipient_tasks), recipient_id))
+            else:
+                sent.append(recipient_id)
+                sent_count += len(recipient_tasks)
+
+        # Notices are picked out by recipient and token, rather than by ID,
+        # so large digests don't need a query parameter per notice. Those
+        # left once the sent ones are deleted failed to send.
+        self.filter(recipient__in=sent, claim_token=token).delete()
+        failed = self.filter(claim_token=token)
+        failed.filter(attempts__gte=NOTIFICATION_MAX_ATTEMPTS - 1).delete()
+        for attempts in set(failed.values_list('attempts', flat=True)):
+            delay = NOTIFICATION_RETRY_DELAY * 2 ** attempts
+            (failed.filter(attempts=attempts)
+                   .update(claimed=None, claim_token=None,
+                           attempts=F('attempts') + 1,
+                           next_attempt=now + timedelta(seconds=delay)))
+        return (len(tasks), sent_count)
+
+
+class NotificationTask(models.Model):
+    """Queued notice of an award or nomination, sent in a digest by the
+    dispatch_notifications command"""
+    objects = NotificationTaskManager()
+
+    recipient = models.ForeignKey(User, related_name='+')
+    label = models.CharField(max_length=40)
+    award = models.ForeignKey(Award, blank=True, null=True)
+    nomination = models.ForeignKey(Nomination, blank=True, null=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    claimed = models.DateTimeField(blank=True, null=True, db_index=True)
+    claim_token = models.CharField(max_length=32, blank=True, null=True,
+                                   db_index=True)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __unicode__(self):
+        return u'%s for %s' % (self.label, self.recipient)
+
+    def get_object(self):
+        """The award or nomination this notice is about"""
+        return self.award or self.nomination
+
+    def get_context(self):
+        return notice_context(self.get_object())
+
+
+def add_deferred_award_to_claim_filter(sender, instance, raw=False,
+                                       **kwargs):
+    """Add the email of a deferred award to the claim filter before it's
+    saved, so no login sees it saved but not in the filter.
+    See badger.claimfilter"""
+    if not raw and instance.email is not None:
+        claimfilter.add_emails([instance.email])
+
+
+signals.pre_save.connect(add_deferred_award_to_claim_filter,
+                         sender=DeferredAward)
+
+
 # HACK: Django 1.2 is missing receiver and user_logged_in
 if receiver and user_logged_in:
     @receiver(user_logged_in)
     def claim_on_login(sender, request, user, **kwargs):
         """When a user logs in, claim any deferred awards by email"""
-        DeferredAward.objects.claim_by_email(user)
+        if claimfilter.may_have_pending(user.email):
+            DeferredAward.objects.claim_by_email(user)
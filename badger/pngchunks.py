@@ -0,0 +1,146 @@
+"""Bake text metadata into PNG images by splicing chunks, rather than
+decoding and re-encoding the whole image.
+
+see: http://www.w3.org/TR/PNG/#5Chunk-layout
+see: https://github.com/mozilla/openbadges/blob/development/lib/baker.js
+"""
+import hashlib
+import struct
+import threading
+import zlib
+
+from django.conf import settings
+from django.utils.datastructures import SortedDict
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from PIL import Image, PngImagePlugin
+except ImportError:
+    import Image
+    import PngImagePlugin
+
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+TEXT_CHUNK_TYPES = ('tEXt', 'zTXt', 'iTXt')
+
+# Max number of source images kept parsed in memory by load_source()
+CHUNK_CACHE_SIZE = getattr(settings, 'BADGER_PNG_CHUNK_CACHE_SIZE', 100)
+
+_cache_lock = threading.Lock()
+_sources_by_hash = SortedDict()
+_hashes_by_name = SortedDict()
+
+
+def read_chunks(data):
+    """Parse PNG data into a list of (type, body) tuples. Raises ValueError
+    if the data isn't a well-formed PNG."""
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('Not a PNG image')
+    chunks = []
+    pos, end = len(PNG_SIGNATURE), len(data)
+    while pos < end:
+        if pos + 8 > end:
+            raise ValueError('Truncated PNG chunk header')
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        if len(body) != length or pos + 12 + length > end:
+            raise ValueError('Truncated PNG chunk %r' % chunk_type)
+        chunks.append((chunk_type, body))
+        pos += 12 + length
+        if chunk_type == 'IEND':
+            break
+    if not chunks or chunks[0][0] != 'IHDR' or chunks[-1][0] != 'IEND':
+        raise ValueError('PNG must start with IHDR and end with IEND')
+    return chunks
+
+
+def write_chunk(chunk_type, body):
+    """Serialize a chunk, with its length and CRC"""
+    crc = zlib.crc32(chunk_type + body) & 0xffffffff
+    return struct.pack('>I4s', len(body), chunk_type) + body + \
+        struct.pack('>I', crc)
+
+
+def text_chunk(keyword, text):
+    """Build a tEXt chunk, or an iTXt chunk if the text isn't latin-1"""
+    if isinstance(text, unicode):
+        try:
+            text = text.encode('latin-1')
+        except UnicodeError:
+            return write_chunk('iTXt', '%s\0\0\0\0\0%s' % (
+                keyword, text.encode('utf-8')))
+    return write_chunk('tEXt', '%s\0%s' % (keyword, text))
+
+
+def split_for_baking(data, keyword):
+    """Split PNG data into the bytes before and after the point where a text
+    chunk gets spliced in, dropping any existing text chunks for the
+    keyword."""
+    chunks = read_chunks(data)
+    head = PNG_SIGNATURE + write_chunk(*chunks[0])
+    tail = ''.join(
+        write_chunk(chunk_type, body)
+        for chunk_type, body in chunks[1:]
+        if not (chunk_type in TEXT_CHUNK_TYPES and
+                body.split('\0', 1)[0] == keyword))
+    return (head, tail)
+
+
+def load_source(name, read, keyword='openbadges'):
+    """Load a source image for baking, keyed by content hash.
+
+    ``name`` identifies where the image came from, such as its storage
+    name, so that repeated bakes from the same file skip the read.
+    ``read`` is a callable returning the image data.
+
+    Returns (content hash, data, split), where split is the (head, tail)
+    from split_for_baking(), or None if the image isn't a usable PNG.
+    """
+    with _cache_lock:
+        content_hash = _hashes_by_name.get(name, None)
+        if content_hash in _sources_by_hash:
+            return _sources_by_hash[content_hash]
+
+    data = read()
+    content_hash = hashlib.sha1(data).hexdigest()
+    try:
+        split = split_for_baking(data, keyword)
+    except ValueError:
+        split = None
+    source = (content_hash, data, split)
+
+    with _cache_lock:
+        _sources_by_hash[content_hash] = source
+        _hashes_by_name[name] = content_hash
+        for cache in (_sources_by_hash, _hashes_by_name):
+            while len(cache) > CHUNK_CACHE_SIZE:
+                # Drop the oldest entry
+                del cache[next(iter(cache))]
+
+    return source
+
+
+def bake(split, keyword, text):
+    """Bake text into an image split by split_for_baking()"""
+    head, tail = split
+    return head + text_chunk(keyword, text) + tail
+
+
+def bake_with_pil(data, keyword, text):
+    """Bake text into an image by decoding and re-encoding it with PIL. Works
+    for any image format PIL can read, but is much slower than bake().
+    Returns None if the image can't be read."""
+    try:
+        img = Image.open(StringIO(data))
+    except IOError:
+        return None
+    meta = PngImagePlugin.PngInfo()
+    meta.add_text(keyword, text)
+    new_img = StringIO()
+    img.save(new_img, "PNG", pnginfo=meta)
+    return new_img.getvalue()
@@ -0,0 +1,161 @@
+"""Write-behind buffer for high-frequency progress updates.
+
+Rather than a SELECT and an UPDATE per event, progress deltas are collected
+in memory per process, keyed by user & badge, and written in bulk with
+Progress.objects.update_many(). Enabled with BADGER_PROGRESS_BUFFER = True,
+see badger.utils.record_progress().
+
+Pending progress is flushed from a timer once it's max_age seconds old, and
+as the process exits. Changes that fail to be written are kept, to be retried
+with the next flush. Buffered progress is still lost if the process is
+killed, so this is meant for progress where an occasional lost event is
+acceptable.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.db import connection
+
+import badger
+from .models import Progress
+
+
+_progress_buffer = None
+_progress_buffer_lock = threading.Lock()
+
+
+def get_progress_buffer():
+    """Get the progress buffer for this process, creating it on first use"""
+    global _progress_buffer
+    with _progress_buffer_lock:
+        if _progress_buffer is None:
+            _progress_buffer = ProgressBuffer()
+            atexit.register(_progress_buffer.flush)
+        return _progress_buffer
+
+
+class ProgressBuffer(object):
+    """Accumulates progress changes in memory, flushing them in bulk once
+    max_size records are pending or max_age seconds have passed since the
+    first pending change. Changes that would auto-award a badge are flushed
+    at once, so awards aren't delayed."""
+
+    def __init__(self, max_size=None, max_age=None):
+        self.max_size = max_size or badger.settings.PROGRESS_BUFFER_SIZE
+        self.max_age = max_age or badger.settings.PROGRESS_BUFFER_MAX_AGE
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.last_flush = time.time()
+        self.timer = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.events = 0
+            self.events_flushed = 0
+            self.flushes = 0
+            self.rows_written = 0
+            self.flush_time = 0.0
+            self.max_flush_time = 0.0
+
+    def stats(self):
+        """Get a dict of counts and timings for the buffer. The coalescing
+        ratio is the number of events per row written."""
+        with self.lock:
+            return dict(
+                events=self.events,
+                pending=len(self.pending),
+                flushes=self.flushes,
+                rows_written=self.rows_written,
+                coalescing_ratio=(float(self.events_flushed) /
+                                  max(self.rows_written, 1)),
+                avg_flush_time=self.flush_time / max(self.flushes, 1),
+                max_flush_time=self.max_flush_time,
+            )
+
+    def add(self, user, badge, amount=0, percent=None):
+        """Buffer a change to the progress of a user toward a badge. The
+        amount is added to the counter, and the percent, if given, replaces
+        the current percent."""
+        key = (user.pk, badge.pk)
+        with self.lock:
+            self.events += 1
+            prev_amount, prev_percent, count = self.pending.get(
+                key, (0, None, 0))
+            if percent is None:
+                percent = prev_percent
+            self.pending[key] = (prev_amount + amount, percent, count + 1)
+            flush = ((percent is not None and percent >= 100) or
+                     len(self.pending) >= self.max_size or
+                     time.time() - self.last_flush >= self.max_age)
+            if not flush:
+                self._start_timer()
+        if flush:
+            try:
+                self.flush()
+            except Exception:
+                # The change is still pending, to be retried.
+                logging.exception('Failed to flush buffered progress')
+
+    def _start_timer(self):
+        """Start a timer to flush pending changes after max_age seconds, if
+        one isn't already running. Call with the lock held."""
+        if self.timer is None:
+            self.timer = threading.Timer(self.max_age, self._flush_on_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _flush_on_timer(self):
+        with self.lock:
+            self.timer = None
+        try:
+            self.flush()
+        except Exception:
+            logging.exception('Failed to flush buffered progress')
+        finally:
+            # The timer thread gets its own DB connection, don't leak it.
+            connection.close()
+
+    def flush(self):
+        """Write all the pending progress changes. If the write fails, the
+        changes are kept pending and the error is raised."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.time()
+        if not pending:
+            return {}
+
+        start = time.time()
+        try:
+            counters = Progress.objects.update_many([
+                (user_id, badge_id, amount, percent)
+                for (user_id, badge_id), (amount, percent, count)
+                in pending.items()])
+        except Exception:
+            self._restore(pending)
+            raise
+        elapsed = time.time() - start
+
+        with self.lock:
+            self.flushes += 1
+            self.events_flushed += sum(
+                count for amount, percent, count in pending.values())
+            self.rows_written += len(pending)
+            self.flush_time += elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+        return counters
+
+    def _restore(self, pending):
+        """Merge changes that failed to be written back into the pending
+        changes, under any made since"""
+        with self.lock:
+            for key, (amount, percent, count) in pending.items():
+                new_amount, new_percent, new_count = self.pending.get(
+                    key, (0, None, 0))
+                if new_percent is None:
+                    new_percent = percent
+                self.pending[key] = (amount + new_amount, new_percent,
+                                     count + new_count)
+            self._start_timer()
@@ -0,0 +1,108 @@
+"""Tokenizing and ranking for the badge search index.
+
+Text is split into lowercase, accent-stripped words, each reduced to a
+rough stem, so that "Badges" and "badge" match. Matches are ranked with
+Okapi BM25.
+
+see: http://en.wikipedia.org/wiki/Okapi_BM25
+"""
+import math
+import re
+import unicodedata
+
+from django.conf import settings
+
+
+# Relative weight of a term found in each indexed field
+SEARCH_FIELD_WEIGHTS = getattr(settings, 'BADGER_SEARCH_FIELD_WEIGHTS', (
+    ('title', 3),
+    ('slug', 2),
+    ('description', 1),
+))
+
+# BM25 tuning: k1 controls term frequency saturation, b controls how much
+# scores are normalized by document length.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Positions skipped between fields, so phrases don't match across them.
+FIELD_POSITION_GAP = 100
+
+MAX_TERM_LENGTH = 64
+
+SUFFIXES = (
+    ('ies', 'y'),
+    ('ing', ''),
+    ('ed', ''),
+    ('es', ''),
+    ('s', ''),
+)
+
+_words = re.compile(r'\w+', re.UNICODE).findall
+
+
+def stem(word):
+    """Strip a common English suffix from a word, leaving at least three
+    characters. Crude, but consistent between indexing and searching."""
+    if word.endswith('ss'):
+        return word
+    for suffix, replacement in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)] + replacement
+    return word
+
+
+def normalize(text):
+    """Lowercase text and strip accents"""
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    return u''.join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    """Split text into a list of normalized, stemmed terms"""
+    return [stem(word)[:MAX_TERM_LENGTH] for word in _words(normalize(text))]
+
+
+def index_terms(fields):
+    """Build index entries from a dict of field name to text.
+
+    Returns a tuple of (length, entries), where length is the weighted
+    number of terms and entries maps each term to a tuple of (weighted term
+    frequency, list of positions).
+    """
+    entries, length, offset = {}, 0, 0
+    for name, weight in SEARCH_FIELD_WEIGHTS:
+        terms = tokenize(fields.get(name, None) or '')
+        for position, term in enumerate(terms):
+            tf, positions = entries.get(term, (0, []))
+            positions.append(offset + position)
+            entries[term] = (tf + weight, positions)
+        length += weight * len(terms)
+        offset += len(terms) + FIELD_POSITION_GAP
+    return (length, entries)
+
+
+def parse_query(phrases):
+    """Turn the phrases of a query, as from _normalize_query(), into a list
+    of term lists. Each phrase may hold more than one term."""
+    return [terms for terms in (tokenize(phrase) for phrase in phrases)
+            if terms]
+
+
+def has_phrase(positions, terms):
+    """Do the terms appear in sequence, given a dict of term to positions?"""
+    starts = set(positions[terms[0]])
+    for offset, term in enumerate(terms[1:], start=1):
+        starts &= set(p - offset for p in positions[term])
+        if not starts:
+            return False
+    return True
+
+
+def bm25(tf, df, length, num_docs, avg_length):
+    """Score one term in one document"""
+    idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+    norm = 1 - BM25_B + BM25_B * length / max(avg_length, 1)
+    return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
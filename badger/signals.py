@@ -52,6 +52,17 @@ badge_was_awarded = _signal_with_docs(
 
     """)
 
+badges_were_awarded = _signal_with_docs(
+    ['awards'],
+    """Fires off once after one or more badges are awarded together, as
+    by :py:meth:`badger.models.Badge.award_to_many`
+
+    Signal receiver parameters:
+
+    :arg awards: a list of the new Award instances
+
+    """)
+
 user_will_be_nominated = _signal_with_docs(
     ['nomination'],
     """Fires off before user is nominated for a badge
@@ -3,10 +3,13 @@ import logging
 from contextlib import contextmanager
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections
 from django.db.models import loading
 from django.contrib.auth.models import User
 from django import test
+from django.test.utils import CaptureQueriesContext
 from django.utils.translation import get_language
 
 try:
@@ -51,6 +54,7 @@ class BadgerTestCase(test.TestCase):
 
     def _pre_setup(self):
         loading.cache.loaded = False
+        cache.clear()
         call_command('update_badges', verbosity=0)
         badger.autodiscover()
 
@@ -84,6 +88,19 @@ class BadgerTestCase(test.TestCase):
             # If we're in funfactoryland, back out of the locale tweaks
             set_url_prefix(self.old_prefix)
 
+    @contextmanager
+    def assertMaxQueries(self, num, using=DEFAULT_DB_ALIAS, msg=None):
+        """Assert that a block of code issues no more than num queries"""
+        with CaptureQueriesContext(connections[using]) as context:
+            yield context
+        executed = len(context)
+        if executed > num:
+            queries = '\n'.join('%s. %s' % (i, query['sql'])
+                                 for i, query in enumerate(
+                                     context.captured_queries, start=1))
+            self.fail('%s%s queries executed, no more than %s expected:\n%s' %
+                      (msg and '%s: ' % msg or '', executed, num, queries))
+
     def _get_user(self, username="tester", email="tester@example.com",
             password="trustno1", is_staff=False, is_superuser=False):
         (user, created) = User.objects.get_or_create(username=username,
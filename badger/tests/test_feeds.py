@@ -1,4 +1,6 @@
 import logging
+import json
+from datetime import timedelta
 import feedparser
 
 from django.conf import settings
@@ -11,6 +13,8 @@ from pyquery import PyQuery as pq
 from nose.tools import assert_equal, with_setup, assert_false, eq_, ok_
 from nose.plugins.attrib import attr
 
+from mock import patch
+
 from django.template.defaultfilters import slugify
 
 from django.contrib.auth.models import User
@@ -20,11 +24,12 @@ try:
 except ImportError:
     from django.core.urlresolvers import reverse
 
-from . import BadgerTestCase
+from . import BadgerTestCase, patch_settings
 
 from badger.models import (Badge, Award, Progress,
         BadgeAwardNotAllowedException)
 from badger.utils import get_badge, award_badge
+from badger.feeds import MAX_FEED_ITEMS, AwardsFeed
 
 
 class BadgerFeedsTest(BadgerTestCase):
@@ -72,6 +77,245 @@ class BadgerFeedsTest(BadgerTestCase):
 
             ok_(found_it)
 
+    def test_feed_query_budgets(self):
+        """Feeds issue a fixed number of queries, however many items"""
+        user = self._get_user()
+        badge = Badge.objects.create(creator=user, title="Budget Badge")
+        for i in range(10):
+            awardee = self._get_user(username='budget_%s' % i,
+                                     email='budget_%s@example.com' % i)
+            badge.award_to(awardee, awarder=user)
+            Badge.objects.create(creator=user, title="Budget Badge %s" % i)
+
+        # (url name, args, max queries)
+        budgets = (
+            ('badger.feeds.awards_recent', (), 2),
+            ('badger.feeds.awards_by_badge', (badge.slug,), 3),
+            ('badger.feeds.awards_by_user', ('budget_0',), 3),
+            ('badger.feeds.badges_recent', (), 2),
+            ('badger.feeds.badges_by_user', (user.username,), 3),
+        )
+        for name, args, budget in budgets:
+            for format in ('json', 'rss', 'atom'):
+                url = reverse(name, args=(format,) + args)
+                with self.assertMaxQueries(budget, msg=url):
+                    r = self.client.get(url)
+                    self._get_content(r)
+                eq_(200, r.status_code)
+
+    def test_feed_cursors(self):
+        """JSON feeds link to their next page with an ?after= cursor"""
+        user = self._get_user()
+        titles = set("Cursor Badge %s" % i for i in range(40))
+        for title in titles:
+            Badge.objects.create(creator=user, title=title)
+
+        seen = []
+        url = reverse('badger.feeds.badges_recent', args=('json',))
+        while url:
+            r = self.client.get(url)
+            eq_(200, r.status_code)
+            data = json.loads(self._get_content(r))
+            seen.extend(item['title'] for item in data['items'])
+            url = data.get('next', None)
+        eq_(len(titles), len(seen))
+        eq_(titles, set(seen))
+
+        url = reverse('badger.feeds.badges_recent', args=('json',))
+        r = self.client.get(url, dict(after='bogus'))
+        eq_(404, r.status_code)
+
+    def test_feed_since(self):
+        """JSON feeds link to the items added since their newest, for
+        polling"""
+        user = self._get_user()
+        badge = Badge.objects.create(creator=user, title="Since Badge")
+
+        def award(start, end):
+            for i in range(start, end):
+                badge.award_to(self._get_user(username='since_%s' % i,
+                                              email='since_%s@example.com' % i))
+
+        def get_feed(url):
+            r = self.client.get(url)
+            eq_(200, r.status_code)
+            data = json.loads(self._get_content(r))
+            return ([item['title'].split()[-1] for item in data['items']],
+                    data.get('since', None))
+
+        award(0, 3)
+        for name, args in (('badger.feeds.awards_recent', ()),
+                           ('badger.feeds.awards_by_badge', (badge.slug,))):
+            url = reverse(name, args=('json',) + args)
+            names, since_url = get_feed(url)
+            eq_(['since_2', 'since_1', 'since_0'], names)
+
+            # Nothing new yet, so the next poll is the same
+            names, next_url = get_feed(since_url)
+            eq_([], names)
+            eq_(since_url, next_url)
+
+        # New awards come in batches of MAX_FEED_ITEMS, oldest first
+        award(3, 5 + MAX_FEED_ITEMS)
+        names, since_url = get_feed(since_url)
+        eq_(['since_%s' % i for i in reversed(range(3, 3 + MAX_FEED_ITEMS))],
+            names)
+        names, since_url = get_feed(since_url)
+        eq_(['since_%s' % (4 + MAX_FEED_ITEMS), 'since_%s' % (3 + MAX_FEED_ITEMS)],
+            names)
+        names, since_url = get_feed(since_url)
+        eq_([], names)
+
+        r = self.client.get(url, dict(since='bogus'))
+        eq_(404, r.status_code)
+
+    def test_feed_conditional_get(self):
+        """Feeds answer conditional GETs with 304 until their items change"""
+        user = self._get_user()
+        badge = Badge.objects.create(creator=user, title="Conditional Badge")
+        badge.award_to(self._get_user(username='conditional_1',
+                                      email='conditional_1@example.com'))
+
+        url = reverse('badger.feeds.awards_recent', args=('json',))
+        r = self.client.get(url)
+        eq_(200, r.status_code)
+        ok_('max-age=' in r['Cache-Control'])
+        etag, last_modified = r['ETag'], r['Last-Modified']
+
+        with self.assertNumQueries(1):
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        eq_(304, r.status_code)
+        r = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        eq_(304, r.status_code)
+
+        # Other formats and parameters get their own ETags
+        r = self.client.get(url, dict(callback='cb'),
+                            HTTP_IF_NONE_MATCH=etag)
+        eq_(200, r.status_code)
+
+        award = badge.award_to(self._get_user(
+            username='conditional_2', email='conditional_2@example.com'))
+        latest = award.modified + timedelta(seconds=5)
+        Award.objects.filter(pk=award.pk).update(modified=latest)
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        eq_(200, r.status_code)
+        ok_(r['ETag'] != etag)
+
+        # Deleting an item, or adding one in the same second as the latest
+        # change, leaves the last modified time alone, but not the ETag.
+        etag = r['ETag']
+        Award.objects.filter(badge=badge).exclude(pk=award.pk).delete()
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        eq_(200, r.status_code)
+        ok_(r['ETag'] != etag)
+
+        etag = r['ETag']
+        award = badge.award_to(self._get_user(
+            username='conditional_3', email='conditional_3@example.com'))
+        Award.objects.filter(pk=award.pk).update(modified=latest)
+        r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        eq_(200, r.status_code)
+        ok_(r['ETag'] != etag)
+
+    def test_json_feed_streaming(self):
+        """JSON feeds are streamed, with items fetched in chunks"""
+        user = self._get_user()
+        badge = Badge.objects.create(creator=user, title="Streaming Badge")
+        for i in range(12):
+            badge.award_to(self._get_user(username='streaming_%s' % i,
+                                          email='streaming_%s@example.com' % i))
+
+        url = reverse('badger.feeds.awards_by_badge', args=('json', badge.slug))
+        with patch_settings(BADGER_FEED_CHUNK_SIZE=5):
+            r = self.client.get(url)
+            ok_(r.streaming)
+            eq_('application/json', r['Content-Type'])
+            # Items are only fetched as the response is read: 3 chunks, the
+            # last fetching one extra item to see if there's a next page.
+            with self.assertNumQueries(3):
+                data = json.loads(self._get_content(r))
+        eq_(12, len(data['items']))
+        eq_(u'Recent awards of "Streaming Badge"', data['title'])
+        ok_('next' not in data)
+
+        # JSONP callbacks still wrap the feed
+        r = self.client.get(url, dict(callback='cb'))
+        content = self._get_content(r)
+        ok_(content.startswith('cb({') and content.endswith('})'))
+        eq_(data['items'], json.loads(content[3:-1])['items'])
+
+        with patch_settings(BADGER_FEED_CHUNK_SIZE=5):
+            for i in range(12, 20):
+                badge.award_to(self._get_user(
+                    username='streaming_%s' % i,
+                    email='streaming_%s@example.com' % i))
+            r = self.client.get(url)
+            data = json.loads(self._get_content(r))
+            eq_(MAX_FEED_ITEMS, len(data['items']))
+            r = self.client.get(data['next'])
+            data = json.loads(self._get_content(r))
+            eq_(20 - MAX_FEED_ITEMS, len(data['items']))
+            ok_('next' not in data)
+
+    def test_json_feed_streaming_overlap(self):
+        """Streaming feeds read while others are under way get their own
+        items"""
+        user = self._get_user()
+        badges = [Badge.objects.create(creator=user,
+                                       title="Overlapping Badge %s" % i)
+                  for i in range(2)]
+        for i, badge in enumerate(badges):
+            badge.award_to(self._get_user(username='overlap_%s' % i,
+                                          email='overlap_%s@example.com' % i))
+
+        responses = [self.client.get(reverse('badger.feeds.awards_by_badge',
+                                             args=('json', badge.slug)))
+                     for badge in badges]
+        for i, (badge, r) in enumerate(zip(badges, responses)):
+            data = json.loads(self._get_content(r))
+            eq_(u'Recent awards of "%s"' % badge.title, data['title'])
+            eq_([u'%s awarded to overlap_%s' % (badge.title, i)],
+                [item['title'] for item in data['items']])
+
+    def test_feed_item_fragment_cache(self):
+        """Feed items are rendered once, for all formats, until they or
+        their users change"""
+        user = self._get_user()
+        awardee = self._get_user(username='fragment_1',
+                                 email='fragment_1@example.com')
+        badge = Badge.objects.create(creator=user, title="Fragment Badge")
+        badge.award_to(awardee, awarder=user)
+
+        url = reverse('badger.feeds.awards_recent', args=('json',))
+        data = json.loads(self._get_content(self.client.get(url)))
+        eq_(u'Fragment Badge awarded to fragment_1', data['items'][0]['title'])
+
+        with patch.object(AwardsFeed, 'render_item_title') as render:
+            for format in ('json', 'rss', 'atom'):
+                url = reverse('badger.feeds.awards_recent', args=(format,))
+                r = self.client.get(url)
+                self._get_content(r)
+                eq_(200, r.status_code)
+            eq_(0, render.call_count)
+
+        # Renaming the awardee or the badge renders the item again
+        awardee.username = 'fragment_2'
+        awardee.save()
+        url = reverse('badger.feeds.awards_recent', args=('json',))
+        data = json.loads(self._get_content(self.client.get(url)))
+        eq_(u'Fragment Badge awarded to fragment_2', data['items'][0]['title'])
+
+        badge.title = 'Renamed Fragment Badge'
+        badge.save()
+        data = json.loads(self._get_content(self.client.get(url)))
+        eq_(u'Renamed Fragment Badge awarded to fragment_2',
+            data['items'][0]['title'])
+
+    def _get_content(self, r):
+        if r.streaming:
+            return ''.join(r.streaming_content)
+        return r.content
+
     def _get_user(self, username="tester", email="tester@example.com",
             password="trustno1"):
         (user, created) = User.objects.get_or_create(username=username,
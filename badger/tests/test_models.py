@@ -1,28 +1,49 @@
 # -*- coding: utf-8 -*-
 from os.path import dirname
+import asyncore
 import logging
+import smtpd
+import os
+import tempfile
+import threading
 import time
+from datetime import datetime
 
 try:
     from PIL import Image
 except ImportError:
     import Image
 
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
 from django.conf import settings
 
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.models import loading
 from django.core.files.base import ContentFile
 from django.http import HttpRequest
+from django.db import connection, connections, transaction, DatabaseError
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 import json
 from django.test.client import Client
 
 from django.core import mail
+from django.contrib.sites.models import Site
 
-from nose.tools import assert_equal, with_setup, assert_false, eq_, ok_
+from nose.tools import (assert_equal, with_setup, assert_false, eq_, ok_,
+                        assert_raises)
 from nose.plugins.attrib import attr
 from nose import SkipTest
 
+from mock import patch
+
+from django.core.cache import cache
+
 if "notification" in settings.INSTALLED_APPS:
     from notification import models as notification
 else:
@@ -34,11 +55,21 @@ except ImportError:
     from django.core.urlresolvers import reverse
 
 from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_in
+from taggit.models import Tag
 
 from . import BadgerTestCase, patch_settings
 
 import badger
+from badger import autocomplete, claimfilter, pngchunks
+from badger.baking import ThreadBakeQueue, bake_award, BAKE_THREAD_RETRIES
+from badger.progress import ProgressBuffer
+from badger.pagination import encode_cursor, paginate_after
+from badger.utils import record_progress
 from badger.models import (Badge, Award, Nomination, Progress, DeferredAward,
+        AwardBakeTask, ClaimCode, ClaimEmailTask, NotificationTask,
+        BadgeSearchIndex, BadgeTagCount,
+        get_prerequisite_graph, AWARDED_BADGE_IDS_CACHE_KEY,
         BadgeAwardNotAllowedException,
         BadgeAlreadyAwardedException,
         DeferredAwardGrantNotAllowedException,
@@ -112,9 +143,670 @@ class BadgerBadgeTest(BadgerTestCase):
 
         eq_(1, Award.objects.filter(badge=b, user=user).count())
 
+    def test_award_to_many(self):
+        """Can award a badge to a list of emails in bulk"""
+        badge = self._get_badge()
+        awardee_1 = self._get_user(username='awardee_1',
+                                   email='awardee_1@example.com')
+        awardee_2 = self._get_user(username='awardee_2',
+                                   email='awardee_2@example.com')
+        invitee_email = 'invitee@example.com'
+        deferred_email = 'deferred@example.com'
+
+        badge.award_to(awardee=awardee_2)
+        badge.award_to(email=deferred_email)
+
+        results = badge.award_to_many([
+            awardee_1.email, awardee_2.email, invitee_email, deferred_email,
+            awardee_1.email,
+        ], description='Bulk award')
+
+        eq_(dict([
+            (awardee_1.email, 'AWARDED'),
+            (awardee_2.email, 'ALREADYAWARDED'),
+            (invitee_email, 'INVITED'),
+            (deferred_email, 'ALREADYAWARDED'),
+        ]), results)
+
+        award = Award.objects.get(badge=badge, user=awardee_1)
+        eq_('Bulk award', award.description)
+        eq_(badge.creator, award.creator)
+        eq_(1, Award.objects.filter(badge=badge, user=awardee_2).count())
+        eq_(1, DeferredAward.objects.filter(badge=badge,
+                                            email=invitee_email).count())
+        eq_(1, DeferredAward.objects.filter(badge=badge,
+                                            email=deferred_email).count())
+
+    def test_award_to_many_repeats(self):
+        """Repeated emails are awarded again, unless the badge is unique"""
+        awardee = self._get_user(username='repeat', email='repeat@example.com')
+        invitee_email = 'repeat_invitee@example.com'
+        emails = [awardee.email, invitee_email, awardee.email, invitee_email]
+
+        unique = self._get_badge(title='Unique repeats')
+        eq_(dict([(awardee.email, 'AWARDED'), (invitee_email, 'INVITED')]),
+            unique.award_to_many(emails))
+        eq_(1, Award.objects.filter(badge=unique).count())
+        eq_(1, DeferredAward.objects.filter(badge=unique).count())
+
+        badge = self._get_badge(title='Repeats', unique=False)
+        eq_(dict([(awardee.email, 'AWARDED'), (invitee_email, 'INVITED')]),
+            badge.award_to_many(emails))
+        eq_(2, Award.objects.filter(badge=badge, user=awardee).count())
+        eq_(2, DeferredAward.objects.filter(badge=badge).count())
+        eq_(2, Badge.objects.get(pk=badge.pk).award_count)
+
+    def test_award_to_many_atomic(self):
+        """Nothing is awarded if award_to_many fails part way"""
+        badge = self._get_badge()
+        awardee = self._get_user(username='atomic', email='atomic@example.com')
+        with patch.object(DeferredAward.objects, 'create_many',
+                          side_effect=ValueError('Failed')):
+            assert_raises(ValueError, badge.award_to_many,
+                          [awardee.email, 'atomic_invitee@example.com'])
+        eq_(0, Award.objects.filter(badge=badge).count())
+        eq_(0, DeferredAward.objects.filter(badge=badge).count())
+
+    def test_award_to_many_chunks(self):
+        """Bulk awards look up emails in chunks, and queue their notices"""
+        badge = self._get_badge(title='Chunked')
+        users = [self._get_user(username='chunk_%s' % i,
+                                email='chunk_%s@example.com' % i)
+                 for i in range(5)]
+        invite_emails = ['chunk_invite_%s@example.com' % i for i in range(5)]
+        badge.award_to(awardee=users[0])
+        badge.award_to(email=invite_emails[0])
+
+        with patch_settings(BADGER_AWARD_QUERY_SIZE=2):
+            results = badge.award_to_many(
+                [user.email for user in users] + invite_emails)
+
+        eq_('ALREADYAWARDED', results[users[0].email])
+        eq_('ALREADYAWARDED', results[invite_emails[0]])
+        eq_(['AWARDED'] * 4, [results[user.email] for user in users[1:]])
+        eq_(['INVITED'] * 4, [results[email] for email in invite_emails[1:]])
+        eq_(5, Award.objects.filter(badge=badge).count())
+        eq_(5, DeferredAward.objects.filter(badge=badge).count())
+        if notification:
+            eq_(set(users[1:]), set(task.award.user for task in
+                                    NotificationTask.objects.filter(
+                                        label='award_received')))
+
+    def test_award_to_many_prerequisites(self):
+        """Bulk awards trigger auto-awards of dependent badges"""
+        user = self._get_user()
+        b1 = self._get_badge(title="Prereq A")
+        b2 = self._get_badge(title="Prereq B")
+        meta = self._get_badge(title="Meta Badge")
+        meta.prerequisites.add(b1, b2)
+
+        b1.award_to(awardee=user)
+        ok_(not meta.is_awarded_to(user))
+
+        b2.award_to_many([user.email])
+        ok_(meta.is_awarded_to(user))
+
+    def test_award_count(self):
+        """Badges keep a count of their awards"""
+        badge = self._get_badge(unique=False)
+        user = self._get_user()
+        eq_(0, badge.award_count)
+
+        award = badge.award_to(awardee=user)
+        badge.award_to(awardee=user)
+        badge.award_to_many([user.email, self._get_user(
+            username='other', email='other@example.com').email])
+        eq_(4, Badge.objects.get(pk=badge.pk).award_count)
+
+        # Saving a stale instance doesn't overwrite the count.
+        badge.description = 'Changed'
+        badge.save()
+        eq_(4, Badge.objects.get(pk=badge.pk).award_count)
+
+        award.delete()
+        eq_(3, Badge.objects.get(pk=badge.pk).award_count)
+
+    def test_recount_awards_command(self):
+        """recount_awards repairs award counts that have drifted"""
+        badge_1 = self._get_badge(title="Recount 1")
+        badge_2 = self._get_badge(title="Recount 2")
+        badge_1.award_to(awardee=self._get_user())
+        Badge.objects.filter(pk=badge_1.pk).update(award_count=5)
+        Badge.objects.filter(pk=badge_2.pk).update(award_count=2)
+
+        call_command('recount_awards', dry_run=True, stdout=StringIO())
+        eq_(5, Badge.objects.get(pk=badge_1.pk).award_count)
+
+        call_command('recount_awards', stdout=StringIO())
+        eq_(1, Badge.objects.get(pk=badge_1.pk).award_count)
+        eq_(0, Badge.objects.get(pk=badge_2.pk).award_count)
+
+    def test_awarded_badge_ids_cache(self):
+        """Award state is cached per user and invalidated on changes"""
+        badge = self._get_badge()
+        user = self._get_user()
+
+        ok_(not badge.is_awarded_to(user))
+        with self.assertNumQueries(0):
+            ok_(not badge.is_awarded_to(user))
+
+        award = badge.award_to(awardee=user)
+        ok_(badge.is_awarded_to(user))
+        with self.assertNumQueries(0):
+            ok_(badge.is_awarded_to(user))
+
+        award.delete()
+        ok_(not badge.is_awarded_to(user))
+
+        # A set loaded before a change, but cached after it, isn't used.
+        stale = cache.get(AWARDED_BADGE_IDS_CACHE_KEY % user.pk)
+        badge.award_to(awardee=user)
+        cache.set(AWARDED_BADGE_IDS_CACHE_KEY % user.pk, stale)
+        ok_(badge.is_awarded_to(user))
+
+    def test_award_without_cache(self):
+        """Awarding doesn't fail when the cache can't store version stamps"""
+        badge = self._get_badge()
+        user = self._get_user()
+        with patch('badger.models.cache.incr',
+                   side_effect=ValueError('Key not found')):
+            award = badge.award_to(awardee=user)
+            eq_(1, Award.objects.filter(badge=badge, user=user).count())
+            award.delete()
+        eq_(0, Award.objects.filter(badge=badge, user=user).count())
+
+    def test_award_with_dependents_query_count(self):
+        """Awarding a badge with dependents doesn't count awards per
+        prerequisite"""
+        user = self._get_user()
+        prereqs = [self._get_badge(title="Prereq %s" % i) for i in range(4)]
+        for prereq in prereqs[1:]:
+            prereq.award_to(awardee=user)
+
+        dependents = []
+        for i in range(5):
+            dependent = self._get_badge(title="Dependent %s" % i)
+            dependent.prerequisites.add(*prereqs)
+            dependents.append(dependent)
+
+        with CaptureQueriesContext(connection) as ctx:
+            prereqs[0].award_to(awardee=user)
+        award_counts = [q for q in ctx.captured_queries
+                        if 'COUNT(' in q['sql'] and
+                           'badger_award' in q['sql']]
+        eq_(0, len(award_counts))
+
+        for dependent in dependents:
+            ok_(dependent.is_awarded_to(user))
+
+    def test_prerequisite_cascade(self):
+        """Auto-awards cascade through badges satisfied by other auto-awards,
+        and follow changes to prerequisites"""
+        user = self._get_user()
+        root = self._get_badge(title="Root")
+        left = self._get_badge(title="Left")
+        right = self._get_badge(title="Right")
+        top = self._get_badge(title="Top")
+        other = self._get_badge(title="Other")
+        left.prerequisites.add(root)
+        right.prerequisites.add(root)
+        top.prerequisites.add(left, right)
+
+        # Cache the graph, then change it.
+        other.award_to(awardee=user)
+        right.prerequisites.add(other)
+
+        root.award_to(awardee=user)
+        for badge in (root, left, right, top):
+            eq_(1, Award.objects.filter(badge=badge, user=user).count())
+
+    @attr('benchmark')
+    def test_prerequisite_chain_query_count(self):
+        """Awarding the root of a long prerequisite chain loads the graph
+        once and awards the whole chain without recursing"""
+        user = self._get_user()
+        chain = [self._get_badge(title="Chain %s" % i) for i in range(200)]
+        for prev, badge in zip(chain, chain[1:]):
+            badge.prerequisites.add(prev)
+
+        start = time.time()
+        with CaptureQueriesContext(connection) as ctx:
+            chain[0].award_to(awardee=user)
+        elapsed = time.time() - start
+
+        eq_(200, Award.objects.filter(user=user).count())
+        graph_queries = [q for q in ctx.captured_queries
+                         if 'badger_badge_prerequisites' in q['sql']]
+        eq_(1, len(graph_queries))
+        logging.debug("Awarded 200 chained badges in %0.3fs with %s queries" %
+                      (elapsed, len(ctx.captured_queries)))
+
+    def test_award_to_many_query_count(self):
+        """Queries issued by award_to_many stay flat as the list grows"""
+        badge = self._get_badge()
+        # The prerequisite graph and current site are loaded once and cached,
+        # so don't count them
+        get_prerequisite_graph()
+        Site.objects.get_current()
+
+        def count_queries(prefix, num):
+            for i in range(num):
+                self._get_user(username='%s_user_%s' % (prefix, i),
+                               email='%s_user_%s@example.com' % (prefix, i))
+            emails = (['%s_user_%s@example.com' % (prefix, i)
+                       for i in range(num)] +
+                      ['%s_invite_%s@example.com' % (prefix, i)
+                       for i in range(num)])
+            with CaptureQueriesContext(connection) as ctx:
+                results = badge.award_to_many(emails)
+            eq_(num * 2, len(results))
+            return len(ctx.captured_queries)
+
+        eq_(count_queries('few', 5), count_queries('many', 100))
+
+    def test_notification_digests(self):
+        """Queued notices are sent in one digest per recipient"""
+        creator = self._get_user(username='digest_creator',
+                                 email='digest_creator@example.com')
+        badge = self._get_badge(title='Digest', creator=creator)
+        users = [self._get_user(username='digest_%s' % i,
+                                email='digest_%s@example.com' % i)
+                 for i in range(5)]
+
+        with patch('badger.models.notification') as notification:
+            with patch_settings(BADGER_NOTIFICATION_QUEUE=True):
+                badge.award_to_many([user.email for user in users],
+                                    awarder=creator)
+            eq_(0, notification.send.call_count)
+            eq_(10, NotificationTask.objects.count())
+
+            # Nothing is sent until the digest window has passed.
+            eq_((0, 0), NotificationTask.objects.dispatch())
+            call_command('dispatch_notifications', once=True, window=0,
+                         verbosity=0)
+            eq_(0, NotificationTask.objects.count())
+
+            sends = dict((args[0][0], args[1:])
+                         for args, kwargs
+                         in notification.send_now.call_args_list)
+            eq_(6, len(sends))
+            label, context = sends[creator]
+            eq_('notification_digest', label)
+            eq_(set(['badge_awarded']),
+                set(notice.label for notice in context['notices']))
+            eq_(set(users), set(notice.get_object().user
+                                for notice in context['notices']))
+            label, context = sends[users[0]]
+            eq_('award_received', label)
+            eq_(users[0], context['award'].user)
+
+            # Without the queue, notices are sent as they happen.
+            user = self._get_user(username='digest_now',
+                                  email='digest_now@example.com')
+            award = badge.award_to(user, awarder=creator)
+            eq_(0, NotificationTask.objects.count())
+            notification.send.assert_any_call(
+                [creator], 'badge_awarded',
+                dict(award=award, protocol='http'))
+
+    def test_notification_retries(self):
+        """Notices that fail to send are retried after a delay, doubled each
+        time, and dropped after the last attempt"""
+        badge = self._get_badge(title='Retry Digest', creator=False)
+        user = self._get_user(username='retry_digest',
+                              email='retry_digest@example.com')
+
+        with patch('badger.models.notification') as notification:
+            with patch_settings(BADGER_NOTIFICATION_QUEUE=True):
+                badge.award_to(user)
+            eq_(1, NotificationTask.objects.count())
+            notification.send_now.side_effect = IOError('Connection refused')
+            with patch('badger.models.NOTIFICATION_MAX_ATTEMPTS', 3):
+                for attempt in (1, 2):
+                    eq_((1, 0), NotificationTask.objects.dispatch(window=0))
+                    task = NotificationTask.objects.get()
+                    eq_(attempt, task.attempts)
+                    delay = task.next_attempt - timezone.now()
+                    delay = (delay.days * 86400 + delay.seconds +
+                             delay.microseconds / 1e6)
+                    ok_(0 < delay <= 60 * 2 ** (attempt - 1))
+                    eq_((0, 0), NotificationTask.objects.dispatch(window=0))
+                    NotificationTask.objects.update(
+                        next_attempt=timezone.now())
+                eq_((1, 0), NotificationTask.objects.dispatch(window=0))
+            eq_(0, NotificationTask.objects.count())
+            eq_(3, notification.send_now.call_count)
+
+    def test_notification_same_instant(self):
+        """A dispatch only sends the notices it claimed, even if another
+        worker claimed some at the same instant"""
+        badge = self._get_badge(title='Same Instant Digest', creator=False)
+        users = [self._get_user(username='instant_digest_%s' % i,
+                                email='instant_digest_%s@example.com' % i)
+                 for i in range(2)]
+
+        with patch('badger.models.notification') as notification:
+            with patch_settings(BADGER_NOTIFICATION_QUEUE=True):
+                badge.award_to_many([user.email for user in users])
+            now = timezone.now()
+            NotificationTask.objects.filter(recipient=users[0]).update(
+                claimed=now, claim_token='otherworker')
+            with patch('badger.models.timezone.now', return_value=now):
+                eq_((1, 1), NotificationTask.objects.dispatch(window=0))
+            eq_([users[1]], [args[0][0] for args, kwargs
+                             in notification.send_now.call_args_list])
+            eq_([users[0]], [task.recipient
+                             for task in NotificationTask.objects.all()])
+
+
+class BadgerSearchTest(BadgerTestCase):
+
+    def test_search(self):
+        """Badge search is ranked, stemmed, and matches quoted phrases"""
+        b1 = self._get_badge(title="Python Testing",
+                             description="Wrote tests for the python code")
+        b2 = self._get_badge(title="Code Review",
+                             description="Reviewed some Python code")
+        b3 = self._get_badge(title="Documentation",
+                             description="Wrote docs about testing")
+
+        eq_([b1, b2], list(Badge.objects.search('python')))
+        eq_([b1, b3], list(Badge.objects.search('tested')))
+        eq_([b1], list(Badge.objects.search('python tests')))
+        eq_([b2], list(Badge.objects.search('"some python code"')))
+        eq_([], list(Badge.objects.search('"python some"')))
+        eq_([], list(Badge.objects.search('nothing')))
+        eq_([b2, b1], list(Badge.objects.search('python', sort='title')))
+
+        # The index follows changes to badges.
+        b3.description = 'Wrote docs about python'
+        b3.save()
+        eq_(3, Badge.objects.search('python').count())
+        b1.delete()
+        eq_([b2, b3], list(Badge.objects.search('python', sort='title')))
+
+    def test_search_max_results(self):
+        """Only searches ranked by relevance are capped"""
+        badges = [self._get_badge(title="Capped %s" % i) for i in range(3)]
+        with patch('badger.models.SEARCH_MAX_RESULTS', 2):
+            eq_(2, Badge.objects.search('capped').count())
+            eq_(badges, list(Badge.objects.search('capped', sort='title')))
+            eq_(3, Badge.objects.search('capped', sort='created').count())
+
+    def test_rebuild_search_index(self):
+        """rebuild_search_index indexes all badges from scratch"""
+        badge = self._get_badge(title="Rebuild Me")
+        BadgeSearchIndex.objects.all().delete()
+        eq_([], list(Badge.objects.search('rebuild')))
+
+        call_command('rebuild_search_index', batch_size=1, stdout=StringIO())
+        eq_([badge], list(Badge.objects.search('rebuild')))
+
+    def test_search_query_count(self):
+        """Searches read the search index, in as many queries at 300 badges
+        as at 100"""
+        words = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot',
+                 'golf', 'hotel', 'india', 'juliet', 'kilo', 'lima')
+        num_badges = 0
+        num_queries = []
+        for size in (100, 300):
+            Badge.objects.bulk_create([
+                Badge(title='%s %s %s' % (words[i % 12], words[i % 7],
+                                          i),
+                      slug='bench-%s' % i,
+                      description='%s badge number %s' % (words[i % 5], i))
+                for i in range(num_badges, size)])
+            num_badges = size
+            call_command('rebuild_search_index', verbosity=0)
+
+            with CaptureQueriesContext(connection) as ctx:
+                results = list(Badge.objects.search('"alpha bravo" badge'))
+            ok_(results)
+            ok_(not [q for q in ctx.captured_queries
+                     if 'LIKE' in q['sql'].upper()])
+            num_queries.append(len(ctx.captured_queries))
+        eq_(num_queries[0], num_queries[1])
+
+
+class BadgerPaginationTest(BadgerTestCase):
+
+    def test_paginate_after(self):
+        """Cursor pages cover every item once, in order, despite ties"""
+        badge = self._get_badge()
+        for i in range(10):
+            badge.award_to(self._get_user(username='page_%s' % i,
+                                          email='page_%s@example.com' % i))
+        # Give some awards the same timestamp
+        awards = list(Award.objects.order_by('pk'))
+        for i, award in enumerate(awards):
+            Award.objects.filter(pk=award.pk).update(
+                modified=awards[i // 3 * 3].modified)
+        expected = list(Award.objects.order_by('-modified', '-pk'))
+
+        seen, after = [], None
+        while True:
+            page = paginate_after(Award.objects.all(), after, 3)
+            ok_(len(page) <= 3)
+            seen.extend(page)
+            if not page.has_next():
+                break
+            after = page.next_cursor
+        eq_(expected, seen)
+
+        for token in ('bogus', encode_cursor(datetime.now(), 'x'), '*'):
+            assert_raises(ValueError, paginate_after, Award.objects.all(),
+                          token, 3)
+
+    def test_paginate_after_deep_pages(self):
+        """Deep cursor pages seek past the earlier items in one query,
+        rather than counting through them with an OFFSET"""
+        badge = self._get_badge()
+        user = self._get_user()
+        Award.objects.bulk_create([
+            Award(badge=badge, user=user) for i in range(200)])
+
+        page_size = 10
+        expected = list(Award.objects.order_by('-modified', '-pk'))
+        deep = expected[page_size * 15 - 1]
+        deep_cursor = encode_cursor(deep.modified, deep.pk)
+
+        with CaptureQueriesContext(connection) as ctx:
+            page = paginate_after(Award.objects.all(), deep_cursor,
+                                  page_size)
+        eq_(expected[page_size * 15:page_size * 16], list(page))
+        eq_(1, len(ctx.captured_queries))
+        sql = ctx.captured_queries[0]['sql']
+        ok_('OFFSET' not in sql.upper(), sql)
+
+
+class BadgerTagCountTest(BadgerTestCase):
+
+    def test_top_tags(self):
+        """Tag counts follow tagging changes, and feed top_tags()"""
+        badges = [self._get_badge(title="Tagged %s" % i) for i in range(4)]
+        for badge in badges:
+            badge.tags.add('common')
+        for badge in badges[:2]:
+            badge.tags.add('rare', 'other')
+        badges[0].tags.add('unique')
+
+        top = [(x['tag'].name, x['count'])
+               for x in Badge.objects.top_tags(min_count=2)]
+        eq_(('common', 4), top[0])
+        eq_(set([('rare', 2), ('other', 2)]), set(top[1:]))
+
+        # Served from the cache, until the counts change
+        with self.assertNumQueries(0):
+            eq_(3, len(Badge.objects.top_tags(min_count=2)))
+        eq_(4, len(Badge.objects.top_tags(min_count=1)))
+        eq_(1, len(Badge.objects.top_tags(min_count=1, limit=1)))
+
+        badges[1].tags.remove('rare')
+        badges[2].delete()
+        badges[3].tags.clear()
+        top = dict((x['tag'].name, x['count'])
+                   for x in Badge.objects.top_tags(min_count=1))
+        eq_(dict(common=2, other=2, rare=1, unique=1), top)
+        eq_(2, BadgeTagCount.objects.count_for(
+            Tag.objects.get(name='common')))
+
+
+class BadgerAutocompleteTest(BadgerTestCase):
+
+    def test_autocomplete(self):
+        """Autocomplete matches title and slug prefixes, following changes"""
+        b1 = Badge.objects.create(title=u"Caf\xe9 Regular", slug="coffee")
+        b2 = self._get_badge(title="Code Reviewer")
+        b3 = self._get_badge(title="Committer")
+
+        def titles(prefix, limit=10):
+            return [title for pk, title, slug
+                    in Badge.objects.autocomplete(prefix, limit)]
+
+        eq_([u"Caf\xe9 Regular", "Code Reviewer", "Committer"], titles('c'))
+        eq_([u"Caf\xe9 Regular"], titles('  CAFE  r'))
+        eq_(["Code Reviewer", u"Caf\xe9 Regular"], titles('co', limit=2))
+        eq_([u"Caf\xe9 Regular"], titles('coffee'))
+        eq_([], titles(''))
+        eq_([], titles('x'))
+
+        b3.title = "Maintainer"
+        b3.save()
+        eq_(["Maintainer"], titles('main'))
+        # The slug is unchanged, and still matches
+        eq_(["Maintainer"], titles('comm'))
+        b2.delete()
+        eq_([], titles('code'))
+
+    def test_autocomplete_stale(self):
+        """Autocomplete rebuilds when another process changes badges"""
+        badge = self._get_badge(title="Old Title")
+        eq_(1, len(Badge.objects.autocomplete('old')))
+
+        # Changes that skip signals here, as if made in another process
+        Badge.objects.filter(pk=badge.pk).update(title="New Title")
+        eq_(1, len(Badge.objects.autocomplete('old')))
+        autocomplete.bump_version()
+        eq_([(badge.pk, "New Title", badge.slug)],
+            Badge.objects.autocomplete('new'))
+
+    def test_autocomplete_without_cache(self):
+        """Badges can be saved when the cache can't store the version stamp,
+        and autocomplete rebuilds to pick up the change"""
+        badge = self._get_badge(title="Cacheless Title")
+        eq_(1, len(Badge.objects.autocomplete('cacheless')))
+
+        with patch('badger.autocomplete.cache.incr',
+                   side_effect=ValueError('Key not found')):
+            eq_((None, None), autocomplete.bump_version())
+            badge.title = "Renamed Title"
+            badge.save()
+        eq_([(badge.pk, "Renamed Title", badge.slug)],
+            Badge.objects.autocomplete('renamed'))
+
+    def test_autocomplete_query_count(self):
+        """Autocomplete loads the badges with one query, then looks them up
+        in memory"""
+        Badge.objects.bulk_create([
+            Badge(title='Badge %s' % i, slug='badge-%s' % i)
+            for i in range(200)])
+        # bulk_create() skips the signals that keep the index current
+        autocomplete.bump_version()
+
+        with self.assertNumQueries(1):
+            ok_(Badge.objects.autocomplete('badge 1'))
+        with self.assertNumQueries(0):
+            for i in range(200):
+                results = Badge.objects.autocomplete('badge %s' % i)
+                eq_('Badge %s' % i, results[0][1])
+
 
 class BadgerOBITest(BadgerTestCase):
 
+    def test_cached_obi_json(self):
+        """OBI JSON is cached, until the award, badge, or users change"""
+        creator = self._get_user(username="creator",
+                                 email="creator@example.com")
+        badge = self._get_badge(title="Cached Badge", creator=creator)
+        awardee = self._get_user(username="awardee",
+                                 email="awardee@example.com")
+        award = badge.award_to(awardee, awarder=creator)
+
+        def fetch():
+            award = Award.objects.select_related('badge').get(pk=award_pk)
+            return json.loads(award.as_obi_assertion_json())
+        award_pk = award.pk
+
+        eq_(award.as_obi_assertion(), fetch())
+        badge.as_obi_serialization_json()
+        award = Award.objects.select_related('badge').get(pk=award_pk)
+        with self.assertNumQueries(0):
+            assertion = json.loads(award.as_obi_assertion_json())
+            badge_data = json.loads(award.badge.as_obi_serialization_json())
+        eq_(award.as_obi_assertion(), assertion)
+        eq_(badge.as_obi_serialization(), badge_data)
+
+        badge.description = "Changed description"
+        badge.save()
+        eq_("Changed description", fetch()['badge']['description'])
+        eq_("Changed description",
+            json.loads(badge.as_obi_serialization_json())['description'])
+
+        awardee.email = "changed@example.com"
+        awardee.save()
+        fresh = Award.objects.get(pk=award_pk).as_obi_assertion()
+        eq_(fresh['recipient'], fetch()['recipient'])
+
+    def test_cached_obi_json_badge_creator(self):
+        """Cached OBI JSON is dropped when a badge creator changes, as the
+        issuer of the badge and of awards without an awarder"""
+        creator = self._get_user(username="issuer",
+                                 email="issuer@example.com")
+        badge = self._get_badge(title="Issued Badge", creator=creator)
+        award = badge.award_to(self._get_user(username="issued",
+                                              email="issued@example.com"))
+        award_pk = award.pk
+        eq_("issuer@example.com",
+            json.loads(award.as_obi_assertion_json())
+                ['badge']['issuer']['contact'])
+        eq_("issuer@example.com",
+            json.loads(badge.as_obi_serialization_json())
+                ['issuer']['contact'])
+
+        # The user's version stamp is bumped, without looking up what was
+        # cached for them.
+        creator.email = "changed_issuer@example.com"
+        with CaptureQueriesContext(connection) as ctx:
+            creator.save()
+        ok_(not [q for q in ctx.captured_queries
+                 if 'badger_award' in q['sql'] or 'badger_badge' in q['sql']])
+        award = Award.objects.select_related('badge').get(pk=award_pk)
+        eq_("changed_issuer@example.com",
+            json.loads(award.as_obi_assertion_json())
+                ['badge']['issuer']['contact'])
+        eq_("changed_issuer@example.com",
+            json.loads(award.badge.as_obi_serialization_json())
+                ['issuer']['contact'])
+
+    def test_obi_assertions_json_many(self):
+        """Many cached OBI assertions are fetched in one cache round trip"""
+        badge = self._get_badge(title="Bulk Badge")
+        for i in range(10):
+            badge.award_to(self._get_user(username='bulk_%s' % i,
+                                          email='bulk_%s@example.com' % i))
+        awards = list(Award.objects.select_related('badge'))
+        expected = dict((award.pk, award.as_obi_assertion())
+                        for award in awards)
+
+        Award.objects.obi_assertions_json(awards)
+        with patch('badger.models.cache.get_many',
+                   wraps=cache.get_many) as get_many:
+            with self.assertNumQueries(0):
+                results = Award.objects.obi_assertions_json(awards)
+            eq_(1, get_many.call_count)
+        eq_(expected, dict((pk, json.loads(data))
+                           for pk, data in results.items()))
+
     def test_baked_award_image(self):
         """Award gets image baked with OBI assertion"""
         # Get the source for a sample badge image
@@ -138,7 +830,8 @@ class BadgerOBITest(BadgerTestCase):
 
         # Try awarding the badge once with baking enabled and once without
         for enabled in (True, False):
-            with patch_settings(BADGER_BAKE_AWARD_IMAGES=enabled):
+            with patch_settings(BADGER_BAKE_AWARD_IMAGES=enabled,
+                                BADGER_BAKE_QUEUE='sync'):
                 award_1 = badge.award_to(awardee=user_awardee_1)
                 if not enabled:
                     ok_(not award_1.image)
@@ -153,6 +846,149 @@ class BadgerOBITest(BadgerTestCase):
                     eq_(expected_url, hosted_assertion_url)
                 award_1.delete()
 
+    def test_rebake_award_image(self):
+        """Rebaking an award with an unchanged badge image is a no-op"""
+        badge = self._get_badge(title="Badge with Creator")
+        awardee = self._get_user(username="awardee_1")
+        with patch_settings(BADGER_BAKE_AWARD_IMAGES=True,
+                            BADGER_BAKE_QUEUE='sync'):
+            award = badge.award_to(awardee=awardee)
+
+        award = Award.objects.get(pk=award.pk)
+        name_before = award.image.name
+        ok_(award.image.storage.exists(name_before))
+        ok_(award.bake_obi_image())
+        eq_(name_before, Award.objects.get(pk=award.pk).image.name)
+        ok_(award.image.storage.exists(name_before))
+
+    def test_png_chunk_baking(self):
+        """Text baked into PNG chunks can be read back by PIL"""
+        img_data = open(BADGE_IMG_FN, 'rb').read()
+        split = pngchunks.split_for_baking(img_data, 'openbadges')
+
+        for text in (u'http://example.com/badges/badge/foo/awards/1.json',
+                     u'http://example.com/badges/badge/弁/awards/2.json'):
+            baked = pngchunks.bake(split, 'openbadges', text)
+            img = Image.open(StringIO(baked))
+            img.load()
+            eq_(text.encode('utf-8'), img.info['openbadges'])
+
+            # Rebaking a baked image replaces, rather than adds, the text.
+            baked_split = pngchunks.split_for_baking(baked, 'openbadges')
+            rebaked = pngchunks.bake(baked_split, 'openbadges', text)
+            eq_(baked, rebaked)
+
+        self.assertRaises(ValueError, pngchunks.read_chunks, 'not a png')
+
+    @attr('benchmark')
+    def test_png_chunk_baking_speed(self):
+        """Baking by splicing PNG chunks beats re-encoding with PIL"""
+        img_data = open(BADGE_IMG_FN, 'rb').read()
+        urls = ['http://example.com/badges/badge/foo/awards/%s.json' % i
+                for i in range(1000)]
+
+        start = time.time()
+        for url in urls:
+            pngchunks.bake_with_pil(img_data, 'openbadges', url)
+        pil_time = time.time() - start
+
+        start = time.time()
+        for url in urls:
+            source_hash, data, split = pngchunks.load_source(
+                BADGE_IMG_FN, lambda: open(BADGE_IMG_FN, 'rb').read())
+            pngchunks.bake(split, 'openbadges', url)
+        chunk_time = time.time() - start
+
+        logging.info('Baked 1000 awards: PIL %0.3fs, PNG chunks %0.3fs' %
+                     (pil_time, chunk_time))
+        ok_(chunk_time < pil_time)
+
+    def test_rebake_awards_command(self):
+        """rebake_awards can be limited by badge and resumed by pk"""
+        badge_1 = self._get_badge(title="Rebake 1")
+        badge_2 = self._get_badge(title="Rebake 2")
+        awards_1 = [badge_1.award_to(awardee=self._get_user(
+                        username='rebake_1_%s' % i))
+                    for i in range(3)]
+        award_2 = badge_2.award_to(awardee=self._get_user(
+                      username='rebake_2'))
+
+        def baked(award):
+            return bool(Award.objects.get(pk=award.pk).image)
+
+        # Resume from a checkpoint left behind by an interrupted run.
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'rebake.checkpoint')
+        open(checkpoint, 'w').write('%s\n' % awards_1[0].pk)
+
+        call_command('rebake_awards', badge=badge_1.slug, batch_size=1,
+                     checkpoint=checkpoint, stdout=StringIO())
+
+        ok_(not baked(awards_1[0]))
+        ok_(baked(awards_1[1]))
+        ok_(baked(awards_1[2]))
+        ok_(not baked(award_2))
+        ok_(not os.path.exists(checkpoint))
+
+        call_command('rebake_awards', since_pk=awards_1[2].pk,
+                     stdout=StringIO())
+        ok_(not baked(awards_1[0]))
+        ok_(baked(award_2))
+
+    def test_bake_worker(self):
+        """Award images queued in the database are baked by bake_worker"""
+        img_data = open(BADGE_IMG_FN, 'r').read()
+        badge = self._get_badge(title="Badge with Image")
+        badge.image.save('', ContentFile(img_data), True)
+        awardee = self._get_user(username="awardee_1")
+
+        with patch_settings(BADGER_BAKE_AWARD_IMAGES=True,
+                            BADGER_BAKE_QUEUE='db'):
+            award = badge.award_to(awardee=awardee)
+
+        # Until the worker gets to it, the award has no baked image.
+        ok_(not Award.objects.get(pk=award.pk).image)
+        eq_(1, AwardBakeTask.objects.filter(award=award).count())
+
+        call_command('bake_worker', once=True, verbosity=0)
+
+        eq_(0, AwardBakeTask.objects.count())
+        award = Award.objects.get(pk=award.pk)
+        ok_(award.image)
+        img = Image.open(award.image.file)
+        expected_url = '%s%s' % (
+            BASE_URL, reverse('badger.award_detail_json',
+                              args=(badge.slug, award.id)))
+        eq_(expected_url, img.info['openbadges'])
+
+    def test_thread_bake_queue(self):
+        """Award images can be baked by a pool of worker threads"""
+        badge = self._get_badge()
+        awardee = self._get_user(username="awardee_1")
+        queue = ThreadBakeQueue(num_threads=2)
+
+        with patch('badger.baking.bake_award') as bake_award:
+            with patch_settings(BADGER_BAKE_AWARD_IMAGES=False):
+                award = badge.award_to(awardee=awardee)
+            queue.enqueue(award)
+            queue.join()
+            bake_award.assert_called_once_with(award.pk,
+                                               retries=BAKE_THREAD_RETRIES)
+
+    def test_bake_missing_award(self):
+        """Bakes look again for awards not committed yet, and log failures"""
+        award = self._get_badge().award_to(awardee=self._get_user())
+        get = Award.admin_objects.get
+        with patch('badger.baking.time.sleep') as sleep:
+            with patch.object(Award.admin_objects, 'get',
+                              side_effect=[Award.DoesNotExist(),
+                                           get(pk=award.pk)]):
+                ok_(bake_award(award.pk, retries=5))
+            eq_(1, sleep.call_count)
+            with patch('badger.baking.logging.warning') as warning:
+                ok_(not bake_award(award.pk + 1000, retries=2))
+                eq_(1, warning.call_count)
+            eq_(3, sleep.call_count)
+
 
 class BadgerProgressTest(BadgerTestCase):
 
@@ -174,6 +1010,171 @@ class BadgerProgressTest(BadgerTestCase):
         # None, because award deletes progress.
         eq_(0, Progress.objects.filter(badge=b, user=user).count())
 
+    def test_increment_by(self):
+        """Counter increments happen in the database and pick up other
+        updates to the record"""
+        user = self._get_user()
+        badge = self._get_badge()
+
+        p = badge.progress_for(user)
+        p.increment_by(3)
+        ok_(p.pk)
+        eq_(3, p.counter)
+
+        other = Progress.objects.get(pk=p.pk)
+        other.increment_by(4)
+        p.decrement_by(2)
+        eq_(5, p.counter)
+
+        p.decrement_by(1, refresh=False)
+        eq_(4, p.counter)
+        eq_(4, Progress.objects.get(pk=p.pk).counter)
+
+        # Percent set elsewhere triggers an auto-award on increment, but only
+        # with refresh, since otherwise the percent isn't reloaded.
+        Progress.objects.filter(pk=p.pk).update(percent=100)
+        p.increment_by(1, refresh=False)
+        ok_(not badge.is_awarded_to(user))
+        p.increment_by(1)
+        ok_(badge.is_awarded_to(user))
+
+    def test_increment_by_concurrent(self):
+        """Concurrent increments of the same progress record aren't lost"""
+        user = self._get_user()
+        badge = self._get_badge()
+        p = badge.progress_for(user)
+        p.save()
+
+        # Share this thread's connection, so the workers see the test DB.
+        conn = connections['default']
+        conn.allow_thread_sharing = True
+
+        def work():
+            connections['default'] = conn
+            progress = Progress.objects.get(pk=p.pk)
+            for i in range(25):
+                progress.increment_by(1, refresh=False)
+
+        try:
+            threads = [threading.Thread(target=work) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            conn.allow_thread_sharing = False
+
+        eq_(100, Progress.objects.get(pk=p.pk).counter)
+
+    def test_increment_many(self):
+        """Progress counters can be incremented in bulk"""
+        user_1 = self._get_user(username="user_1")
+        user_2 = self._get_user(username="user_2")
+        badge_1 = self._get_badge(title="Badge 1")
+        badge_2 = self._get_badge(title="Badge 2")
+        unique = self._get_badge(title="Unique", unique=True)
+        unique.award_to(awardee=user_2)
+
+        p = badge_1.progress_for(user_1)
+        p.counter = 10
+        p.save()
+
+        counters = Progress.objects.increment_many([
+            (user_1, badge_1, 1),
+            (user_1, badge_1, 2),
+            (user_1, badge_2, 5),
+            (user_2, badge_1, 7),
+            (user_2, unique, 1),
+        ])
+        eq_({(user_1.pk, badge_1.pk): 13,
+             (user_1.pk, badge_2.pk): 5,
+             (user_2.pk, badge_1.pk): 7}, counters)
+        eq_(0, Progress.objects.filter(user=user_2, badge=unique).count())
+
+        Progress.objects.filter(user=user_1, badge=badge_2).update(percent=100)
+        Progress.objects.increment_many([(user_1, badge_2, 1)])
+        ok_(badge_2.is_awarded_to(user_1))
+
+    def test_progress_buffer(self):
+        """Buffered progress changes are coalesced and written in bulk"""
+        user_1 = self._get_user(username="user_1")
+        user_2 = self._get_user(username="user_2")
+        badge = self._get_badge()
+        buf = ProgressBuffer(max_size=2, max_age=60)
+
+        with self.assertNumQueries(0):
+            for i in range(10):
+                buf.add(user_1, badge, 1)
+        eq_(0, Progress.objects.count())
+
+        # A second pending record hits max_size and flushes both.
+        buf.add(user_2, badge, 3, percent=50)
+        eq_(10, Progress.objects.get(user=user_1, badge=badge).counter)
+        p = Progress.objects.get(user=user_2, badge=badge)
+        eq_((3, 50), (p.counter, p.percent))
+
+        stats = buf.stats()
+        eq_(11, stats['events'])
+        eq_(1, stats['flushes'])
+        eq_(2, stats['rows_written'])
+        eq_(5.5, stats['coalescing_ratio'])
+
+        # Crossing the auto-award threshold flushes at once.
+        buf.add(user_2, badge, percent=100)
+        ok_(badge.is_awarded_to(user_2))
+        eq_(0, buf.stats()['pending'])
+
+    def test_progress_buffer_max_age(self):
+        """Buffered progress is flushed once it gets old enough"""
+        user = self._get_user()
+        badge = self._get_badge()
+        buf = ProgressBuffer(max_size=100, max_age=60)
+
+        buf.add(user, badge, 1)
+        eq_(0, Progress.objects.count())
+        buf.last_flush -= 60
+        buf.add(user, badge, 1)
+        eq_(2, Progress.objects.get(user=user, badge=badge).counter)
+
+    def test_progress_buffer_timer(self):
+        """Buffered progress is flushed by a timer, without more events"""
+        buf = ProgressBuffer(max_size=100, max_age=0.01)
+        flushed = threading.Event()
+        with patch.object(buf, 'flush', side_effect=flushed.set):
+            buf.add(self._get_user(), self._get_badge(), 1)
+            flushed.wait(5)
+        ok_(flushed.is_set())
+
+    def test_progress_buffer_failed_flush(self):
+        """Buffered progress that fails to be written is retried"""
+        user = self._get_user()
+        badge = self._get_badge()
+        buf = ProgressBuffer(max_size=100, max_age=60)
+
+        buf.add(user, badge, 2, percent=10)
+        with patch.object(Progress.objects, 'update_many',
+                          side_effect=DatabaseError('Gone away')):
+            assert_raises(DatabaseError, buf.flush)
+        eq_(0, Progress.objects.count())
+
+        buf.add(user, badge, 3)
+        buf.flush()
+        p = Progress.objects.get(user=user, badge=badge)
+        eq_((5, 10), (p.counter, p.percent))
+        eq_(2, buf.stats()['events'])
+
+    def test_record_progress(self):
+        """Progress can be recorded with or without the buffer"""
+        user = self._get_user()
+        badge = self._get_badge()
+
+        record_progress(badge, user, 2)
+        eq_(2, Progress.objects.get(user=user, badge=badge).counter)
+
+        with patch_settings(BADGER_PROGRESS_BUFFER=True):
+            record_progress(badge.slug, user, 3, percent=100)
+        ok_(badge.is_awarded_to(user))
+
 
 class BadgerDeferredAwardTest(BadgerTestCase):
 
@@ -408,6 +1409,234 @@ class BadgerDeferredAwardTest(BadgerTestCase):
             # Assert that the claim group is gone, and now there's one less.
             eq_(num_groups - 1, len(badge1.claim_groups))
 
+    def test_generate_claim_codes_in_bulk(self):
+        """Claim codes are generated in batches, avoiding codes in use"""
+        creator = self._get_user()
+        badge = self._get_badge(title="Bulk Codes", creator=creator)
+        DeferredAward.objects.create(badge=badge, claim_code='aaaaaa')
+
+        with CaptureQueriesContext(connection) as ctx:
+            with patch_settings(BADGER_CLAIM_CODE_BATCH_SIZE=500):
+                cg = badge.generate_deferred_awards(user=creator,
+                                                    amount=1200)
+        codes = list(DeferredAward.objects.filter(claim_group=cg)
+                                          .values_list('claim_code',
+                                                       flat=True))
+        eq_(1200, len(set(codes)))
+        # SQLite splits each batch into inserts of ~100 rows, at most
+        ok_(len(ctx.captured_queries) < 50)
+
+        # Codes drawn twice, or already in use, are drawn again
+        drawn = iter(['aaaaaa', 'bbbbbb', 'bbbbbb', 'cccccc', 'dddddd'])
+        with patch('badger.models.make_random_code', lambda: next(drawn)):
+            eq_(set(['bbbbbb', 'cccccc']),
+                set(DeferredAward.objects.unused_claim_codes(2)))
+
+        # A batch that collides when inserted is retried with new codes
+        with patch.object(DeferredAward.objects.__class__,
+                          'unused_claim_codes',
+                          side_effect=[['aaaaaa', 'eeeeee'],
+                                       ['ffffff', 'gggggg']]):
+            cg = badge.generate_deferred_awards(user=creator, amount=2)
+        eq_(set(['ffffff', 'gggggg']),
+            set(DeferredAward.objects.filter(claim_group=cg)
+                                     .values_list('claim_code', flat=True)))
+
+    def test_create_many_fills_claim_codes(self):
+        """Deferred awards created in bulk without claim codes get them"""
+        badge = self._get_badge(title="Codeless")
+        DeferredAward.objects.create_many([
+            DeferredAward(badge=badge, email='codeless_%s@example.com' % i)
+            for i in range(3)])
+        codes = list(DeferredAward.objects.filter(badge=badge)
+                                          .values_list('claim_code',
+                                                       flat=True))
+        eq_(3, len(set(codes)))
+        ok_('' not in codes)
+
+    def test_claim_code_pool(self):
+        """Deferred awards take their claim codes from the pool, which is
+        refilled with unused codes"""
+        creator = self._get_user()
+        badge = self._get_badge(title="Pooled Codes", creator=creator)
+        DeferredAward.objects.create(badge=badge, claim_code='aaaaaa')
+
+        # Codes in use are never pooled
+        drawn = iter(['aaaaaa'] + ['pool%02d' % i for i in range(20)])
+        with patch('badger.models.make_random_code', lambda: next(drawn)):
+            eq_((0, 10), ClaimCode.objects.refill(10, batch_size=4))
+        eq_(10, ClaimCode.objects.depth())
+        ok_(not ClaimCode.objects.filter(code='aaaaaa').exists())
+        pooled = set(ClaimCode.objects.values_list('code', flat=True))
+
+        with patch_settings(BADGER_CLAIM_CODE_POOL_DEPTH=10):
+            # Codes are only taken when deferred awards are saved
+            da = DeferredAward(badge=badge)
+            eq_('', da.claim_code)
+            eq_(10, ClaimCode.objects.depth())
+            da.save()
+            ok_(da.claim_code in pooled)
+            da = da.grant_to('grantee@example.com', creator)
+            ok_(da.claim_code in pooled)
+            badge.award_to_many(['pooled_1@example.com',
+                                 'pooled_2@example.com'], awarder=creator)
+            cg = badge.generate_deferred_awards(user=creator, amount=10)
+
+        # The pool ran dry, so generate() made up the shortfall
+        codes = set(DeferredAward.objects.filter(claim_group=cg)
+                                         .values_list('claim_code', flat=True))
+        eq_(10, len(codes))
+        eq_(6, len(codes & pooled))
+        eq_(0, ClaimCode.objects.depth())
+        # grant_to() re-keyed the first deferred award, so one code is spent
+        eq_(9, DeferredAward.objects.filter(claim_code__in=pooled).count())
+
+        # Taken codes are dropped on refill, and no code is taken twice
+        eq_((10, 5), ClaimCode.objects.refill(5))
+        eq_(5, ClaimCode.objects.count())
+        eq_(3, len(ClaimCode.objects.pop(3)))
+        eq_(2, len(ClaimCode.objects.pop(3)))
+        eq_([], ClaimCode.objects.pop(3))
+
+        call_command('refill_claim_codes', depth=8, verbosity=0)
+        eq_(8, ClaimCode.objects.count())
+
+    def test_claim_email_outbox(self):
+        """Claim emails can be queued with deferred awards, then sent in
+        batches over one connection, with retries"""
+        user = self._get_user()
+        badge = self._get_badge(title="Outbox", creator=user, unique=False)
+        emails = ['outbox_%s@example.com' % i for i in range(4)]
+
+        with patch_settings(BADGER_CLAIM_EMAIL_OUTBOX=True):
+            badge.award_to(email=emails[0], awarder=user)
+            badge.award_to_many(emails, awarder=user)
+            # Queued along with the deferred award, or not at all
+            try:
+                with transaction.atomic():
+                    badge.award_to(email='rolled_back@example.com')
+                    raise ValueError()
+            except ValueError:
+                pass
+        eq_(0, len(mail.outbox))
+        eq_(4, ClaimEmailTask.objects.count())
+
+        with patch('badger.models.render_to_string',
+                   return_value='Claim your badge'):
+            with patch('badger.models.get_connection',
+                       wraps=mail.get_connection) as get_connection:
+                eq_((4, 4), ClaimEmailTask.objects.flush())
+            eq_(1, get_connection.call_count)
+            eq_(sorted(emails), sorted(m.to[0] for m in mail.outbox))
+            eq_((0, 0), ClaimEmailTask.objects.flush())
+
+            # Failed emails are retried after a delay, doubled each time
+            with patch_settings(BADGER_CLAIM_EMAIL_OUTBOX=True):
+                badge.award_to(email='retry@example.com')
+            backend = 'django.core.mail.backends.locmem.EmailBackend'
+            for attempt in (1, 2):
+                with patch('%s.send_messages' % backend,
+                           side_effect=IOError('Connection refused')):
+                    eq_((1, 0), ClaimEmailTask.objects.flush())
+                task = ClaimEmailTask.objects.get()
+                eq_(attempt, task.attempts)
+                delay = task.next_attempt - timezone.now()
+                delay = (delay.days * 86400 + delay.seconds +
+                         delay.microseconds / 1e6)
+                ok_(0 < delay <= 60 * 2 ** (attempt - 1))
+                eq_((0, 0), ClaimEmailTask.objects.flush())
+                ClaimEmailTask.objects.update(next_attempt=timezone.now())
+            eq_((1, 1), ClaimEmailTask.objects.flush())
+        eq_('retry@example.com', mail.outbox[-1].to[0])
+
+    def test_claim_email_outbox_render_error(self):
+        """A claim email that fails to render is retried later, without
+        stopping the rest of its batch"""
+        badge = self._get_badge(title="Render Error Outbox", unique=False)
+        with patch_settings(BADGER_CLAIM_EMAIL_OUTBOX=True):
+            for i in range(2):
+                badge.award_to(email='render_%s@example.com' % i)
+        broken = DeferredAward.objects.get(email='render_0@example.com')
+
+        def render(name, dictionary, context):
+            if context['deferred_award'].pk == broken.pk:
+                raise ValueError('Broken template')
+            return 'Claim your badge'
+
+        with patch('badger.models.render_to_string', render):
+            eq_((2, 1), ClaimEmailTask.objects.flush())
+        eq_(['render_1@example.com'], [m.to[0] for m in mail.outbox])
+        task = ClaimEmailTask.objects.get()
+        eq_(broken.pk, task.deferred_award_id)
+        eq_(1, task.attempts)
+        eq_(None, task.claimed)
+
+    def test_claim_email_outbox_same_instant(self):
+        """A flush only sends the claim emails it claimed, even if another
+        worker claimed some at the same instant"""
+        user = self._get_user()
+        badge = self._get_badge(title="Same Instant", creator=user)
+        with patch_settings(BADGER_CLAIM_EMAIL_OUTBOX=True):
+            badge.award_to_many(['instant_%s@example.com' % i
+                                 for i in range(2)], awarder=user)
+        now = timezone.now()
+        other = ClaimEmailTask.objects.order_by('pk')[0]
+        ClaimEmailTask.objects.filter(pk=other.pk).update(
+            claimed=now, claim_token='otherworker')
+
+        with patch('badger.models.timezone.now', return_value=now):
+            with patch('badger.models.render_to_string',
+                       return_value='Claim your badge'):
+                eq_((1, 1), ClaimEmailTask.objects.flush())
+        eq_(['instant_1@example.com'], [m.to[0] for m in mail.outbox])
+        eq_([other.pk], [task.pk for task in ClaimEmailTask.objects.all()])
+
+    def test_claim_email_outbox_smtp(self):
+        """Queued claim emails are sent over one SMTP connection"""
+        class TestSMTPServer(smtpd.SMTPServer):
+            connections, messages = 0, []
+
+            def handle_accept(self):
+                TestSMTPServer.connections += 1
+                smtpd.SMTPServer.handle_accept(self)
+
+            def process_message(self, peer, mailfrom, rcpttos, data):
+                TestSMTPServer.messages.extend(rcpttos)
+
+        server = TestSMTPServer(('127.0.0.1', 0), None)
+        port = server.socket.getsockname()[1]
+        stopped = threading.Event()
+
+        def serve():
+            while not stopped.is_set():
+                asyncore.loop(timeout=0.05, count=1)
+        thread = threading.Thread(target=serve)
+        thread.start()
+
+        user = self._get_user()
+        badge = self._get_badge(title="SMTP Outbox", creator=user)
+        emails = ['smtp_%s@example.com' % i for i in range(5)]
+        try:
+            with patch_settings(BADGER_CLAIM_EMAIL_OUTBOX=True):
+                badge.award_to_many(emails, awarder=user)
+            backend = 'django.core.mail.backends.smtp.EmailBackend'
+            with patch_settings(
+                    EMAIL_BACKEND=backend,
+                    EMAIL_HOST='127.0.0.1', EMAIL_PORT=port,
+                    EMAIL_HOST_USER='', EMAIL_USE_TLS=False):
+                with patch('badger.models.render_to_string',
+                           return_value='Claim your badge'):
+                    call_command('flush_claim_emails', once=True,
+                                 verbosity=0)
+        finally:
+            stopped.set()
+            thread.join()
+            server.close()
+
+        eq_(0, ClaimEmailTask.objects.count())
+        eq_(1, TestSMTPServer.connections)
+        eq_(sorted(emails), sorted(TestSMTPServer.messages))
+
     def test_deferred_award_unique_duplication(self):
         """Only one deferred award for a unique badge can be created"""
         deferred_email = 'winner@example.com'
@@ -450,6 +1679,123 @@ class BadgerDeferredAwardTest(BadgerTestCase):
         eq_(2, DeferredAward.objects.filter(email=deferred_email).count())
         eq_(1, len(mail.outbox))
 
+    def test_claim_filter(self):
+        """Logins skip looking for deferred awards when the claim filter
+        says there are none, and still claim those there are"""
+        user = self._get_user()
+        badge = self._get_badge(title="Filtered", creator=user, unique=False)
+        call_command('rebuild_claim_filter', verbosity=0)
+
+        def log_in(username, email):
+            awardee = self._get_user(username=username, email=email)
+            with CaptureQueriesContext(connection) as ctx:
+                user_logged_in.send(sender=User, request=HttpRequest(),
+                                    user=awardee)
+            return (badge.is_awarded_to(awardee),
+                    [q for q in ctx.captured_queries
+                     if 'badger_deferredaward' in q['sql']])
+
+        eq_((False, []), log_in('nobody', 'nobody@example.com'))
+
+        # Deferred awards saved one by one, and in bulk, are both claimed
+        badge.award_to(email='single@example.com', awarder=user)
+        badge.award_to_many(['bulk@example.com'], awarder=user)
+        for username, email in (('single', 'single@example.com'),
+                                ('bulk', 'bulk@example.com')):
+            awarded, queries = log_in(username, email)
+            ok_(awarded)
+            ok_(queries)
+
+        # Out of date, or missing, the filter is ignored
+        claimfilter.bump_version()
+        ok_(claimfilter.get_filter() is None)
+        eq_(1, len(log_in('nobody', 'nobody@example.com')[1]))
+        cache.clear()
+        eq_(1, len(log_in('nobody', 'nobody@example.com')[1]))
+
+        # Claimed emails are dropped when the filter is rebuilt
+        call_command('rebuild_claim_filter', verbosity=0)
+        ok_('single@example.com' not in claimfilter.get_filter())
+
+    def test_claim_filter_pending(self):
+        """Saving deferred awards records their emails as pending, without
+        rewriting the claim filter"""
+        badge = self._get_badge(title="Pending Filter")
+        call_command('rebuild_claim_filter', verbosity=0)
+        bloom = claimfilter.get_filter()
+
+        badge.award_to(email='pending@example.com')
+        badge.award_to_many(['pending_bulk@example.com'])
+        eq_(bloom.bits, claimfilter.get_filter().bits)
+        ok_('pending@example.com' not in claimfilter.get_filter())
+        ok_(claimfilter.may_have_pending('pending@example.com'))
+        ok_(claimfilter.may_have_pending('PENDING_bulk@example.com'))
+        ok_(not claimfilter.may_have_pending('other@example.com'))
+
+        # Rebuilds fold in the pending emails
+        cache.delete(claimfilter.pending_key('pending@example.com'))
+        call_command('rebuild_claim_filter', verbosity=0)
+        ok_('pending@example.com' in claimfilter.get_filter())
+
+    def test_claim_filter_without_cache(self):
+        """Deferred awards can be saved when the cache can't store their
+        emails, or the filter's version stamp, leaving the filter out of
+        date"""
+        badge = self._get_badge(title="Cacheless Filter")
+        call_command('rebuild_claim_filter', verbosity=0)
+        ok_(not claimfilter.may_have_pending('cacheless@example.com'))
+
+        with patch('badger.claimfilter.cache.set_many'):
+            badge.award_to(email='cacheless@example.com')
+        ok_(claimfilter.get_filter() is None)
+        ok_(claimfilter.may_have_pending('cacheless@example.com'))
+
+        call_command('rebuild_claim_filter', verbosity=0)
+        with patch('badger.claimfilter.cache.set_many'):
+            with patch('badger.claimfilter.cache.incr',
+                       side_effect=ValueError('Key not found')):
+                badge.award_to(email='incrless@example.com')
+        ok_(claimfilter.get_filter() is None)
+        ok_(claimfilter.may_have_pending('incrless@example.com'))
+
+        # Rebuilding reports a filter the cache didn't store
+        with patch('badger.claimfilter.cache.set'):
+            assert_raises(CommandError, call_command,
+                          'rebuild_claim_filter', verbosity=0)
+
+    def test_claim_filter_max_size(self):
+        """Claim filters are capped in size, and still hold every email"""
+        emails = ['capped_%s@example.com' % i for i in range(5000)]
+        with patch('badger.claimfilter.MAX_SIZE', 1024):
+            eq_((5000, True), claimfilter.rebuild(lambda: emails))
+        bloom = claimfilter.get_filter()
+        eq_(1024, len(bloom.bits))
+        ok_(all(email in bloom for email in emails))
+
+    def test_claim_filter_login_queries(self):
+        """Logins without deferred awards skip the query with a filter"""
+        badge = self._get_badge(title="Login Queries")
+        DeferredAward.objects.bulk_create([
+            DeferredAward(badge=badge, email='invitee_%s@example.com' % i,
+                          claim_code='logins%s' % i)
+            for i in range(50)])
+        users = [self._get_user(username='login_%s' % i,
+                                email='login_%s@example.com' % i)
+                 for i in range(10)]
+
+        def deferred_award_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                for user in users:
+                    user_logged_in.send(sender=User, request=HttpRequest(),
+                                        user=user)
+            return [q for q in ctx.captured_queries
+                    if 'badger_deferredaward' in q['sql']]
+
+        cache.clear()
+        ok_(deferred_award_queries())
+        call_command('rebuild_claim_filter', verbosity=0)
+        eq_([], deferred_award_queries())
+
 
 class BadgerMultiplayerBadgeTest(BadgerTestCase):
 
@@ -489,6 +1835,22 @@ class BadgerMultiplayerBadgeTest(BadgerTestCase):
         nomination.approve_by(nomination.badge.creator)
         ok_(nomination.is_approved)
 
+    def test_queued_nomination_notices(self):
+        """Nomination notices can be queued, to be sent in digests"""
+        badge = self._get_badge()
+        with patch('badger.models.notification') as notification:
+            with patch_settings(BADGER_NOTIFICATION_QUEUE=True):
+                nomination = self._create_nomination(badge)
+                nomination.approve_by(nomination.badge.creator)
+            eq_(0, notification.send.call_count)
+            tasks = NotificationTask.objects.order_by('created', 'pk')
+            eq_([(nomination.badge.creator, 'nomination_submitted'),
+                 (nomination.badge.creator, 'nomination_approved'),
+                 (nomination.creator, 'nomination_approved'),
+                 (nomination.nominee, 'nomination_received')],
+                [(task.recipient, task.label) for task in tasks])
+            ok_(all(task.get_object() == nomination for task in tasks))
+
     def test_autoapprove_nomination(self):
         """All nominations should be auto-approved for a badge flagged for
         auto-approval"""
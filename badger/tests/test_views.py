@@ -16,6 +16,8 @@ from pyquery import PyQuery as pq
 from nose.tools import assert_equal, with_setup, assert_false, eq_, ok_
 from nose.plugins.attrib import attr
 
+from mock import patch
+
 from django.template.defaultfilters import slugify
 
 try:
@@ -26,13 +28,14 @@ except ImportError:
     from django.core.urlresolvers import reverse
     get_url_prefix = None
 
-from . import BadgerTestCase
+from . import BadgerTestCase, patch_settings
 
 from badger.models import (Badge, Award, Nomination, Progress, DeferredAward,
         NominationApproveNotAllowedException,
         NominationAcceptNotAllowedException,
         BadgeAwardNotAllowedException)
 from badger.utils import get_badge, award_badge
+from badger.views import AwardsListView
 
 
 class BadgerViewsTest(BadgerTestCase):
@@ -72,6 +75,18 @@ class BadgerViewsTest(BadgerTestCase):
         eq_('http://testserver%s' % badge.get_absolute_url(), 
             data['criteria'])
 
+    @attr('json')
+    def test_autocomplete(self):
+        """Can look up badges by title prefix as JSON"""
+        badge = self._get_badge(title="Autocomplete Me")
+        self._get_badge(title="Something Else")
+
+        r = self.client.get(reverse('badger.autocomplete'), dict(q='auto'))
+        eq_('application/json', r['Content-Type'])
+        data = json.loads(r.content)
+        eq_([dict(title=badge.title, slug=badge.slug,
+                  url=badge.get_absolute_url())], data['results'])
+
     @attr('json')
     def test_award_detail(self):
         """Can view award detail"""
@@ -110,6 +125,86 @@ class BadgerViewsTest(BadgerTestCase):
         eq_('http://testserver%s' % award.badge.get_absolute_url(), 
             data['badge']['criteria'])
 
+    @attr('json')
+    def test_json_conditional_get(self):
+        """Badge & award JSON answer conditional GETs with 304s"""
+        user = self._get_user()
+        b1 = Badge.objects.create(creator=user, title="Conditional Badge")
+        award = b1.award_to(self._get_user(username='tester2'))
+
+        etags = {}
+        for url in (reverse('badger.detail_json', args=(b1.slug,)),
+                    reverse('badger.award_detail_json',
+                            args=(b1.slug, award.pk))):
+            r = self.client.get(url)
+            eq_(200, r.status_code)
+            ok_('max-age=' in r['Cache-Control'])
+            etags[url] = r['ETag']
+
+            with self.assertMaxQueries(1):
+                r2 = self.client.get(url, HTTP_IF_NONE_MATCH=r['ETag'])
+            eq_(304, r2.status_code)
+            r2 = self.client.get(url,
+                                 HTTP_IF_MODIFIED_SINCE=r['Last-Modified'])
+            eq_(304, r2.status_code)
+
+        # The badge creator is shown in both, so changing them changes the
+        # ETags, though the badge and award are untouched
+        user.email = 'changed@example.com'
+        user.save()
+        for url, etag in etags.items():
+            r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            eq_(200, r.status_code)
+            ok_(etag != r['ETag'])
+
+        # HTML pages aren't conditional
+        r = self.client.get(reverse('badger.views.detail', args=(b1.slug,)))
+        ok_(not r.has_header('ETag'))
+
+    @attr('json')
+    def test_assertions_export(self):
+        """Can fetch many award assertions at once"""
+        user = self._get_user()
+        awardee = self._get_user(username='exported',
+                                 email='exported@example.com')
+        awards = []
+        for i in range(20):
+            badge = Badge.objects.create(creator=user,
+                                         title="Export Badge %s" % i)
+            awards.append(badge.award_to(awardee, awarder=user))
+
+        def assertions_from(r):
+            eq_(200, r.status_code)
+            eq_('application/json', r['Content-Type'])
+            data = json.loads(''.join(r.streaming_content))
+            return dict((item['url'], item['assertion'])
+                        for item in data['assertions'])
+
+        url = reverse('badger.assertions_by_user', args=(awardee.username,))
+        with self.assertMaxQueries(3):
+            by_user = assertions_from(self.client.get(url))
+        eq_(20, len(by_user))
+        for award in awards:
+            award_url = 'http://testserver%s' % reverse(
+                'badger.award_detail_json', args=(award.badge.slug, award.pk))
+            eq_(json.loads(self.client.get(award_url).content),
+                by_user[award_url])
+
+        # Batches of awards are fetched a query at a time
+        with patch_settings(BADGER_ASSERTION_EXPORT_BATCH_SIZE=7):
+            with self.assertMaxQueries(5):
+                eq_(by_user, assertions_from(self.client.get(url)))
+
+        ids = ','.join(str(award.pk) for award in awards[:5])
+        by_id = assertions_from(self.client.get(
+            reverse('badger.assertions'), dict(ids=ids)))
+        eq_(5, len(by_id))
+        for award_url, assertion in by_id.items():
+            eq_(by_user[award_url], assertion)
+
+        r = self.client.get(reverse('badger.assertions'), dict(ids='1,x'))
+        eq_(400, r.status_code)
+
     def test_awards_by_user(self):
         """Can view awards by user"""
         user = self._get_user()
@@ -153,6 +248,32 @@ class BadgerViewsTest(BadgerTestCase):
             eq_(1, doc.find('.award .user:contains("%s")' % u.username)
                       .length)
 
+    def test_awards_list_cursor(self):
+        """Can page through awards with ?after= cursors"""
+        user = self._get_user()
+        b1 = Badge.objects.create(creator=user, title="Code Badge #1")
+        for i in range(5):
+            b1.award_to(self._get_user(username='cursor_%s' % i,
+                                       email='cursor_%s@example.com' % i))
+
+        url = reverse('badger.views.awards_list', args=(b1.slug,))
+        usernames = []
+        with patch.object(AwardsListView, 'paginate_by', 2):
+            next_url = '%s?after=' % url
+            while next_url:
+                r = self.client.get(next_url, follow=True)
+                eq_(200, r.status_code)
+                doc = pq(r.content)
+                ok_(doc.find('.award').length <= 2)
+                usernames.extend(pq(el).text() for el
+                                 in doc.find('.award .user'))
+                href = doc.find('.pagination .next a').attr('href')
+                next_url = href and url + href[href.index('?'):]
+        eq_(5, len(usernames))
+
+        r = self.client.get(url, dict(after='bogus'), follow=True)
+        eq_(404, r.status_code)
+
     def test_award_detail_includes_nomination(self):
         """Nomination should be included in award detail"""
         creator = self._get_user(username="creator", email="creator@example.com")
@@ -324,6 +445,22 @@ class BadgerViewsTest(BadgerTestCase):
             args=(b1.slug,)), follow=True)
         ok_(b1.is_awarded_to(user2))
 
+    def test_generate_claim_codes(self):
+        """Claim codes can be generated in bulk from the badge detail page"""
+        user = self._get_user(username="creator", email="creator@example.com")
+        badge = Badge.objects.create(creator=user, title="Code generator")
+        url = reverse('badger.views.detail', args=(badge.slug,))
+        self.client.login(username="creator", password="trustno1")
+
+        r = self.client.post(url, dict(is_generate=1, amount=2000))
+        eq_(302, r.status_code)
+        eq_(2000, DeferredAward.objects.filter(badge=badge).count())
+
+        for amount in ('lots', 0, 10 ** 6):
+            r = self.client.post(url, dict(is_generate=1, amount=amount))
+            eq_(400, r.status_code)
+        eq_(2000, DeferredAward.objects.filter(badge=badge).count())
+
     def test_deferred_award_immediate_claim(self):
         """Ensure that a deferred award can be immediately claimed rather than
         viewing detail"""
@@ -617,3 +754,44 @@ class BadgerViewsTest(BadgerTestCase):
             user.set_password(password)
             user.save()
         return user
+
+
+class BadgerQueryBudgetTest(BadgerTestCase):
+    """Public views stay within a fixed budget of queries, however many
+    badges & awards they list. Raise a budget only with good reason."""
+
+    def setUp(self):
+        self.client = Client()
+
+    def test_query_budgets(self):
+        """Public views stay within their query budgets"""
+        creator = self._get_user(username='creator',
+                                 email='creator@example.com')
+        badge = Badge.objects.create(creator=creator, title="Budget Badge")
+        for i in range(20):
+            awardee = self._get_user(username='budget_%s' % i,
+                                     email='budget_%s@example.com' % i)
+            badge.award_to(awardee, awarder=creator)
+            other = Badge.objects.create(creator=creator,
+                                         title="Budget Badge %s" % i)
+            other.tags.add('budget')
+            other.award_to(self._get_user(username='budget_0'),
+                           awarder=creator)
+
+        # (view, args, max queries)
+        budgets = (
+            ('badger.views.home', (), 10),
+            ('badger.views.badges_list', (), 8),
+            ('badger.badges_list', ('budget',), 10),
+            ('badger.views.awards_list', (), 8),
+            ('badger.views.awards_list', (badge.slug,), 10),
+            ('badger.views.detail', (badge.slug,), 12),
+            ('badger.detail_json', (badge.slug,), 4),
+            ('badger.views.awards_by_user', ('budget_0',), 8),
+            ('badger.views.badges_by_user', (creator.username,), 8),
+        )
+        for name, args, budget in budgets:
+            url = reverse(name, args=args)
+            with self.assertMaxQueries(budget, msg=url):
+                r = self.client.get(url, follow=True)
+            eq_(200, r.status_code)
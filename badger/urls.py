@@ -9,6 +9,8 @@ from . import views
 
 urlpatterns = patterns('badger.views',
     url(r'^$', 'badges_list', name='badger.badges_list'),
+    url(r'^autocomplete\.json$', 'autocomplete',
+        name='badger.autocomplete'),
     url(r'^staff_tools$', 'staff_tools',
         name='badger.staff_tools'),
     url(r'^tag/(?P<tag_name>.+)/?$', 'badges_list',
@@ -42,6 +44,10 @@ urlpatterns = patterns('badger.views',
         name='badger.detail'),
     url(r'^users/(?P<username>[^/]+)/awards/?$', 'awards_by_user',
         name='badger.awards_by_user'),
+    url(r'^users/(?P<username>[^/]+)/assertions\.json$',
+        'assertions_by_user', name='badger.assertions_by_user'),
+    url(r'^assertions\.json$', 'assertions',
+        name='badger.assertions'),
 
     url(r'^create$', 'create',
         name='badger.create_badge'),
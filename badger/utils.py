@@ -1,5 +1,11 @@
+import hashlib
+from functools import wraps
+
 from django.conf import settings
 from django.db.models import signals
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import available_attrs
+from django.views.decorators.http import condition
 
 import badger
 from badger.models import Badge, Award, Progress
@@ -96,3 +102,72 @@ def get_progress(slug_or_badge, user):
     """
     b = get_badge(slug_or_badge)
     return b.progress_for(user)
+
+
+def record_progress(slug_or_badge, user, amount=0, percent=None):
+    """Record progress by a user toward a badge, without fetching the
+    progress record first. With BADGER_PROGRESS_BUFFER enabled, the change
+    is buffered in memory and written in bulk later.
+
+    :arg slug_or_badge: slug or Badge instance
+    :arg user: User making progress
+    :arg amount: Amount to add to the progress counter
+    :arg percent: New percent completion, or None to leave it unchanged
+
+    """
+    b = get_badge(slug_or_badge)
+    if badger.settings.PROGRESS_BUFFER:
+        from badger.progress import get_progress_buffer
+        get_progress_buffer().add(user, b, amount, percent)
+    else:
+        Progress.objects.update_many([(user, b, amount, percent)])
+
+
+def last_modified_condition(last_modified_func, max_age=None):
+    """Decorator for views answering conditional GETs, like Django's
+    condition(), with the ETag derived from the last modified time and the
+    request URL. So, a single cheap lookup by ``last_modified_func`` serves
+    both validators, and requests that match get a 304 before the view
+    runs. If max_age is given, responses get Cache-Control headers, too.
+
+    ``last_modified_func`` takes the same arguments as the view, returning
+    None to skip conditional handling for the request. It may also return
+    a tuple of (last modified time, version string), with the version
+    folded into the ETag, for changes that leave the time alone, like
+    deleted items.
+    """
+    def get_validators(request, *args, **kwargs):
+        if not hasattr(request, '_badger_validators'):
+            validators = last_modified_func(request, *args, **kwargs)
+            if validators is not None and not isinstance(validators, tuple):
+                validators = (validators, '')
+            request._badger_validators = validators
+        return request._badger_validators
+
+    def get_last_modified(request, *args, **kwargs):
+        validators = get_validators(request, *args, **kwargs)
+        return validators and validators[0] or None
+
+    def get_etag(request, *args, **kwargs):
+        validators = get_validators(request, *args, **kwargs)
+        if not validators or validators[0] is None:
+            return None
+        last_modified, version = validators
+        return hashlib.md5('%s|%s|%s' % (request.get_full_path(),
+                                         last_modified.isoformat(),
+                                         version)).hexdigest()
+
+    def decorator(func):
+        conditional_func = condition(etag_func=get_etag,
+            last_modified_func=get_last_modified)(func)
+
+        @wraps(func, assigned=available_attrs(func))
+        def inner(request, *args, **kwargs):
+            response = conditional_func(request, *args, **kwargs)
+            if (max_age is not None and response.status_code in (200, 304)
+                    and get_last_modified(request, *args, **kwargs)):
+                patch_cache_control(response, public=True, max_age=max_age)
+            return response
+        return inner
+
+    return decorator
@@ -4,7 +4,8 @@ import random
 from django.conf import settings
 
 from django.http import (HttpResponseRedirect, HttpResponse,
-        HttpResponseForbidden, HttpResponseNotFound, Http404)
+        HttpResponseForbidden, HttpResponseNotFound, HttpResponseBadRequest,
+        StreamingHttpResponse, Http404)
 
 import json
 
@@ -24,6 +25,7 @@ try:
 except ImportError:
     from django.utils.translation import ugettext_lazy as _
 
+from django.core.paginator import Paginator
 from django.views.generic.list import ListView
 from django.views.decorators.http import (require_GET, require_POST,
                                           require_http_methods)
@@ -32,29 +34,69 @@ from django.contrib import messages
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
+from django.core.cache import cache
 
 try:
     import taggit
     from taggit.models import Tag, TaggedItem
+    from .models import BadgeTagCount
 except ImportError:
     taggit = None
 
 import badger
 from badger import settings as bsettings
 from .models import (Badge, Award, Nomination, DeferredAward,
-                     Progress, BadgeAwardNotAllowedException,
+                     Progress, prefetch_user_related, get_user_versions,
+                     USER_VERSION_KEY,
+                     BadgeAwardNotAllowedException,
                      BadgeAlreadyAwardedException,
                      NominationApproveNotAllowedException,
                      NominationAcceptNotAllowedException)
+from .pagination import paginate_after
+from .utils import last_modified_condition
 from .forms import (BadgeAwardForm, DeferredAwardGrantForm,
                     DeferredAwardMultipleGrantForm, BadgeNewForm,
                     BadgeEditForm, BadgeSubmitNominationForm)
 
 
+class CursorPaginationMixin(object):
+    """Pages a ListView with ?after= cursors, when given one or when
+    BADGER_CURSOR_PAGINATION is enabled"""
+    cursor_field = 'modified'
+
+    def uses_cursor(self):
+        return ('after' in self.request.GET or
+                bsettings.CURSOR_PAGINATION)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.uses_cursor():
+            return super(CursorPaginationMixin, self).paginate_queryset(
+                queryset, page_size)
+        try:
+            page = paginate_after(queryset, self.request.GET.get('after'),
+                                  page_size, self.cursor_field)
+        except ValueError:
+            raise Http404(_("Invalid cursor"))
+        return (None, page, page.object_list, page.has_other_pages())
+
+
+class CountedPaginator(Paginator):
+    """Paginator for a list whose length is already known, saving a
+    COUNT query"""
+
+    def __init__(self, object_list, per_page, count=None, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page,
+                                               **kwargs)
+        self._count = count
+
+
 def home(request):
     """Badger home page"""
     badge_list = Badge.objects.order_by('-modified').all()[:bsettings.MAX_RECENT]
-    award_list = Award.objects.order_by('-modified').all()[:bsettings.MAX_RECENT]
+    award_list = prefetch_user_related(
+        Award.objects.order_by('-modified')
+                     .select_related('badge', 'user', 'creator'),
+        'user', 'creator')[:bsettings.MAX_RECENT]
     badge_tags = Badge.objects.top_tags()
 
     return render_to_response('%s/home.html' % bsettings.TEMPLATE_BASE, dict(
@@ -62,7 +104,7 @@ def home(request):
     ), context_instance=RequestContext(request))
 
 
-class BadgesListView(ListView):
+class BadgesListView(CursorPaginationMixin, ListView):
     """Badges list page"""
     model = Badge
     template_name = '%s/badges_list.html' % bsettings.TEMPLATE_BASE
@@ -74,13 +116,28 @@ class BadgesListView(ListView):
         query_string = self.request.GET.get('q', None)
         tag_name = self.kwargs.get('tag_name', None)
         if query_string is not None:
-            sort_order = self.request.GET.get('sort', 'created')
+            sort_order = self.request.GET.get('sort', 'relevance')
             qs = Badge.objects.search(query_string, sort_order)
         if taggit and tag_name:
             tag = get_object_or_404(Tag, name=tag_name)
-            qs = (Badge.objects.filter(tags__in=[tag]).distinct())
+            # Badges are only tagged once with a tag, so this needs no
+            # DISTINCT, and the count for paging comes from BadgeTagCount.
+            self.tag_count = BadgeTagCount.objects.count_for(tag)
+            qs = Badge.objects.filter(tags=tag)
         return qs
 
+    def uses_cursor(self):
+        # Search results are ordered by relevance or the requested sort
+        return (self.request.GET.get('q', None) is None and
+                super(BadgesListView, self).uses_cursor())
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        if getattr(self, 'tag_count', None) is not None:
+            return CountedPaginator(queryset, per_page, count=self.tag_count,
+                                    **kwargs)
+        return super(BadgesListView, self).get_paginator(queryset, per_page,
+                                                         **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super(BadgesListView, self).get_context_data(**kwargs)
         context['award_list'] = None
@@ -88,24 +145,67 @@ class BadgesListView(ListView):
         context['query_string'] = kwargs.get('q', None)
         if context['query_string'] is not None:
             # TODO: Is this the most efficient query?
-            context['award_list'] = (Award.objects.filter(badge__in=self.get_queryset()))
+            context['award_list'] = self.get_award_queryset()
         if taggit and context['tag_name']:
             # TODO: Is this the most efficient query?
-            context['award_list'] = (Award.objects.filter(badge__in=self.get_queryset()))
+            context['award_list'] = self.get_award_queryset()
         return context
 
+    def get_award_queryset(self):
+        return prefetch_user_related(
+            Award.objects.filter(badge__in=self.get_queryset())
+                         .select_related('badge', 'user', 'creator'),
+            'user', 'creator')
+
 badges_list = BadgesListView.as_view()
 
 
+@require_GET
+def autocomplete(request):
+    """Badges with a title or slug starting with the q parameter, as JSON"""
+    results = [
+        dict(title=title, slug=slug,
+             url=reverse('badger.views.detail', args=(slug,)))
+        for pk, title, slug in Badge.objects.autocomplete(
+            request.GET.get('q', ''), bsettings.AUTOCOMPLETE_MAX_RESULTS)]
+    resp = HttpResponse(json.dumps(dict(results=results)))
+    resp['Content-Type'] = 'application/json'
+    return resp
+
+
+def _json_user_versions(user_ids):
+    """Version stamps of the users shown in OBI JSON, which change when
+    they do, though the badge or award doesn't"""
+    user_ids = [pk for pk in user_ids if pk]
+    return get_user_versions(cache.get_many([USER_VERSION_KEY % pk
+                                             for pk in user_ids]),
+                             user_ids)
+
+
+def _badge_json_last_modified(request, slug, format="html"):
+    if format != 'json':
+        return None
+    found = Badge.objects.filter(slug=slug).values_list('modified',
+                                                        'creator_id')[:1]
+    if not found:
+        return None
+    modified, creator_id = found[0]
+    return (modified, _json_user_versions([creator_id]))
+
+
 @require_http_methods(['HEAD', 'GET', 'POST'])
+@last_modified_condition(_badge_json_last_modified,
+                         max_age=bsettings.JSON_CACHE_MAX_AGE)
 def detail(request, slug, format="html"):
     """Badge detail view"""
     badge = get_object_or_404(Badge, slug=slug)
     if not badge.allows_detail_by(request.user):
         return HttpResponseForbidden('Detail forbidden')
 
-    awards = (Award.objects.filter(badge=badge)
-                           .order_by('-created'))[:bsettings.MAX_RECENT]
+    awards = prefetch_user_related(
+        Award.objects.filter(badge=badge).order_by('-created')
+                     .select_related('badge', 'user', 'creator'),
+        'user', 'creator')[:bsettings.MAX_RECENT]
 
     # FIXME: This is awkward. It used to collect sections as responses to a
     # signal sent out to badger_multiplayer and hypothetical future expansions
@@ -120,7 +220,12 @@ def detail(request, slug, format="html"):
         if request.POST.get('is_generate', None):
             if not badge.allows_manage_deferred_awards_by(request.user):
                 return HttpResponseForbidden('Claim generate denied')
-            amount = int(request.POST.get('amount', 10))
+            try:
+                amount = int(request.POST.get('amount', 10))
+            except ValueError:
+                return HttpResponseBadRequest('Invalid amount')
+            if not 0 < amount <= bsettings.MAX_GENERATED_CLAIM_CODES:
+                return HttpResponseBadRequest('Invalid amount')
             reusable = (amount == 1)
             cg = badge.generate_deferred_awards(user=request.user,
                                                 amount=amount,
@@ -138,8 +243,7 @@ def detail(request, slug, format="html"):
     claim_groups = badge.claim_groups
 
     if format == 'json':
-        data = badge.as_obi_serialization(request)
-        resp = HttpResponse(json.dumps(data))
+        resp = HttpResponse(badge.as_obi_serialization_json(request))
         resp['Content-Type'] = 'application/json'
         return resp
     else:
@@ -206,7 +310,7 @@ def delete(request, slug):
     if not badge.allows_delete_by(request.user):
         return HttpResponseForbidden()
 
-    awards_count = badge.award_set.count()
+    awards_count = badge.award_count
 
     if request.method == "POST":
         messages.info(request, _(u'Badge "{badgetitle}" deleted.').format(
@@ -252,19 +356,22 @@ def award_badge(request, slug):
     ), context_instance=RequestContext(request))
 
 
-class AwardsListView(ListView):
+class AwardsListView(CursorPaginationMixin, ListView):
     model = Award
     template_name = '%s/awards_list.html' % bsettings.TEMPLATE_BASE
     template_object_name = 'award'
     paginate_by = bsettings.BADGE_PAGE_SIZE
 
     def get_badge(self):
-        if not hasattr(self, 'badge'):
+        if not hasattr(self, '_badge'):
             self._badge = get_object_or_404(Badge, slug=self.kwargs.get('slug', None))
         return self._badge
 
     def get_queryset(self):
-        qs = Award.objects.order_by('-modified')
+        qs = prefetch_user_related(
+            Award.objects.order_by('-modified')
+                         .select_related('badge', 'user', 'creator'),
+            'user', 'creator')
         if self.kwargs.get('slug', None) is not None:
             qs = qs.filter(badge=self.get_badge())
         return qs
@@ -280,17 +387,35 @@ class AwardsListView(ListView):
 awards_list = AwardsListView.as_view()
 
 
+def _award_json_last_modified(request, slug, id, format="html"):
+    if format != 'json':
+        return None
+    # The assertion includes the badge and its users, so changes to any
+    # of them count
+    found = (Award.objects.filter(pk=id, badge__slug=slug)
+                          .values_list('modified', 'badge__modified',
+                                       'user_id', 'creator_id',
+                                       'badge__creator_id')[:1])
+    if not found:
+        return None
+    modified, badge_modified, user_id, creator_id, badge_creator_id = found[0]
+    return (max(modified, badge_modified),
+            _json_user_versions([user_id, creator_id, badge_creator_id]))
+
+
 @require_http_methods(['HEAD', 'GET'])
+@last_modified_condition(_award_json_last_modified,
+                         max_age=bsettings.JSON_CACHE_MAX_AGE)
 def award_detail(request, slug, id, format="html"):
     """Award detail view"""
     badge = get_object_or_404(Badge, slug=slug)
-    award = get_object_or_404(Award, badge=badge, pk=id)
+    award = get_object_or_404(Award.objects.select_related('badge'),
+                              badge=badge, pk=id)
     if not award.allows_detail_by(request.user):
         return HttpResponseForbidden('Award detail forbidden')
 
     if format == 'json':
-        data = json.dumps(award.as_obi_assertion(request))
-        resp = HttpResponse(data)
+        resp = HttpResponse(award.as_obi_assertion_json(request))
         resp['Content-Type'] = 'application/json'
         return resp
     else:
@@ -426,7 +551,10 @@ def claims_list(request, slug, claim_group, format="html"):
 def awards_by_user(request, username):
     """Badge awards by user"""
     user = get_object_or_404(User, username=username)
-    awards = Award.objects.filter(user=user)
+    awards = prefetch_user_related(
+        Award.objects.filter(user=user)
+                     .select_related('badge', 'user', 'creator'),
+        'user', 'creator')
     return render_to_response('%s/awards_by_user.html' % bsettings.TEMPLATE_BASE, dict(
         user=user, award_list=awards,
     ), context_instance=RequestContext(request))
@@ -436,12 +564,75 @@ def awards_by_user(request, username):
 def awards_by_badge(request, slug):
     """Badge awards by badge"""
     badge = get_object_or_404(Badge, slug=slug)
-    awards = Award.objects.filter(badge=badge)
+    awards = prefetch_user_related(
+        Award.objects.filter(badge=badge)
+                     .select_related('badge', 'user', 'creator'),
+        'user', 'creator')
     return render_to_response('%s/awards_by_badge.html' % bsettings.TEMPLATE_BASE, dict(
         badge=badge, awards=awards,
     ), context_instance=RequestContext(request))
 
 
+def _award_batches(queryset):
+    """Yield lists of awards from a queryset, a batch per query"""
+    batch_size = bsettings.ASSERTION_EXPORT_BATCH_SIZE
+    queryset = queryset.select_related('badge__creator', 'user', 'creator')
+    last_pk = 0
+    while True:
+        awards = list(queryset.filter(pk__gt=last_pk).order_by('pk')
+                              [:batch_size])
+        if awards:
+            yield awards
+        if len(awards) < batch_size:
+            break
+        last_pk = awards[-1].pk
+
+
+def _stream_assertions(request, batches):
+    """Stream a JSON list of OBI assertions, with their hosted URLs"""
+    yield '{"assertions": ['
+    separator = ''
+    for awards in batches:
+        assertions = Award.objects.obi_assertions_json(awards, request)
+        for award in awards:
+            if not award.allows_detail_by(request.user):
+                continue
+            url = request.build_absolute_uri(reverse(
+                'badger.award_detail_json', args=(award.badge.slug, award.pk)))
+            yield '%s{"url": %s, "assertion": %s}' % (
+                separator, json.dumps(url), assertions[award.pk])
+            separator = ', '
+    yield ']}'
+
+
+def _assertions_response(request, queryset):
+    resp = StreamingHttpResponse(
+        _stream_assertions(request, _award_batches(queryset)))
+    resp['Content-Type'] = 'application/json'
+    return resp
+
+
+@require_GET
+def assertions_by_user(request, username):
+    """OBI assertions for all the awards to a user, as JSON"""
+    user = get_object_or_404(User, username=username)
+    return _assertions_response(request, Award.objects.filter(user=user))
+
+
+@require_GET
+def assertions(request):
+    """OBI assertions for a comma-separated list of award IDs in the ids
+    parameter, as JSON"""
+    try:
+        ids = set(int(pk) for pk in request.GET.get('ids', '').split(',')
+                  if pk.strip())
+    except ValueError:
+        return HttpResponseBadRequest('Invalid award IDs')
+    if len(ids) > bsettings.ASSERTION_EXPORT_BATCH_SIZE:
+        return HttpResponseBadRequest('Too many award IDs')
+    return _assertions_response(request, Award.objects.filter(pk__in=ids))
+
+
 @require_http_methods(['GET', 'POST'])
 @login_required
 def staff_tools(request):
@@ -477,7 +668,9 @@ def staff_tools(request):
 def badges_by_user(request, username):
     """Badges created by user"""
     user = get_object_or_404(User, username=username)
-    badges = Badge.objects.filter(creator=user)
+    badges = prefetch_user_related(
+        Badge.objects.filter(creator=user).select_related('creator'),
+        'creator')
     return render_to_response('%s/badges_by_user.html' % bsettings.TEMPLATE_BASE, dict(
         user=user, badge_list=badges,
     ), context_instance=RequestContext(request))
@@ -59,26 +59,28 @@ def awards_list(request, *args, **kwargs):
 
     errors, successes = {}, {}
 
+    valid_emails = []
     for email in emails:
         try:
             validate_email(email)
-            result = badge.award_to(email=email, awarder=request.user,
-                                    description=description,
-                                    raise_already_awarded=True)
-            if not result:
-                errors[email] = 'FAILED'
-            else:
-                if isinstance(result, Award):
-                    successes[email] = 'AWARDED'
-                else:
-                    successes[email] = 'INVITED'
-
+            valid_emails.append(email)
         except ValidationError, e:
             errors[email] = "INVALID"
-        except BadgeAlreadyAwardedException, e:
-            errors[email] = "ALREADYAWARDED"
+
+    if valid_emails:
+        try:
+            results = badge.award_to_many(valid_emails,
+                                          awarder=request.user,
+                                          description=description)
+            for email, result in results.items():
+                if result == 'ALREADYAWARDED':
+                    errors[email] = result
+                else:
+                    successes[email] = result
         except Exception, e:
-            errors[email] = "EXCEPTION %s" % e
+            # award_to_many() is atomic, so none of the emails were awarded.
+            for email in valid_emails:
+                errors[email] = "EXCEPTION %s" % e
 
     return _json_response(errors=errors, successes=successes)
 
@@ -42,9 +42,13 @@ from django.core.cache import cache
 from django.core.files.base import ContentFile
 from django.core.files.storage import FileSystemStorage
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
+from badger.models import Award
+from badger.signals import badges_were_awarded
+
 
 MAX_USERNAME_CHANGES = getattr(settings, 'PROFILE_MAX_USERNAME_CHANGES', 3)
 
@@ -124,6 +128,9 @@ class UserProfile(models.Model):
     bio = models.TextField(blank=True)
     organization = models.CharField(max_length=255, default='', blank=True)
     location = models.CharField(max_length=255, default='', blank=True)
+
+    # Kept up to date as awards are made & deleted, see recount_awards
+    award_count = models.IntegerField(default=0, editable=False)
     
     created = models.DateTimeField(auto_now_add=True, blank=False)
     modified = models.DateTimeField(auto_now=True, blank=False)
@@ -135,6 +142,15 @@ class UserProfile(models.Model):
         return (self.display_name and 
                 self.display_name or self.user.username)
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # Don't clobber award_count with whatever value this instance
+            # loaded, since awards update it directly.
+            kwargs['update_fields'] = [f.name for f in self._meta.fields
+                                       if not f.primary_key and
+                                       f.name != 'award_count']
+        super(UserProfile, self).save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse('profiles.profile_view', 
                        kwargs={'username':self.user.username})
@@ -231,12 +247,37 @@ class UserProfile(models.Model):
 
 def autocreate_user_profile(self):
     """Ensure user profile exists when accessed"""
+    # Use the profile from prefetch_related('userprofile_set'), if any
+    profiles = self.userprofile_set.all()
+    if profiles:
+        return profiles[0]
     profile, created = UserProfile.objects.get_or_create(
         user=User.objects.get(id=self.id), 
-        defaults=dict())
+        defaults=dict(award_count=Award.admin_objects.filter(user=self.id)
+                                                     .count()))
     return profile
 
 
+@receiver(badges_were_awarded, sender=Award)
+def increment_profile_award_count(sender, awards, **kwargs):
+    counts = {}
+    for award in awards:
+        counts[award.user_id] = counts.get(award.user_id, 0) + 1
+    # One UPDATE for each distinct count, rather than one for each user
+    user_ids_by_count = {}
+    for user_id, count in counts.items():
+        user_ids_by_count.setdefault(count, []).append(user_id)
+    for count, user_ids in user_ids_by_count.items():
+        UserProfile.objects.filter(user__in=user_ids).update(
+            award_count=F('award_count') + count)
+
+
+@receiver(post_delete, sender=Award)
+def decrement_profile_award_count(sender, instance, **kwargs):
+    UserProfile.objects.filter(user=instance.user_id).update(
+        award_count=F('award_count') - 1)
+
+
 # HACK: monkeypatch User.get_profile to ensure the profile exists
 User.get_profile = autocreate_user_profile
 
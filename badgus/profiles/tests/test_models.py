@@ -17,6 +17,7 @@ from django.core.cache import cache
 
 
 from badgus.base.tests import FakeResponse, override_constance_settings
+from badger.models import Badge
 from badgus.profiles.models import UserProfile
 
 
@@ -40,6 +41,36 @@ class UserProfileTest(test.TestCase):
         ok_(profile is not None)
         eq_(False, profile.username_changes)
 
+    def test_prefetched_profile(self):
+        """Ensure that a prefetched UserProfile is used on access"""
+        user = User.objects.create_user(
+            'auto_tester', 'auto_tester@example.com', 'auto_tester')
+        profile = user.get_profile()
+        user = (User.objects.prefetch_related('userprofile_set')
+                            .get(pk=user.pk))
+        with self.assertNumQueries(0):
+            eq_(profile.pk, user.get_profile().pk)
+
+    def test_award_count(self):
+        """Ensure that a UserProfile keeps a count of awards to the user"""
+        user = User.objects.create_user(
+            'auto_tester', 'auto_tester@example.com', 'auto_tester')
+        badge = Badge.objects.create(title='Count Me', unique=False)
+        award = badge.award_to(user)
+        badge.award_to(user)
+        eq_(2, user.get_profile().award_count)
+
+        # Awards made in bulk are counted too.
+        badge.award_to_many([user.email, user.email])
+        eq_(4, user.get_profile().award_count)
+
+        award.delete()
+        eq_(3, user.get_profile().award_count)
+
+        # Counts awards made before the profile existed.
+        user.get_profile().delete()
+        eq_(3, user.get_profile().award_count)
+
 class VouchedProfileTests(test.TestCase):
 
     def setUp(self):
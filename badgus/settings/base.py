@@ -393,6 +393,10 @@ PASSWORD_HASHERS = get_password_hashers(BASE_PASSWORD_HASHERS, HMAC_KEYS)
 ## Tests
 TEST_RUNNER = 'test_utils.runner.RadicalTestSuiteRunner'
 
+# Skip slow tests tagged with @attr('benchmark'). Run them too with
+# ./manage.py test -a benchmark
+NOSE_ARGS = ['-a', '!benchmark']
+
 # For absolute urls
 try:
     DOMAIN = socket.gethostname()
@@ -626,6 +630,8 @@ CSP_FRAME_SRC = ("'self'",
 CSP_OPTIONS = ('eval-script',)
 
 BADGER_ALLOW_ADD_BY_ANYONE = config('BADGER_ALLOW_ADD_BY_ANYONE', default=False, cast=bool)
+# User.__unicode__ and user_avatar() both use the profile
+BADGER_USER_PREFETCH_RELATED = ('userprofile_set',)
 
 DEFAULT_FROM_EMAIL = 'notifications@badges.mozilla.org'
 OBI_BASE_URL = "//backpack.openbadges.org/"